@@ -0,0 +1,66 @@
+"""
+Micro-benchmark of the Transaction/Invoice codec against the pre-slots models.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_codec [--records 20000] [--repeat 3]
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+
+from benchmarks import legacy_models
+from benchmarks.fixtures import invoice_json, transaction_json
+from data_classes.invoice import Invoice
+from data_classes.transaction import Transaction
+
+
+def best_of(repeat: int, func) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def resident_bytes(build) -> int:
+    """Bytes still allocated by the list `build` returns."""
+    gc.collect()
+    tracemalloc.start()
+    records = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del records
+    return size
+
+
+def run(name: str, payloads: list, current_cls, legacy_cls, repeat: int):
+    count = len(payloads)
+    print(f"{name} ({count} records)")
+    for label, cls in (("legacy", legacy_cls), ("current", current_cls)):
+        decoded = [cls.from_json(p) for p in payloads]
+        decode = best_of(repeat, lambda: [cls.from_json(p) for p in payloads])
+        encode = best_of(repeat, lambda: [r.to_json() for r in decoded])
+        memory = resident_bytes(lambda: [cls.from_json(p) for p in payloads])
+        print(f"  {label:<8} decode {decode / count * 1e6:7.2f} us/record"
+              f"  encode {encode / count * 1e6:7.2f} us/record"
+              f"  resident {memory / count:8.0f} B/record")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    run("transactions", [transaction_json(i) for i in range(args.records)],
+        Transaction, legacy_models.Transaction, args.repeat)
+    run("invoices", [invoice_json(i) for i in range(args.records)],
+        Invoice, legacy_models.Invoice, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Firestore writes per block for on-chain transactions, with num_confirmations
+stored on every document and with confirmations derived from the chain tip
+(services.chain).
+
+Every block mines `--txs-per-block` new transactions and LND re-emits the
+ones with fewer than `--recent` confirmations, as it does for every
+confirmation. Documents go through the Ingestor and fingerprint cache, the
+writes are counted instead of committed. Run from the repository root:
+
+    python -m benchmarks.bench_confirmations
+    python -m benchmarks.bench_confirmations --blocks 500 --txs-per-block 50 --recent 100
+"""
+import argparse
+import time
+
+from benchmarks.fake_firestore import FakeFirestore
+from benchmarks.fixtures import transaction_json
+from services.chain import BlockHeightIndex, ChainTracker
+from services.fingerprints import FingerprintCache
+from services.ingestion import Ingestor, TRANSACTIONS_SUBCOLLECTION
+
+BASE_HEIGHT = 800000
+
+
+class CountingWriter:
+    def __init__(self):
+        self.writes = 0
+
+    def upsert(self, doc_ref, data: dict, received_at=None, then=None):
+        self.writes += 1
+
+
+def run(label: str, args, derived: bool):
+    db = FakeFirestore()
+    writer = CountingWriter()
+    fingerprints = FingerprintCache(max_entries=args.blocks * args.txs_per_block + 1)
+    chain = None
+    if derived:
+        chain = ChainTracker(db, writer, fingerprints, BlockHeightIndex(), final_confirmations=args.final_confirmations)
+    ingestor = Ingestor(db, None, writer, fingerprints, chain=chain)
+    # index -> height it was mined at
+    mined = {}
+    per_block = []
+    started = time.perf_counter()
+    for block in range(args.blocks):
+        tip = BASE_HEIGHT + block
+        before = writer.writes
+        if chain is not None:
+            chain.advance(tip, f"{tip:064x}")
+        for i in range(block * args.txs_per_block, (block + 1) * args.txs_per_block):
+            mined[i] = tip
+        for i, height in mined.items():
+            confirmations = tip - height + 1
+            if confirmations > args.recent:
+                continue
+            data = transaction_json(i)
+            data.update(block_height=height, block_hash=f"{height:064x}", num_confirmations=confirmations)
+            ingestor.upsert_user_document(f"user{i % args.users}", TRANSACTIONS_SUBCOLLECTION, data["tx_hash"], data)
+        per_block.append(writer.writes - before)
+    elapsed = time.perf_counter() - started
+    # The first `recent` blocks fill the window, the steady state comes after
+    steady = per_block[args.recent:] or per_block
+    print(f"{label:18} writes {writer.writes:8d}  per block {sum(steady) / len(steady):8.1f}"
+          f"  max {max(steady):6d}  {elapsed:6.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--blocks", type=int, default=200)
+    parser.add_argument("--txs-per-block", type=int, default=20)
+    parser.add_argument("--recent", type=int, default=100, help="confirmations LND re-emits transactions up to")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--final-confirmations", type=int, default=6)
+    args = parser.parse_args()
+
+    run("num_confirmations", args, derived=False)
+    run("derived from tip", args, derived=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Size of the user documents written for transactions and invoices, with the
+full records and with the projections of services.projection.
+
+Sizes are computed with Firestore's storage size rules, which is what
+document limits and bandwidth are measured in, and as compact JSON as a
+client downloads them. Blobs are written once per distinct content and only
+read on demand, they are reported separately. Run from the repository root:
+
+    python -m benchmarks.bench_documents
+    python -m benchmarks.bench_documents --records 5000 --outputs 20 --htlcs 8 --route-hints 4
+"""
+import argparse
+import json
+from typing import List
+
+from benchmarks.fixtures import invoice_json, transaction_json
+from data_classes.invoice import Invoice
+from data_classes.transaction import Transaction
+from services.ingestion import (BACKEND_COLLECTION, BLOB_FIELD, BLOBS_COLLECTION, INVOICES_SUBCOLLECTION,
+                                TRANSACTIONS_SUBCOLLECTION)
+from services.projection import DEFAULT_PROJECTIONS
+
+
+def value_size(value) -> int:
+    """Storage size of a field value, https://firebase.google.com/docs/firestore/storage-size"""
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 8
+    if isinstance(value, str):
+        return len(value.encode()) + 1
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(value_size(item) for item in value)
+    if isinstance(value, dict):
+        return sum(len(key.encode()) + 1 + value_size(item) for key, item in value.items())
+    raise TypeError(f"Unsupported value {value!r}")
+
+
+def document_size(path: str, data: dict) -> int:
+    name = sum(len(segment.encode()) + 1 for segment in path.split("/")) + 16
+    return name + value_size(data) + 32
+
+
+def json_size(data: dict) -> int:
+    return len(json.dumps(data, separators=(',', ':')).encode())
+
+
+def percentile(values: List[int], q: float) -> int:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def summary(sizes: List[int]) -> str:
+    return f"avg {sum(sizes) / len(sizes):8.0f}  p99 {percentile(sizes, 0.99):7d}  max {max(sizes):7d}"
+
+
+def run(collection: str, records: List[dict]):
+    projection = DEFAULT_PROJECTIONS[collection]
+    full, hot, full_json, hot_json, blob_json, blob_stored = [], [], [], [], [], []
+    for document_id, data in records:
+        path = f"{BACKEND_COLLECTION}/user/{collection}/{document_id}"
+        document, bulky = projection.split(data)
+        full.append(document_size(path, data))
+        full_json.append(json_size(data))
+        if bulky:
+            digest, compressed = projection.encode(bulky)
+            document[BLOB_FIELD] = digest
+            blob_json.append(json_size(bulky))
+            blob_stored.append(document_size(f"{BLOBS_COLLECTION}/{digest}",
+                                             {"data": compressed, "size": len(compressed)}))
+        hot.append(document_size(path, document))
+        hot_json.append(json_size(document))
+
+    print(f"{collection} ({len(records)} records)")
+    print(f"  full document   {summary(full)}   json {summary(full_json)}")
+    print(f"  hot document    {summary(hot)}   json {summary(hot_json)}")
+    if blob_stored:
+        print(f"  blob            {summary(blob_stored)}   json {summary(blob_json)}")
+    saved = 1 - sum(hot) / sum(full)
+    print(f"  bytes written per update {sum(full) / len(full):.0f} -> {sum(hot) / len(hot):.0f}"
+          f" ({saved:.0%} less), per new record with its blob"
+          f" {(sum(hot) + sum(blob_stored)) / len(hot):.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=2000)
+    parser.add_argument("--outputs", type=int, default=2, help="outputs per transaction")
+    parser.add_argument("--htlcs", type=int, default=2, help="HTLCs per invoice")
+    parser.add_argument("--route-hints", type=int, default=2, help="route hints per invoice")
+    args = parser.parse_args()
+
+    transactions = [Transaction.from_json(transaction_json(i, num_outputs=args.outputs))
+                    for i in range(args.records)]
+    run(TRANSACTIONS_SUBCOLLECTION, [(transaction.tx_hash, transaction.to_json()) for transaction in transactions])
+    invoices = [Invoice.from_json(invoice_json(i, num_htlcs=args.htlcs, num_route_hints=args.route_hints))
+                for i in range(args.records)]
+    run(INVOICES_SUBCOLLECTION, [(invoice.payment_addr, invoice.to_json()) for invoice in invoices])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""
+End-to-end ingestion benchmark against a local fake LND and an in-process fake Firestore.
+
+The fake LND (benchmarks.fake_lnd) runs in a subprocess over TLS. The service
+side is wired like main.py: one LndNode feeding the shared Ingestor, batch
+writer, fingerprint cache, address index and checkpoint store, with the
+Firestore client replaced by benchmarks.fake_firestore. Run from the
+repository root:
+
+    python -m benchmarks.bench_ingest --scenario all
+    python -m benchmarks.bench_ingest --scenario backfill --transactions 50000 --invoices 50000
+    python -m benchmarks.bench_ingest --scenario steady --stream-events 10000 --rate 1000
+    python -m benchmarks.bench_ingest --scenario burst --stream-events 5000 --drop-after 1000 --burst 5000
+
+Scenarios:
+  backfill  historical records only, paged in by the startup backfill,
+            --stream-events and --burst are ignored
+  steady    records streamed at --rate per stream
+  burst     like steady, but the first connection of each stream drops after
+            --drop-after events while --burst more events are produced, which
+            have to be caught up after the reconnect
+
+Reported per scenario: events/sec over all records, p50/p99/max latency from
+a record being produced in LND (served, for historical records) to its
+Firestore commit, and the peak RSS of the service process. Only the first
+commit of each document is timed, so updates coalesced into a later write
+are not counted separately. `all` runs every scenario in its own process so
+peak RSS is not carried over.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from benchmarks.fake_firestore import FakeFirestore
+from benchmarks.fake_lnd import FakeLndData, add_data_arguments, data_arguments, data_from_args, parse_stamp, write_self_signed_cert
+from services.address_index import AddressIndex
+from services.checkpoints import CheckpointStore
+from services.fingerprints import FingerprintCache
+from services.firestore_writer import BatchWriter
+from services.ingestion import BACKEND_COLLECTION, BTC_ADDRESSES_COLLECTION, INVOICES_SUBCOLLECTION, Ingestor, TRANSACTIONS_SUBCOLLECTION
+from services.journal import EventJournal
+from services.lnd_node import LndNode, LndNodeConfig, NodeSettings
+
+SCENARIOS = ("backfill", "steady", "burst")
+# Defaults applied per scenario unless given on the command line
+SCENARIO_DEFAULTS = {
+    "backfill": {"transactions": 20000, "invoices": 20000, "stream_events": 0},
+    "steady": {"transactions": 0, "invoices": 0, "stream_events": 5000, "rate": 500.0},
+    "burst": {"transactions": 0, "invoices": 0, "stream_events": 5000, "rate": 500.0,
+              "drop_after": 1000, "burst": 5000},
+}
+# Applied even when given on the command line, e.g. to every scenario of `all`:
+# backfill never subscribes, streamed events would never be written
+SCENARIO_OVERRIDES = {
+    "backfill": {"stream_events": 0, "burst": 0},
+}
+
+
+class CommitRecorder:
+    """Latency of the first commit of every document carrying a bench stamp."""
+
+    def __init__(self):
+        self.latencies: Dict[str, float] = {}
+        self.last_commit_at = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, path: str, data: dict, committed_at: float):
+        produced_at = parse_stamp(data.get("label")) or parse_stamp(data.get("memo"))
+        if produced_at is None:
+            return
+        with self._lock:
+            if path not in self.latencies:
+                self.latencies[path] = committed_at - produced_at
+                self.last_commit_at = committed_at
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self.latencies)
+
+
+def owner(i: int, users: int, owned_ratio: float):
+    return f"user{i % users}" if (i % 100) < owned_ratio * 100 else None
+
+
+def seed_owners(db: FakeFirestore, data: FakeLndData, users: int, owned_ratio: float) -> List[str]:
+    """Give the owned records' addresses to users, return the document paths expected to be written."""
+    addresses: Dict[str, List[str]] = {}
+    # Recorded fixtures repeat addresses, each address keeps its first owner
+    address_owners: Dict[str, str] = {}
+    expected = []
+    kinds = (
+        (TRANSACTIONS_SUBCOLLECTION, data.total_transactions, data.transaction, "tx_hash"),
+        (INVOICES_SUBCOLLECTION, data.total_invoices, data.invoice, "payment_addr"),
+    )
+    for kind, total, record_of, id_field in kinds:
+        for i in range(total):
+            user_id = owner(i, users, owned_ratio)
+            if user_id is None:
+                continue
+            record = record_of(i)
+            address = data.owned_address(kind, record)
+            if not address:
+                continue
+            if address not in address_owners:
+                address_owners[address] = user_id
+                addresses.setdefault(user_id, []).append(address)
+            user_id = address_owners[address]
+            expected.append(f"{BACKEND_COLLECTION}/{user_id}/{kind}/{record[id_field]}")
+    for user_id, owned in addresses.items():
+        db.seed(f"{BTC_ADDRESSES_COLLECTION}/{user_id}", {"addresses": owned})
+    return expected
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("fake LND exited during startup")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError("fake LND did not start")
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+async def wait_for_commits(recorder: CommitRecorder, expected: int, idle_timeout: float):
+    """Wait until `expected` documents are committed or nothing was committed for `idle_timeout` seconds."""
+    last_count, last_progress = -1, time.time()
+    while True:
+        count = recorder.count()
+        if count >= expected:
+            return
+        if count != last_count:
+            last_count, last_progress = count, time.time()
+        elif time.time() - last_progress > idle_timeout:
+            return
+        await asyncio.sleep(0.05)
+
+
+async def drive(scenario: str, node: LndNode, address_index: AddressIndex, writer: BatchWriter,
+                recorder: CommitRecorder, expected: int, idle_timeout: float):
+    loop = asyncio.get_running_loop()
+    address_index.start()
+    writer.start()
+    await loop.run_in_executor(None, address_index.wait_ready, 30)
+    started_at = time.time()
+    if scenario == "backfill":
+        await node.backfill()
+        await wait_for_commits(recorder, expected, idle_timeout)
+    else:
+        await node.start()
+        await wait_for_commits(recorder, expected, idle_timeout)
+        await node.stop()
+    await node.close()
+    await loop.run_in_executor(None, writer.close)
+    return started_at
+
+
+def run_scenario(scenario: str, args) -> dict:
+    data = data_from_args(args)
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = write_self_signed_cert(directory)
+        macaroon_path = os.path.join(directory, "admin.macaroon")
+        with open(macaroon_path, "wb") as f:
+            f.write(os.urandom(64))
+        port = free_port()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "benchmarks.fake_lnd", "--port", str(port),
+             "--certfile", certfile, "--keyfile", keyfile] + data_arguments(args),
+        )
+        try:
+            wait_for_port(port, server)
+
+            recorder = CommitRecorder()
+            db = FakeFirestore(commit_latency=args.firestore_latency, on_commit=recorder)
+            expected = seed_owners(db, data, args.users, args.owned_ratio)
+
+            address_index = AddressIndex(db, BTC_ADDRESSES_COLLECTION)
+            fingerprints = FingerprintCache()
+            writer = BatchWriter(db, on_failure=lambda path, error: fingerprints.forget(path))
+            checkpoints = CheckpointStore(os.path.join(directory, "checkpoints.db"))
+            journal = EventJournal(os.path.join(directory, "journal.db"))
+
+            def commit_staged(ok: bool):
+                if ok:
+                    checkpoints.commit_staged()
+                    journal.commit_staged()
+                else:
+                    journal.rewind()
+
+            writer.add_drain_listener(commit_staged)
+            executor = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='persistence')
+            ingestor = Ingestor(db, address_index, writer, fingerprints)
+            node = LndNode(LndNodeConfig("bench", f"https://127.0.0.1:{port}", macaroon_path, certfile),
+                           NodeSettings(), ingestor, checkpoints, executor, journal)
+
+            started_at = asyncio.run(drive(scenario, node, address_index, writer, recorder,
+                                           len(expected), args.idle_timeout))
+            checkpoints.close()
+            journal.close()
+            executor.shutdown()
+        finally:
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+    latencies = sorted(recorder.latencies.values())
+    elapsed = max(recorder.last_commit_at - started_at, 1e-9)
+    events = data.total_transactions + data.total_invoices
+    return {
+        "scenario": scenario,
+        "events": events,
+        "documents": len(latencies),
+        "missing": len(expected) - len(latencies),
+        "elapsed": elapsed,
+        "events_per_sec": events / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": (latencies[-1] if latencies else float("nan")) * 1000,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def report(result: dict):
+    print(f"{result['scenario']:<9} {result['events']:>8} events  {result['elapsed']:7.2f} s"
+          f"  {result['events_per_sec']:9.0f} events/s"
+          f"  p50 {result['p50_ms']:8.1f} ms  p99 {result['p99_ms']:8.1f} ms  max {result['max_ms']:8.1f} ms"
+          f"  peak RSS {result['peak_rss_mb']:6.0f} MB"
+          + (f"  MISSING {result['missing']} documents" if result['missing'] else ""))
+
+
+def apply_defaults(args, scenario: str):
+    for name, value in SCENARIO_OVERRIDES.get(scenario, {}).items():
+        setattr(args, name, value)
+    for name, value in SCENARIO_DEFAULTS[scenario].items():
+        if getattr(args, name) is None:
+            setattr(args, name, value)
+    for name, value in (("transactions", 0), ("invoices", 0), ("stream_events", 0), ("rate", 100.0), ("burst", 0)):
+        if getattr(args, name) is None:
+            setattr(args, name, value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all")
+    parser.add_argument("--users", type=int, default=1000, help="users owning the records")
+    parser.add_argument("--owned-ratio", type=float, default=1.0, help="share of records some user owns")
+    parser.add_argument("--firestore-latency", type=float, default=0.02, help="seconds per fake Firestore commit")
+    parser.add_argument("--workers", type=int, default=8, help="persistence executor threads")
+    parser.add_argument("--idle-timeout", type=float, default=15.0,
+                        help="give up once no document was committed for this many seconds")
+    add_data_arguments(parser)
+    # Unset data options fall back to the scenario's defaults
+    parser.set_defaults(transactions=None, invoices=None, stream_events=None, rate=None, burst=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.scenario != "all":
+        apply_defaults(args, args.scenario)
+        report(run_scenario(args.scenario, args))
+        return
+
+    # One process per scenario, so each one reports its own peak RSS
+    passthrough = sys.argv[1:]
+    if "--scenario" in passthrough:
+        index = passthrough.index("--scenario")
+        del passthrough[index:index + 2]
+    for scenario in SCENARIOS:
+        subprocess.run([sys.executable, "-m", "benchmarks.bench_ingest", "--scenario", scenario] + passthrough,
+                       check=True)
+
+
+if __name__ == "__main__":
+    main()
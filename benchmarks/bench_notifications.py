@@ -0,0 +1,96 @@
+"""
+Fan-out benchmark of the push notification hub (services.notifications).
+
+Opens --connections server-sent event streams spread over --users users,
+publishes --events settlements from a persistence-like thread pool and
+reports the publish-to-delivery latency seen by the clients. A share of the
+clients (--slow-ratio) stops reading, to show they get evicted instead of
+holding events. Run from the repository root:
+
+    python -m benchmarks.bench_notifications
+    python -m benchmarks.bench_notifications --connections 10000 --users 5000 --events 40000 --rate 10000 --buffer-size 256
+"""
+import argparse
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from services.notifications import INVOICE_SETTLED, NotificationHub, event_stream
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+async def client(hub: NotificationHub, user_id: str, latencies: List[float], slow: bool):
+    stream = event_stream(hub, hub.subscribe(user_id))
+    async for frame in stream:
+        if not frame.startswith(b"id: "):
+            continue
+        if slow:
+            # Never reads again, the hub has to evict it
+            await asyncio.sleep(3600)
+        published_at = float(frame.rsplit(b'"published_at":', 1)[1].split(b"}", 1)[0])
+        latencies.append(time.perf_counter() - published_at)
+
+
+def publish(hub: NotificationHub, users: int, events: int, rate: float):
+    interval = 1 / rate if rate else 0
+    started = time.perf_counter()
+    for i in range(events):
+        if interval:
+            delay = started + i * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        hub.publish(f"user{i % users}", INVOICE_SETTLED,
+                    {"payment_addr": f"addr{i}", "amt_paid_sat": 1000, "published_at": time.perf_counter()})
+
+
+async def run(args):
+    hub = NotificationHub(buffer_size=args.buffer_size, max_subscribers=args.connections)
+    hub.start()
+    latencies: List[float] = []
+    slow_every = int(1 / args.slow_ratio) if args.slow_ratio else 0
+    clients = [asyncio.create_task(client(hub, f"user{i % args.users}", latencies,
+                                          slow=bool(slow_every) and i % slow_every == 0))
+               for i in range(args.connections)]
+    await asyncio.sleep(0.5)
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.publishers) as executor:
+        await asyncio.gather(*(loop.run_in_executor(executor, publish, hub, args.users,
+                                                     args.events // args.publishers, args.rate / args.publishers)
+                               for _ in range(args.publishers)))
+    await asyncio.sleep(1)
+    elapsed = time.perf_counter() - started
+    connected = hub.subscriber_count()
+    hub.stop()
+    for task in clients:
+        task.cancel()
+    await asyncio.gather(*clients, return_exceptions=True)
+
+    latencies.sort()
+    print(f"{args.connections} connections  {args.events} events  {len(latencies)} deliveries in {elapsed:.2f} s"
+          f"  p50 {percentile(latencies, 0.50) * 1000:.2f} ms  p99 {percentile(latencies, 0.99) * 1000:.2f} ms"
+          f"  max {(latencies[-1] if latencies else float('nan')) * 1000:.2f} ms"
+          f"  evicted {args.connections - connected}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=2500)
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--rate", type=float, default=5000.0, help="events per second over all publishers")
+    parser.add_argument("--publishers", type=int, default=4, help="publishing threads")
+    parser.add_argument("--buffer-size", type=int, default=4, help="small so slow clients fall behind within a short run")
+    parser.add_argument("--slow-ratio", type=float, default=0.01, help="share of clients that stop reading")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Cost of a full consistency check with services.reconcile, against re-posting
+every record as the startup backfill used to.
+
+The fake Firestore is filled by a first reconcile run, then a share of the
+documents is deleted (--missing) or changed (--divergent) before the
+measured run. Reads are the documents returned to the reconciler, writes
+the documents committed. Run from the repository root:
+
+    python -m benchmarks.bench_reconcile
+    python -m benchmarks.bench_reconcile --records 50000 --users 2000 --workers 16
+"""
+import argparse
+import random
+import time
+from typing import Dict, Iterator, List
+
+from benchmarks.fake_firestore import FakeFirestore
+from benchmarks.fixtures import address, invoice_json, transaction_json
+from data_classes.invoice import Invoice
+from data_classes.transaction import Transaction
+from services.firestore_writer import BatchWriter
+from services.ingestion import BACKEND_COLLECTION, INVOICES_SUBCOLLECTION, TRANSACTIONS_SUBCOLLECTION, Ingestor
+from services.projection import DEFAULT_PROJECTIONS, BlobStore
+from services.reconcile import ExpectedStore, Reconciler
+
+PAGE_SIZE = 1000
+
+
+class StaticAddressIndex:
+    def __init__(self, owners: Dict[str, str]):
+        self._owners = owners
+
+    def get_owner(self, address: str):
+        return self._owners.get(address)
+
+
+class FakeNode:
+    """The paging of an LndNode over fixture records."""
+    name = "bench"
+
+    def __init__(self, transactions: List[Transaction], invoices: List[Invoice]):
+        self._transactions = transactions
+        self._invoices = invoices
+
+    def iter_transaction_pages(self) -> Iterator[List[Transaction]]:
+        for start in range(0, len(self._transactions), PAGE_SIZE):
+            yield self._transactions[start:start + PAGE_SIZE]
+
+    def iter_invoice_pages(self) -> Iterator[List[Invoice]]:
+        for start in range(0, len(self._invoices), PAGE_SIZE):
+            yield self._invoices[start:start + PAGE_SIZE]
+
+
+def reconcile(db: FakeFirestore, address_index, node: FakeNode, workers: int, dry_run: bool = False):
+    writer = BatchWriter(db)
+    blobs = BlobStore(db, writer)
+    ingestor = Ingestor(db, address_index, None, None, projections=DEFAULT_PROJECTIONS, blobs=blobs)
+    expected = ExpectedStore()
+    reconciler = Reconciler(db, writer, ingestor, expected, blobs=blobs, final_confirmations=6, dry_run=dry_run)
+    db.reads = db.commits = 0
+    started = time.perf_counter()
+    report = reconciler.run([node], workers=workers)
+    elapsed = time.perf_counter() - started
+    expected.close()
+    return report, elapsed, db.reads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=10000, help="transactions and as many invoices")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--missing", type=float, default=0.01, help="share of documents deleted")
+    parser.add_argument("--divergent", type=float, default=0.01, help="share of documents changed")
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    owners = {address(i): f"user{i % args.users}" for i in range(args.records)}
+    transactions = [Transaction.from_json(transaction_json(i, owned_address=address(i))) for i in range(args.records)]
+    invoices = [Invoice.from_json(invoice_json(i, fallback_addr=address(i))) for i in range(args.records)]
+    node = FakeNode(transactions, invoices)
+    address_index = StaticAddressIndex(owners)
+    db = FakeFirestore()
+
+    report, elapsed, reads = reconcile(db, address_index, node, args.workers)
+    print(f"initial fill      {report.written:7d} documents written in {elapsed:6.2f} s")
+
+    rng = random.Random(0)
+    paths = sorted(path for path in db.documents if path.split("/")[0] == BACKEND_COLLECTION
+                   and path.split("/")[2:3] in ([TRANSACTIONS_SUBCOLLECTION], [INVOICES_SUBCOLLECTION]))
+    damaged = rng.sample(paths, int(len(paths) * (args.missing + args.divergent)))
+    deleted = damaged[:int(len(paths) * args.missing)]
+    for path in deleted:
+        del db.documents[path]
+    for path in damaged[len(deleted):]:
+        document = db.documents[path]
+        if "amount" in document:
+            document["amount"] += 1
+        else:
+            document["memo"] = "changed"
+
+    report, elapsed, reads = reconcile(db, address_index, node, args.workers)
+    records = len(paths)
+    print(f"reconcile         {elapsed:6.2f} s  {records / elapsed:8.0f} documents/s  reads {reads:7d}"
+          f"  writes {report.written:6d}  (missing {report.missing}, divergent {report.divergent},"
+          f" skipped {report.skipped}, extra {report.extra})")
+    print(f"re-posting        reads {records:7d}  writes {records:6d}")
+    report, _, _ = reconcile(db, address_index, node, args.workers, dry_run=True)
+    print(f"after repair      missing {report.missing}, divergent {report.divergent}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+In-process stand-in for the parts of the Firestore client the service uses.
+
+Documents live in a dict keyed by path. Batch commits and single writes
+sleep for `commit_latency` seconds to stand in for the round trip, then
+merge the data and report every written document to `on_commit(path, data,
+committed_at)`. Fields written as DELETE_FIELD are removed.
+"""
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+from google.cloud.firestore import DELETE_FIELD
+
+
+@dataclass
+class ChangeType:
+    name: str
+
+
+@dataclass
+class DocumentChange:
+    type: ChangeType
+    document: "DocumentSnapshot"
+
+
+class DocumentSnapshot:
+    def __init__(self, reference: "DocumentReference", data: Optional[dict]):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Optional[dict]:
+        return dict(self._data) if self._data is not None else None
+
+
+class Watch:
+    def unsubscribe(self):
+        pass
+
+
+class DocumentReference:
+    def __init__(self, db: "FakeFirestore", path: str, parent: "CollectionReference"):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+        self.parent = parent
+
+    def collection(self, name: str) -> "CollectionReference":
+        return CollectionReference(self._db, f"{self.path}/{name}", self)
+
+    def set(self, data: dict, merge: bool = False):
+        self._db._commit([(self, data, merge)])
+
+    def get(self) -> DocumentSnapshot:
+        self._db.count_reads(1)
+        return DocumentSnapshot(self, self._db.documents.get(self.path))
+
+
+class Query:
+    def __init__(self, collection: "CollectionReference", field: str, op: str, value, limit: Optional[int] = None):
+        if op != 'array_contains':
+            raise NotImplementedError(f"Unsupported operator {op}")
+        self._collection = collection
+        self._field = field
+        self._value = value
+        self._limit = limit
+
+    def limit(self, count: int) -> "Query":
+        return Query(self._collection, self._field, 'array_contains', self._value, count)
+
+    def stream(self):
+        matches = [doc for doc in self._collection.documents() if self._value in (doc.to_dict() or {}).get(self._field, [])]
+        return iter(matches[:self._limit] if self._limit is not None else matches)
+
+
+class OrderedQuery:
+    """A collection ordered by document id, the only ordering the reconciler pages with."""
+
+    def __init__(self, collection: "CollectionReference", after: Optional[str] = None, limit: Optional[int] = None):
+        self._collection = collection
+        self._after = after
+        self._limit = limit
+
+    def start_after(self, snapshot: DocumentSnapshot) -> "OrderedQuery":
+        return OrderedQuery(self._collection, snapshot.id, self._limit)
+
+    def limit(self, count: int) -> "OrderedQuery":
+        return OrderedQuery(self._collection, self._after, count)
+
+    def stream(self):
+        docs = sorted(self._collection.documents(), key=lambda doc: doc.id)
+        if self._after is not None:
+            docs = [doc for doc in docs if doc.id > self._after]
+        docs = docs[:self._limit] if self._limit is not None else docs
+        self._collection._db.count_reads(len(docs))
+        return iter(docs)
+
+
+class SelectQuery:
+    """A collection read with only some fields, as the aggregate rebuild does."""
+
+    def __init__(self, collection: "CollectionReference", fields):
+        self._collection = collection
+        self._fields = list(fields)
+
+    def stream(self):
+        docs = self._collection.documents()
+        self._collection._db.count_reads(len(docs))
+        return iter([DocumentSnapshot(doc.reference, {name: value for name, value in doc.to_dict().items()
+                                                      if name in self._fields}) for doc in docs])
+
+
+class CollectionReference:
+    def __init__(self, db: "FakeFirestore", path: str, parent: Optional[DocumentReference] = None):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+        self.parent = parent
+
+    def document(self, document_id: str) -> DocumentReference:
+        return DocumentReference(self._db, f"{self.path}/{document_id}", self)
+
+    def where(self, field: str, op: str, value) -> Query:
+        return Query(self, field, op, value)
+
+    def select(self, fields) -> SelectQuery:
+        return SelectQuery(self, fields)
+
+    def order_by(self, field: str) -> OrderedQuery:
+        if field != '__name__':
+            raise NotImplementedError(f"Unsupported ordering {field}")
+        return OrderedQuery(self)
+
+    def documents(self) -> List[DocumentSnapshot]:
+        prefix = self.path + '/'
+        with self._db._lock:
+            items = [(path, dict(data)) for path, data in self._db.documents.items()
+                     if path.startswith(prefix) and '/' not in path[len(prefix):]]
+        return [DocumentSnapshot(self.document(path[len(prefix):]), data) for path, data in items]
+
+    def on_snapshot(self, callback) -> Watch:
+        """Deliver the current documents once, from a background thread like the real listener."""
+        def deliver():
+            docs = self.documents()
+            changes = [DocumentChange(ChangeType('ADDED'), doc) for doc in docs]
+            callback(docs, changes, time.time())
+        threading.Thread(target=deliver, name='fake-firestore-snapshot', daemon=True).start()
+        return Watch()
+
+
+class WriteBatch:
+    def __init__(self, db: "FakeFirestore"):
+        self._db = db
+        self._writes = []
+
+    def set(self, ref: DocumentReference, data: dict, merge: bool = False):
+        self._writes.append((ref, data, merge))
+
+    def commit(self):
+        self._db._commit(self._writes)
+
+
+class FakeFirestore:
+    def __init__(self, commit_latency: float = 0.0,
+                 on_commit: Optional[Callable[[str, dict, float], None]] = None):
+        self.commit_latency = commit_latency
+        self.on_commit = on_commit
+        self.documents: Dict[str, dict] = {}
+        self.commits = 0
+        # Documents returned by gets and ordered queries
+        self.reads = 0
+        self._lock = threading.Lock()
+
+    def collection(self, name: str) -> CollectionReference:
+        return CollectionReference(self, name)
+
+    def batch(self) -> WriteBatch:
+        return WriteBatch(self)
+
+    def count_reads(self, count: int):
+        with self._lock:
+            self.reads += count
+
+    def seed(self, path: str, data: dict):
+        """Store a document without going through a commit."""
+        with self._lock:
+            self.documents[path] = dict(data)
+
+    def _commit(self, writes):
+        if self.commit_latency:
+            time.sleep(self.commit_latency)
+        with self._lock:
+            for ref, data, merge in writes:
+                if merge and ref.path in self.documents:
+                    self.documents[ref.path].update(data)
+                else:
+                    self.documents[ref.path] = dict(data)
+                for name in [name for name, value in data.items() if value is DELETE_FIELD]:
+                    del self.documents[ref.path][name]
+            self.commits += 1
+        if self.on_commit is not None:
+            committed_at = time.time()
+            for ref, data, _ in writes:
+                self.on_commit(ref.path, data, committed_at)
@@ -0,0 +1,337 @@
+"""
+Local stand-in for the LND REST API, serving synthetic or recorded records.
+
+Serves /v1/getinfo, /v1/transactions, /v1/invoices and the newline-delimited
+/v1/transactions/subscribe and /v1/invoices/subscribe streams over TLS:
+
+    python -m benchmarks.fake_lnd --port 18443 --certfile cert.pem --keyfile key.pem \\
+        --transactions 10000 --invoices 10000 --stream-events 5000 --rate 500
+
+`--transactions`/`--invoices` records exist from the start and are served by
+the paging endpoints. `--stream-events` further records per stream are
+produced at `--rate` per second once the stream is first subscribed to, and
+are delivered by the subscriptions and the paging endpoints alike. With
+`--drop-after N` the first connection of each stream is aborted after N
+events, and `--burst B` more events are produced at that moment, so they
+have to be picked up after the reconnect.
+
+Every record carries the time it was produced (streamed records) or served
+(historical records) in its label (transactions) or memo (invoices) as
+"bench:<unix time>", so the sink can measure end-to-end latency.
+"""
+import argparse
+import asyncio
+import copy
+import datetime
+import ipaddress
+import json
+import math
+import os
+import time
+from typing import List, Optional
+
+from fastapi import FastAPI, Query
+from fastapi.responses import StreamingResponse
+
+from benchmarks.fixtures import invoice_json, transaction_json
+
+STAMP_PREFIX = "bench:"
+BASE_HEIGHT = 800000
+TRANSACTIONS_PER_BLOCK = 10
+# Streamed lines sent in one chunk at most when events are overdue
+MAX_CHUNK_EVENTS = 1000
+
+
+def stamp(t: float) -> str:
+    return f"{STAMP_PREFIX}{t:.6f}"
+
+
+def parse_stamp(value) -> Optional[float]:
+    if isinstance(value, str) and value.startswith(STAMP_PREFIX):
+        return float(value[len(STAMP_PREFIX):])
+    return None
+
+
+class Schedule:
+    """Production times of the streamed events of one stream, relative to its start."""
+
+    def __init__(self, events: int, rate: float, drop_after: Optional[int] = None, burst: int = 0):
+        self.rate = rate
+        self.drop_after = drop_after
+        self.burst = burst if drop_after is not None else 0
+        self.total = events + self.burst
+
+    def offset(self, k: int) -> float:
+        if self.drop_after is None or k < self.drop_after:
+            return k / self.rate
+        if k < self.drop_after + self.burst:
+            return self.drop_after / self.rate
+        return (k - self.burst) / self.rate
+
+    def produced(self, elapsed: float) -> int:
+        """Number of events produced `elapsed` seconds after the start."""
+        if elapsed < 0:
+            return 0
+        # Event k is produced at k / rate, events due exactly now are not produced yet
+        ticks = math.ceil(elapsed * self.rate)
+        if self.drop_after is not None and ticks > self.drop_after:
+            ticks += self.burst
+        return min(ticks, self.total)
+
+
+class FakeLndData:
+    """
+    Deterministic transaction and invoice records, numbered from 0.
+
+    Records below `history_*` exist from the start, the following ones are
+    produced by the stream schedules. With `fixtures` (a JSON file holding
+    "transactions" and "invoices" lists in LND REST format) the recorded
+    records are cycled, with hashes and indices made unique per number.
+    """
+
+    def __init__(self, history_transactions: int = 0, history_invoices: int = 0, stream_events: int = 0,
+                 rate: float = 100.0, drop_after: Optional[int] = None, burst: int = 0,
+                 fixtures: Optional[str] = None):
+        self.history_transactions = history_transactions
+        self.history_invoices = history_invoices
+        self.transaction_schedule = Schedule(stream_events, rate, drop_after, burst)
+        self.invoice_schedule = Schedule(stream_events, rate, drop_after, burst)
+        self._recorded_transactions: List[dict] = []
+        self._recorded_invoices: List[dict] = []
+        if fixtures:
+            with open(fixtures) as f:
+                recorded = json.load(f)
+            self._recorded_transactions = recorded.get("transactions", [])
+            self._recorded_invoices = recorded.get("invoices", [])
+
+    @property
+    def total_transactions(self) -> int:
+        return self.history_transactions + self.transaction_schedule.total
+
+    @property
+    def total_invoices(self) -> int:
+        return self.history_invoices + self.invoice_schedule.total
+
+    def transaction(self, i: int) -> dict:
+        if self._recorded_transactions:
+            record = copy.deepcopy(self._recorded_transactions[i % len(self._recorded_transactions)])
+            record["tx_hash"] = f"{i:064x}"
+        else:
+            record = transaction_json(i)
+        record["block_height"] = BASE_HEIGHT + i // TRANSACTIONS_PER_BLOCK
+        record["num_confirmations"] = 1
+        return record
+
+    def invoice(self, i: int) -> dict:
+        if self._recorded_invoices:
+            record = copy.deepcopy(self._recorded_invoices[i % len(self._recorded_invoices)])
+            record["payment_addr"] = f"{i:064x}"
+            record["r_hash"] = f"{i:064x}"
+        else:
+            record = invoice_json(i)
+        record["add_index"] = str(i + 1)
+        record["settle_index"] = str(i + 1) if record.get("state") == "SETTLED" else "0"
+        return record
+
+    def owned_address(self, kind: str, record: dict) -> Optional[str]:
+        """The address an owner lookup resolves `record` by."""
+        if kind == "transactions":
+            for output in record.get("output_details", []):
+                if output.get("is_our_address"):
+                    return output.get("address")
+            return None
+        return record.get("fallback_addr") or None
+
+
+class StreamState:
+    def __init__(self, schedule: Schedule):
+        self.schedule = schedule
+        self.started_at: Optional[float] = None
+        self.connections = 0
+
+    def start(self) -> float:
+        if self.started_at is None:
+            self.started_at = time.time()
+        return self.started_at
+
+    def produced(self) -> int:
+        if self.started_at is None:
+            return 0
+        return self.schedule.produced(time.time() - self.started_at)
+
+    def produced_at(self, k: int) -> float:
+        return self.started_at + self.schedule.offset(k)
+
+
+def create_app(data: FakeLndData) -> FastAPI:
+    app = FastAPI()
+    transactions_stream = StreamState(data.transaction_schedule)
+    invoices_stream = StreamState(data.invoice_schedule)
+
+    def available_transactions() -> int:
+        return data.history_transactions + transactions_stream.produced()
+
+    def available_invoices() -> int:
+        return data.history_invoices + invoices_stream.produced()
+
+    def stamped_transaction(i: int, served_at: float) -> dict:
+        record = data.transaction(i)
+        k = i - data.history_transactions
+        record["label"] = stamp(transactions_stream.produced_at(k) if k >= 0 else served_at)
+        return record
+
+    def stamped_invoice(i: int, served_at: float) -> dict:
+        record = data.invoice(i)
+        k = i - data.history_invoices
+        record["memo"] = stamp(invoices_stream.produced_at(k) if k >= 0 else served_at)
+        if k >= 0:
+            record["creation_date"] = str(int(invoices_stream.produced_at(k)))
+        return record
+
+    @app.get("/v1/getinfo")
+    def getinfo():
+        return {"block_height": BASE_HEIGHT + max(available_transactions() - 1, 0) // TRANSACTIONS_PER_BLOCK}
+
+    @app.get("/v1/transactions")
+    def transactions(start_height: int = 0, end_height: int = -1):
+        available = available_transactions()
+        first = max((start_height - BASE_HEIGHT) * TRANSACTIONS_PER_BLOCK, 0)
+        last = available if end_height == -1 else min((end_height - BASE_HEIGHT + 1) * TRANSACTIONS_PER_BLOCK, available)
+        served_at = time.time()
+        return {"transactions": [stamped_transaction(i, served_at) for i in range(first, last)]}
+
+    @app.get("/v1/invoices")
+    def invoices(index_offset: int = 0, num_max_invoices: int = 100, creation_date_start: int = 0):
+        available = available_invoices()
+        served_at = time.time()
+        page = []
+        i = index_offset
+        while i < available and len(page) < num_max_invoices:
+            record = stamped_invoice(i, served_at)
+            if int(record["creation_date"]) >= creation_date_start:
+                page.append(record)
+            i += 1
+        last_index_offset = int(page[-1]["add_index"]) if page else index_offset
+        return {"invoices": page, "last_index_offset": str(last_index_offset), "first_index_offset": str(index_offset)}
+
+    async def emit(state: StreamState, first: int, history: int, line):
+        """Yield the lines of records `first` onwards as they are produced."""
+        state.connections += 1
+        drop_at = state.schedule.drop_after if state.connections == 1 else None
+        i = first
+        while i - history < state.schedule.total:
+            k = i - history
+            if drop_at is not None and k >= drop_at:
+                raise ConnectionAbortedError("dropping the stream")
+            if k >= 0:
+                delay = state.produced_at(k) - time.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            lines = []
+            now = time.time()
+            while (i - history < state.schedule.total and len(lines) < MAX_CHUNK_EVENTS
+                   and (drop_at is None or i - history < drop_at)
+                   and (i < history or state.produced_at(i - history) <= now)):
+                lines.append(line(i, now))
+                i += 1
+            yield "".join(lines)
+        # LND keeps subscriptions open
+        await asyncio.Event().wait()
+
+    @app.get("/v1/transactions/subscribe")
+    def subscribe_transactions():
+        transactions_stream.start()
+        first = available_transactions()
+        line = lambda i, now: json.dumps(stamped_transaction(i, now)) + "\n"
+        return StreamingResponse(emit(transactions_stream, first, data.history_transactions, line),
+                                 media_type="application/json")
+
+    @app.get("/v1/invoices/subscribe")
+    def subscribe_invoices(add_index: Optional[int] = Query(None), settle_index: Optional[int] = Query(None)):
+        invoices_stream.start()
+        # A resumed subscription replays everything added after add_index
+        first = add_index if add_index is not None else available_invoices()
+        line = lambda i, now: json.dumps({"result": stamped_invoice(i, now)}) + "\n"
+        return StreamingResponse(emit(invoices_stream, first, data.history_invoices, line),
+                                 media_type="application/json")
+
+    return app
+
+
+def write_self_signed_cert(directory: str, host: str = "127.0.0.1"):
+    """Write a self-signed certificate and key for `host` like LND's tls.cert, return their paths."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "fake lnd")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=30))
+        .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address(host)),
+                                                    x509.DNSName("localhost")]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(key.public_key()), critical=False)
+        .sign(key, hashes.SHA256())
+    )
+    certfile = os.path.join(directory, "tls.cert")
+    keyfile = os.path.join(directory, "tls.key")
+    with open(certfile, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(keyfile, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    return certfile, keyfile
+
+
+def add_data_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--transactions", type=int, default=0, help="historical transactions")
+    parser.add_argument("--invoices", type=int, default=0, help="historical invoices")
+    parser.add_argument("--stream-events", type=int, default=0, help="streamed events per stream")
+    parser.add_argument("--rate", type=float, default=100.0, help="streamed events per second per stream")
+    parser.add_argument("--drop-after", type=int, default=None, help="abort the first connection after N events")
+    parser.add_argument("--burst", type=int, default=0, help="events produced at once when the stream drops")
+    parser.add_argument("--fixtures", default=None, help="JSON file with recorded transactions and invoices")
+
+
+def data_from_args(args) -> FakeLndData:
+    return FakeLndData(args.transactions, args.invoices, args.stream_events, args.rate,
+                       args.drop_after, args.burst, args.fixtures)
+
+
+def data_arguments(args) -> List[str]:
+    """Command line arguments reproducing the data options of `args`."""
+    argv = ["--transactions", str(args.transactions), "--invoices", str(args.invoices),
+            "--stream-events", str(args.stream_events), "--rate", str(args.rate), "--burst", str(args.burst)]
+    if args.drop_after is not None:
+        argv += ["--drop-after", str(args.drop_after)]
+    if args.fixtures:
+        argv += ["--fixtures", args.fixtures]
+    return argv
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18443)
+    parser.add_argument("--certfile", required=True)
+    parser.add_argument("--keyfile", required=True)
+    add_data_arguments(parser)
+    args = parser.parse_args()
+    # Dropped streams are aborted with an exception, which uvicorn logs at error level
+    uvicorn.run(create_app(data_from_args(args)), host=args.host, port=args.port,
+                ssl_certfile=args.certfile, ssl_keyfile=args.keyfile, log_level="critical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Synthetic LND REST payloads shaped like /v1/transactions and /v1/invoices records."""
+import hashlib
+import random
+
+
+def _hex(seed: str, size: int = 32) -> str:
+    return hashlib.sha256(seed.encode()).hexdigest()[:size * 2]
+
+
+def address(i: int) -> str:
+    return f"bc1q{_hex(f'addr{i}', 19)}"
+
+
+def transaction_json(i: int, num_outputs: int = 2, owned_address: str = None) -> dict:
+    """A confirmed on-chain transaction with `num_outputs` outputs, the first one ours."""
+    # LND encodes int64 fields as strings, like the invoice ones below
+    outputs = []
+    for n in range(num_outputs):
+        outputs.append({
+            "output_type": "SCRIPT_TYPE_WITNESS_V0_PUBKEY_HASH",
+            "address": owned_address if n == 0 and owned_address else address(i * 10 + n),
+            "pk_script": "0014" + _hex(f'pk{i}.{n}', 20),
+            "output_index": str(n),
+            "amount": str(10000 + i + n),
+            "is_our_address": n == 0,
+        })
+    return {
+        "tx_hash": _hex(f'tx{i}'),
+        "amount": str(10000 + i),
+        "num_confirmations": 6,
+        "block_hash": _hex(f'block{i // 10}'),
+        "block_height": 800000 + i // 10,
+        "time_stamp": str(1700000000 + i * 60),
+        "total_fees": str(150 + i % 50),
+        "dest_addresses": [o["address"] for o in outputs],
+        "output_details": outputs,
+        "raw_tx_hex": _hex(f'raw{i}', 32) * 12,
+        "label": "",
+        "previous_outpoints": [{"outpoint": f"{_hex(f'prev{i}')}:0", "is_our_output": False}],
+    }
+
+
+def invoice_json(i: int, num_htlcs: int = 2, num_route_hints: int = 2, state: str = "SETTLED",
+                 fallback_addr: str = None) -> dict:
+    """An invoice with `num_htlcs` HTLCs and `num_route_hints` single-hop route hints."""
+    settled = state == "SETTLED"
+    return {
+        "memo": f"invoice {i}",
+        "r_preimage": _hex(f'pre{i}'),
+        "r_hash": _hex(f'hash{i}'),
+        "value": str(1000 + i),
+        "value_msat": str((1000 + i) * 1000),
+        "settled": settled,
+        "creation_date": str(1700000000 + i * 30),
+        "settle_date": str(1700000000 + i * 30 + 5) if settled else "0",
+        "payment_request": "lnbc" + _hex(f'pr{i}', 32) * 6,
+        "description_hash": "",
+        "expiry": "86400",
+        "fallback_addr": fallback_addr if fallback_addr is not None else address(i),
+        "cltv_expiry": "80",
+        "route_hints": [
+            {"hop_hints": [{
+                "node_id": "02" + _hex(f'node{i}.{n}'),
+                "chan_id": str(880000000000000 + i * 10 + n),
+                "fee_base_msat": 1000,
+                "fee_proportional_millionths": 1,
+                "cltv_expiry_delta": 40,
+            }]}
+            for n in range(num_route_hints)
+        ],
+        "private": True,
+        "add_index": str(i + 1),
+        "settle_index": str(i + 1) if settled else "0",
+        "amt_paid": str((1000 + i) * 1000) if settled else "0",
+        "amt_paid_sat": str(1000 + i) if settled else "0",
+        "amt_paid_msat": str((1000 + i) * 1000) if settled else "0",
+        "state": state,
+        "htlcs": [
+            {
+                "chan_id": str(880000000000000 + n),
+                "htlc_index": str(i * 10 + n),
+                "amt_msat": str((1000 + i) * 1000 // max(num_htlcs, 1)),
+                "accept_height": 800000 + i // 10,
+                "accept_time": str(1700000000 + i * 30 + 1),
+                "resolve_time": str(1700000000 + i * 30 + 5),
+                "expiry_height": 800080 + i // 10,
+                "state": "SETTLED" if settled else "ACCEPTED",
+                "custom_records": {},
+                "mpp_total_amt_msat": str((1000 + i) * 1000),
+                "amp": None,
+            }
+            for n in range(num_htlcs if state != "OPEN" else 0)
+        ],
+        "features": {"9": {"name": "tlv-onion", "is_required": False, "is_known": True}},
+        "is_keysend": False,
+        "payment_addr": _hex(f'payaddr{i}'),
+        "is_amp": False,
+        "amp_invoice_state": {},
+    }
+
+
+def shuffled(records, seed: int = 0):
+    records = list(records)
+    random.Random(seed).shuffle(records)
+    return records
@@ -0,0 +1,230 @@
+"""
+The Transaction and Invoice models as they were before the slotted codec,
+kept only so the codec benchmark has something to compare against.
+"""
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional
+
+
+@dataclass
+class OutputDetail:
+    output_type: str
+    address: str
+    pk_script: str
+    output_index: int
+    amount: int
+    is_our_address: bool
+
+    @classmethod
+    def from_json(cls, data: dict) -> "OutputDetail":
+        return cls(**data)
+
+    def to_json(self) -> dict:
+        return asdict(self)
+
+
+@dataclass
+class PreviousOutPoint:
+    outpoint: str
+    is_our_output: bool
+
+    @classmethod
+    def from_json(cls, data: dict) -> "PreviousOutPoint":
+        return cls(**data)
+
+    def to_json(self) -> dict:
+        return asdict(self)
+
+
+@dataclass
+class Transaction:
+    tx_hash: str
+    amount: int
+    num_confirmations: int
+    block_hash: str
+    block_height: int
+    time_stamp: int
+    total_fees: int
+    dest_addresses: Optional[List[str]]
+    output_details: List[OutputDetail] = field(default_factory=list)
+    raw_tx_hex: str = ''
+    label: str = ''
+    previous_outpoints: List[PreviousOutPoint] = field(default_factory=list)
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Transaction":
+        return cls(
+            tx_hash=data["tx_hash"],
+            amount=data["amount"],
+            num_confirmations=data["num_confirmations"],
+            block_hash=data["block_hash"],
+            block_height=data["block_height"],
+            time_stamp=data["time_stamp"],
+            total_fees=data["total_fees"],
+            dest_addresses=data.get("dest_addresses"),
+            output_details=[OutputDetail.from_json(od) for od in data.get("output_details", [])],
+            raw_tx_hex=data["raw_tx_hex"],
+            label=data["label"],
+            previous_outpoints=[PreviousOutPoint.from_json(po) for po in data.get("previous_outpoints", [])],
+        )
+
+    def to_json(self) -> dict:
+        return {
+            "tx_hash": self.tx_hash,
+            "amount": self.amount,
+            "num_confirmations": self.num_confirmations,
+            "block_hash": self.block_hash,
+            "block_height": self.block_height,
+            "time_stamp": self.time_stamp,
+            "total_fees": self.total_fees,
+            "dest_addresses": self.dest_addresses,
+            "output_details": [od.to_json() for od in self.output_details],
+            "raw_tx_hex": self.raw_tx_hex,
+            "label": self.label,
+            "previous_outpoints": [po.to_json() for po in self.previous_outpoints],
+        }
+
+
+@dataclass
+class HopHint:
+    node_id: str
+    chan_id: str
+    fee_base_msat: int
+    fee_proportional_millionths: int
+    cltv_expiry_delta: int
+
+    @classmethod
+    def from_json(cls, data: dict) -> "HopHint":
+        return cls(**data)
+
+    def to_json(self) -> dict:
+        return asdict(self)
+
+
+@dataclass
+class RouteHint:
+    hop_hints: List[HopHint] = field(default_factory=list)
+
+    @classmethod
+    def from_json(cls, data: dict) -> "RouteHint":
+        return cls(hop_hints=[HopHint.from_json(hh) for hh in data.get("hop_hints", [])])
+
+    def to_json(self) -> dict:
+        return {"hop_hints": [hh.to_json() for hh in self.hop_hints]}
+
+
+@dataclass
+class Htlc:
+    chan_id: Optional[str] = None
+    amt_msat: Optional[int] = None
+    accept_time: Optional[str] = None
+    resolve_time: Optional[str] = None
+    accept_height: Optional[int] = None
+    htlc_index: Optional[int] = None
+    expiry_height: Optional[int] = None
+    state: Optional[str] = None
+    custom_records: list = field(default_factory=list)
+    mpp_total_amt_msat: Optional[str] = None
+    amp: Optional[dict] = None
+    custom_channel_data: Optional[str] = None
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Htlc":
+        return cls(**data)
+
+    def to_json(self) -> dict:
+        return asdict(self)
+
+
+@dataclass
+class Invoice:
+    memo: str
+    r_preimage: str
+    r_hash: str
+    value: int
+    settled: bool
+    creation_date: str
+    payment_request: str
+    expiry: int
+    cltv_expiry: int
+    state: str
+    value_msat: Optional[int] = None
+    settle_date: Optional[str] = None
+    description_hash: Optional[str] = None
+    fallback_addr: Optional[str] = None
+    route_hints: Optional[List[RouteHint]] = field(default_factory=list)
+    private: Optional[bool] = None
+    add_index: Optional[int] = None
+    settle_index: Optional[int] = None
+    amt_paid: Optional[int] = None
+    amt_paid_sat: Optional[int] = None
+    amt_paid_msat: Optional[int] = None
+    htlcs: Optional[List[Htlc]] = field(default_factory=list)
+    features: Optional[list] = field(default_factory=list)
+    is_keysend: Optional[bool] = None
+    payment_addr: Optional[str] = None
+    is_amp: Optional[bool] = None
+    is_blinded: Optional[bool] = None
+
+    @classmethod
+    def from_json(cls, data: dict) -> "Invoice":
+        return cls(
+            memo=data["memo"],
+            r_preimage=data["r_preimage"],
+            r_hash=data["r_hash"],
+            value=data["value"],
+            settled=data["settled"],
+            creation_date=data["creation_date"],
+            payment_request=data["payment_request"],
+            expiry=data["expiry"],
+            cltv_expiry=data["cltv_expiry"],
+            state=data["state"],
+            value_msat=data.get("value_msat"),
+            settle_date=data.get("settle_date"),
+            description_hash=data.get("description_hash"),
+            fallback_addr=data.get("fallback_addr"),
+            route_hints=[RouteHint.from_json(rh) for rh in data.get("route_hints", [])],
+            private=data.get("private"),
+            add_index=data.get("add_index"),
+            settle_index=data.get("settle_index"),
+            amt_paid=data.get("amt_paid"),
+            amt_paid_sat=data.get("amt_paid_sat"),
+            amt_paid_msat=data.get("amt_paid_msat"),
+            htlcs=[Htlc.from_json(htlc) for htlc in data.get("htlcs", [])],
+            features=[feat for feat in data.get("features", [])],
+            is_keysend=data.get("is_keysend"),
+            payment_addr=data.get("payment_addr"),
+            is_amp=data.get("is_amp"),
+            is_blinded=data.get("is_blinded"),
+        )
+
+    def to_json(self) -> dict:
+        return {
+            "memo": self.memo,
+            "r_preimage": self.r_preimage,
+            "r_hash": self.r_hash,
+            "value": self.value,
+            "settled": self.settled,
+            "creation_date": self.creation_date,
+            "payment_request": self.payment_request,
+            "expiry": self.expiry,
+            "cltv_expiry": self.cltv_expiry,
+            "state": self.state,
+            "value_msat": self.value_msat,
+            "settle_date": self.settle_date,
+            "description_hash": self.description_hash,
+            "fallback_addr": self.fallback_addr,
+            "route_hints": [rh.to_json() for rh in self.route_hints],
+            "private": self.private,
+            "add_index": self.add_index,
+            "settle_index": self.settle_index,
+            "amt_paid": self.amt_paid,
+            "amt_paid_sat": self.amt_paid_sat,
+            "amt_paid_msat": self.amt_paid_msat,
+            "htlcs": [htlc.to_json() for htlc in self.htlcs],
+            "features": [feature for feature in self.features],
+            "is_keysend": self.is_keysend,
+            "payment_addr": self.payment_addr,
+            "is_amp": self.is_amp,
+            "is_blinded": self.is_blinded,
+        }
@@ -0,0 +1,39 @@
+from dataclasses import fields
+from operator import attrgetter
+from typing import Callable, Dict, FrozenSet, Tuple
+
+# Per-class field names and getter, computed once on first use
+_schemas: Dict[type, Tuple[Tuple[str, ...], FrozenSet[str], Callable]] = {}
+
+
+def _schema(cls):
+    schema = _schemas.get(cls)
+    if schema is None:
+        names = tuple(f.name for f in fields(cls))
+        getter = attrgetter(*names)
+        if len(names) == 1:
+            single = getter
+            getter = lambda obj: (single(obj),)
+        schema = (names, frozenset(names), getter)
+        _schemas[cls] = schema
+    return schema
+
+
+def decode_flat(cls, data: dict):
+    """
+    Build a flat dataclass from a JSON dictionary.
+
+    Fields LND adds in newer versions are ignored instead of failing the
+    whole record.
+    """
+    try:
+        return cls(**data)
+    except TypeError:
+        _, known, _ = _schema(cls)
+        return cls(**{key: value for key, value in data.items() if key in known})
+
+
+def encode_flat(obj) -> dict:
+    """Convert a flat dataclass to a dictionary without deep-copying it like asdict."""
+    names, _, getter = _schema(type(obj))
+    return dict(zip(names, getter(obj)))
@@ -1,9 +1,10 @@
-from dataclasses import dataclass, field, asdict
+from dataclasses import dataclass, field
 from typing import List, Optional
-import json
 
+from data_classes.codec import decode_flat, encode_flat
 
-@dataclass
+
+@dataclass(slots=True)
 class HopHint:
     node_id: str
     chan_id: str
@@ -13,13 +14,13 @@ class HopHint:
 
     @classmethod
     def from_json(cls, data: dict) -> "HopHint":
-        return cls(**data)
+        return decode_flat(cls, data)
 
     def to_json(self) -> dict:
-        return asdict(self)
+        return encode_flat(self)
 
 
-@dataclass
+@dataclass(slots=True)
 class RouteHint:
     hop_hints: List[HopHint] = field(default_factory=list)
 
@@ -31,17 +32,17 @@ class RouteHint:
     def to_json(self) -> dict:
         return {"hop_hints": [hh.to_json() for hh in self.hop_hints]}
 
-@dataclass
+@dataclass(slots=True)
 class CustomRecordsEntry:
     key: int
     value: bytes
     @classmethod
     def from_json(cls, data: dict) -> "CustomRecordsEntry":
-        return cls(**data)
+        return decode_flat(cls, data)
     def to_json(self) -> dict:
-        return asdict(self)
+        return encode_flat(self)
     
-@dataclass
+@dataclass(slots=True)
 class AMP:
     root_share: str
     set_id: str
@@ -51,12 +52,12 @@ class AMP:
 
     @classmethod
     def from_json(cls, data: dict) -> "AMP":
-        return cls(**data)
+        return decode_flat(cls, data)
     
     def to_json(self) -> dict:
-        return asdict(self)
+        return encode_flat(self)
     
-@dataclass
+@dataclass(slots=True)
 class Htlc:
     chan_id: Optional[str] = None
     amt_msat: Optional[int] = None
@@ -74,38 +75,38 @@ class Htlc:
 
     @classmethod
     def from_json(cls, data: dict) -> "Htlc":
-        return cls(**data)
+        return decode_flat(cls, data)
 
     def to_json(self) -> dict:
-        return asdict(self)
+        return encode_flat(self)
 
 
-@dataclass
+@dataclass(slots=True)
 class Feature:
     key: str
     value: bool
 
     @classmethod
     def from_json(cls, data: dict) -> "Feature":
-        return cls(**data)
+        return decode_flat(cls, data)
 
     def to_json(self) -> dict:
-        return asdict(self)
+        return encode_flat(self)
 
 
-@dataclass
+@dataclass(slots=True)
 class AmpInvoiceState:
     state: str
     timestamp: str
 
     @classmethod
     def from_json(cls, data: dict) -> "AmpInvoiceState":
-        return cls(**data)
+        return decode_flat(cls, data)
 
     def to_json(self) -> dict:
-        return asdict(self)
+        return encode_flat(self)
 
-@dataclass
+@dataclass(slots=True)
 class AmpInvoiceStateEntry:
     key: str
     value: AmpInvoiceState
@@ -115,8 +116,8 @@ class AmpInvoiceStateEntry:
      return cls(key=data['key'],value=AmpInvoiceState.from_json(data=data['value']))
     
     def to_json(self) -> dict:
-     return asdict(self)
-@dataclass
+     return {"key": self.key, "value": self.value.to_json()}
+@dataclass(slots=True)
 class BlindedPathConfig:
     min_num_real_hops: int
     num_hops: int
@@ -125,13 +126,13 @@ class BlindedPathConfig:
 
     @classmethod
     def from_json(cls, data: dict) -> "BlindedPathConfig":
-        return cls(**data)
+        return decode_flat(cls, data)
 
     def to_json(self) -> dict:
-        return asdict(self)
+        return encode_flat(self)
 
 
-@dataclass
+@dataclass(slots=True)
 class Invoice:
     memo: str
     r_preimage: str
@@ -1,11 +1,13 @@
-from dataclasses import asdict, dataclass, field
-from typing import List, Dict, Optional
+from dataclasses import dataclass, field
+from typing import List, Optional
 
+from data_classes.codec import decode_flat, encode_flat
 
 
 
 
-@dataclass
+
+@dataclass(slots=True)
 class OutputDetail:
     output_type: str  # OutputScriptType, represented as string
     address: str
@@ -17,15 +19,15 @@ class OutputDetail:
     @classmethod
     def from_json(cls, data: dict) -> "OutputDetail":
         """Create an OutputDetail instance from a JSON dictionary."""
-        return cls(**data)
+        return decode_flat(cls, data)
 
     def to_json(self) -> dict:
         """Convert an OutputDetail instance to a JSON-compatible dictionary."""
-        return asdict(self)
+        return encode_flat(self)
 
 
 # PreviousOutPoint class
-@dataclass
+@dataclass(slots=True)
 class PreviousOutPoint:
     outpoint: str
     is_our_output: bool
@@ -33,15 +35,15 @@ class PreviousOutPoint:
     @classmethod
     def from_json(cls, data: dict) -> "PreviousOutPoint":
         """Create a PreviousOutPoint instance from a JSON dictionary."""
-        return cls(**data)
+        return decode_flat(cls, data)
 
     def to_json(self) -> dict:
         """Convert a PreviousOutPoint instance to a JSON-compatible dictionary."""
-        return asdict(self)
+        return encode_flat(self)
 
 
 # Transaction class
-@dataclass
+@dataclass(slots=True)
 class Transaction:
     tx_hash: str
     amount: int
@@ -1,302 +1,439 @@
-import asyncio
-from concurrent.futures import ThreadPoolExecutor
-from fastapi import FastAPI
-
-from data_classes.invoice import Invoice
-from data_classes.transaction import Transaction
-
-app = FastAPI()
-
-import codecs
-import json
-import requests
-import firebase_admin
-from firebase_admin import credentials
-from firebase_admin import firestore
-from dataclasses import asdict, dataclass, field
-from typing import List, Optional
+import logging
 import os
-import time
-# Use a service account.
-cred = credentials.Certificate("./private_files/firebase_privatekey.json")
-
-firebase_app = firebase_admin.initialize_app(cred)
-
-db = firestore.client()
-
-# LND connection constants
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Callable, List, Optional
+
+from fastapi import Depends, FastAPI, Header, HTTPException, Path, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from services.activity import ActivityCache, ActivityQuery, ActivityReader
+from services.address_index import AddressIndex
+from services.aggregates import Aggregator
+from services.chain import BlockHeightIndex, ChainTracker
+from services.auth import InvalidToken, bearer_token, verify_firebase_token
+from services.checkpoints import CheckpointStore
+from services.fingerprints import FingerprintCache
+from services.ingestion import BTC_ADDRESSES_COLLECTION, INVOICES_SUBCOLLECTION, TRANSACTIONS_SUBCOLLECTION, Ingestor
+from services.journal import EventJournal
+from services.leadership import FileLease, FirestoreLease
+from services.ledger import LedgerWriter, pyarrow_modules
+from services.lnd_node import DEFAULT_NODE_NAME, LndNode, LndNodeConfig, NodeSettings, load_node_configs
+from services.logs import configure_logging
+from services import metrics
+from services.notifications import NotificationHub, NotificationLog, event_stream
+from services.projection import DEFAULT_PROJECTIONS, BlobStore
+from services.firestore_writer import BatchWriter
+from services.runtime import Runtime
+
+# Per-event hot-path logs are debug level and sampled at LOG_SAMPLE_RATE
+LOG_LEVEL = 'INFO'
+LOG_SAMPLE_RATE = 0.01
+logger = logging.getLogger(__name__)
+
+# Firebase service account, only read once the app starts
+FIREBASE_CREDENTIALS_PATH = "./private_files/firebase_privatekey.json"
+
+# LND connection constants, used when LND_NODES_PATH does not exist
 REST_HOST = "https://mybitnet.com:8443"
-
-# Firestore collection constants
-BTC_ADDRESSES_COLLECTION = "bitcoin_addresses"
-BACKEND_COLLECTION = "backend"
-TRANSACTIONS_SUBCOLLECTION = "transactions"
-INVOICES_SUBCOLLECTION = "invoices"
-executor = ThreadPoolExecutor(max_workers=2)  # Allows running two tasks in separate threads
-
-@app.on_event("startup")
-async def on_startup():
-    loop = asyncio.get_event_loop()
-
-    # Run the streams in separate threads
-    loop.run_in_executor(executor, subscribe_invoices_sync)
-    loop.run_in_executor(executor, subscribe_transactions_sync)
-
-    # Run the other tasks asynchronously in the main event loop
-    post_transactions(get_transactions())
-    post_invoices(get_invoices())
-def get_transactions(block_height_start=None) -> List[Transaction]:
-    url = f"{REST_HOST}/v1/transactions"
-    macaroon_path = './private_files/lnd_admin.macaroon'
-    # Confirm the macaroon file exists
-    if not os.path.exists(macaroon_path):
-        raise FileNotFoundError(f"Macaroon file not found at {macaroon_path}")
-
-    # Read the macaroon file
-    with open(macaroon_path, 'rb') as f:
-        macaroon = codecs.encode(f.read(), 'hex').decode()
-
-
-    headers = {"Grpc-Metadata-macaroon": macaroon}
-    r = None
-    if block_height_start:
-       r = requests.get(url, headers=headers, data=json.dumps({'start_height': block_height_start, 'max_transactions': 0}))
-    else:
-       r = requests.get(url, headers=headers, verify=False)
-    data = r.json()
-    print("Retrieved transactions json")
-    transactions_list: list = data['transactions']
-    
-    transactions: List[Transaction] = [Transaction.from_json(tx) for tx in transactions_list]
-    return transactions
-
-    
-    
-def post_transactions(transactions: List[Transaction]):
- for transaction in transactions:
-  post_transaction(transaction=transaction)
-        
-def post_transaction(transaction: Transaction):
- print(f'searching for transaction owner of: {transaction.tx_hash}')
- for output_detail in transaction.output_details:
-  if output_detail.is_our_address:
-   print(f'checking address : {output_detail.address}')
-   query = db.collection(BTC_ADDRESSES_COLLECTION).where('addresses', 'array_contains', output_detail.address)
-   results = list(query.stream())
-   if results:
-    user_id = results[0].id
-    doc = db.collection(BACKEND_COLLECTION).document(user_id).get()
-    if not doc.exists:
-     db.collection(BACKEND_COLLECTION).document(user_id).create({})
-    tx_doc = db.collection(BACKEND_COLLECTION).document(user_id).collection(TRANSACTIONS_SUBCOLLECTION).document(transaction.tx_hash).get()
-    if not tx_doc.exists:
-     db.collection(BACKEND_COLLECTION).document(user_id).collection(TRANSACTIONS_SUBCOLLECTION).document(transaction.tx_hash).set(transaction.to_json())
-    else:
-     db.collection(BACKEND_COLLECTION).document(user_id).collection(TRANSACTIONS_SUBCOLLECTION).document(transaction.tx_hash).update(transaction.to_json())
-
-def post_recent_transactions():
-   macaroon_path = './private_files/lnd_admin.macaroon'
- # Confirm the macaroon file exists
-   if not os.path.exists(macaroon_path):
-    raise FileNotFoundError(f"Macaroon file not found at {macaroon_path}")
-
-    # Read the macaroon file
-   with open(macaroon_path, 'rb') as f:
-    macaroon = codecs.encode(f.read(), 'hex').decode()
-
-
-   headers = {"Grpc-Metadata-macaroon": macaroon}
-
-   r = requests.get(f'{REST_HOST}/v1/getinfo', headers=headers, verify=False)
-   block_height: int = r.json()['block_height']
-   new_block_height = block_height - 12
-   post_transactions(get_transactions(block_height_start=new_block_height))
-async def subscribe_transactions():
- url = f"{REST_HOST}/v1/transactions/subscribe"
- macaroon_path = './private_files/lnd_admin.macaroon'
- # Confirm the macaroon file exists
- if not os.path.exists(macaroon_path):
-  raise FileNotFoundError(f"Macaroon file not found at {macaroon_path}")
-
-    # Read the macaroon file
- with open(macaroon_path, 'rb') as f:
-  macaroon = codecs.encode(f.read(), 'hex').decode()
-
-
- headers = {"Grpc-Metadata-macaroon": macaroon}
- print('attempting to start transactions stream...')
- attempts = 0
- retries = 3
- while attempts < retries:
-  try:
-   with requests.get(url, headers=headers, stream=True, verify=False) as resp:
-    print('transaction stream began')
-    for raw_response in resp.iter_lines():
-     print('transaction stream new data')
-     json_response = json.loads(raw_response)
-     transaction = Transaction.from_json(json_response)
-     post_transaction(transaction=transaction)
-  except requests.ConnectionError:
-     print("transactions stream stopped, retrying...")
-     attempts+= 1
-     time.sleep(2 ** attempts)
-     post_recent_transactions()
-
-  except requests.Timeout:
-     print('transactions stream stopped: timeout, retrying...')
-     attempts+=1
-     time.sleep(2 ** attempts)
-     post_recent_transactions()
-  except Exception as e:
-     print(f'transaction stream stopped: unexcepted error {e}, retrying...')
-     attempts+=1
-     time.sleep(2**attempts)
-     post_recent_transactions()
-
-
-
-
-
-
-
-
-#INVOICES
-def calculate_unix_timestamp(hours_ago: int) -> int:
+MACAROON_PATH = './private_files/lnd_admin.macaroon'
+TLS_CERT_PATH = './private_files/tls.cert'
+# JSON list of {"name", "rest_host", "macaroon_path", "tls_cert_path"} objects, one per LND node
+LND_NODES_PATH = './private_files/lnd_nodes.json'
+LND_TIMEOUT = 30  # seconds
+LND_CONNECT_TIMEOUT = 10  # seconds
+LND_MAX_CONNECTIONS = 20  # per node
+
+# Paging of historical records. Transactions are paged by block height ranges.
+INVOICE_PAGE_SIZE = 100
+TRANSACTION_PAGE_BLOCKS = 5000
+TRANSACTIONS_FIRST_BLOCK = 1
+
+# Local address -> user_id index, kept current by a snapshot listener
+ADDRESS_INDEX_READY_TIMEOUT = 30
+
+# Upserts are merged into WriteBatch commits of up to WRITE_BATCH_SIZE documents
+WRITE_BATCH_SIZE = 500
+WRITE_FLUSH_INTERVAL = 1.0  # seconds
+
+# Fingerprints of the last written documents, used to skip no-op updates.
+# Set FINGERPRINT_DB_PATH to keep them across restarts.
+FINGERPRINT_CACHE_SIZE = 100000
+FINGERPRINT_DB_PATH = None
+
+# Sync checkpoints are persisted once the writes they cover have been committed.
+# Each node keeps its own checkpoints in this store.
+CHECKPOINT_DB_PATH = './state/checkpoints.db'
+# Transactions are re-fetched from a few blocks below the checkpoint in case of reorgs
+REORG_SAFETY_BLOCKS = 6
+
+# Stream events are journaled here before they are handled and kept until
+# their Firestore writes are committed, so they survive Firestore outages
+# and restarts. Failed events are retried with a backoff doubling from
+# JOURNAL_RETRY_DELAY up to JOURNAL_MAX_RETRY_DELAY.
+JOURNAL_DB_PATH = './state/journal.db'
+JOURNAL_READ_BATCH = 500
+JOURNAL_RETRY_DELAY = 1.0  # seconds
+JOURNAL_MAX_RETRY_DELAY = 60.0  # seconds
+JOURNAL_COMPACT_INTERVAL = 60.0  # seconds
+
+# The LND streams are reopened after any failure, immediately after a healthy
+# session and otherwise with a jittered backoff up to STREAM_MAX_RETRY_DELAY.
+# A stream that reads nothing for STREAM_IDLE_TIMEOUT is reopened as well,
+# which is how half-open connections are noticed. See GET /streams/status.
+STREAM_RETRY_DELAY = 1.0  # seconds
+STREAM_MAX_RETRY_DELAY = 60.0  # seconds
+STREAM_IDLE_TIMEOUT = 300.0  # seconds
+STREAM_STABLE_AFTER = 30.0  # seconds
+
+# Synchronous Firestore and catch-up work of every node is pushed onto this
+# bounded executor so it never blocks the event loop the LND streams run on
+PERSISTENCE_WORKERS = 8
+
+# Stream readers hand events to bounded per-stream pipelines drained by
+# STREAM_WORKERS persistence workers, keeping per-key ordering
+STREAM_WORKERS = 4
+STREAM_QUEUE_SIZE = 10000
+STREAM_HIGH_WATERMARK = 8000
+PIPELINE_DRAIN_TIMEOUT = 30  # seconds
+
+# Repeated updates of the same transaction or invoice within the window are
+# coalesced into one write of the latest state. A window of 0 disables it.
+TRANSACTION_COALESCE_WINDOW = 2.0  # seconds
+INVOICE_COALESCE_WINDOW = 0.5  # seconds
+
+# Startup backfill runs in the background, see GET /backfill/status
+BACKFILL_CONCURRENCY = 4
+BACKFILL_QUEUE_SIZE = 1000
+
+# Recent transactions and invoices written by this worker are cached per
+# user to answer GET /users/{user_id}/transactions and /invoices
+ACTIVITY_CACHE_MAX_RECORDS = 100000
+ACTIVITY_CACHE_MAX_RECORDS_PER_USER = 200  # per collection
+ACTIVITY_PAGE_SIZE = 50
+ACTIVITY_MAX_PAGE_SIZE = 200
+
+# Per-user balance and activity totals, see services/aggregates.py.
+# The contribution of every record is kept here so replays are no-ops.
+AGGREGATES_DB_PATH = './state/aggregates.db'
+# Custom claim of the Firebase ID tokens allowed to run POST /aggregates/reconcile
+ADMIN_CLAIM = 'admin'
+
+# Written records are also appended to a Parquet ledger for reporting, see
+# services/ledger.py and services/reporting.py. Needs pyarrow, None disables it.
+LEDGER_PATH = None  # e.g. './state/ledger'
+LEDGER_FLUSH_ROWS = 50000
+LEDGER_FLUSH_INTERVAL = 60  # seconds
+
+# Bulky fields (raw_tx_hex, dest_addresses, HTLCs, route hints, payment requests) are moved
+# out of user documents into compressed blobs/{digest} documents, read on
+# demand by their owners through GET /users/{user_id}/blobs/{digest}. Blobs no
+# document references anymore are deleted every BLOB_COLLECT_INTERVAL seconds
+# (None disables it) once older than BLOB_MIN_AGE. See services/projection.py.
+DOCUMENT_PROJECTIONS = True
+BLOB_CACHE_SIZE = 10000
+BLOB_COLLECT_INTERVAL = 24 * 3600  # seconds
+BLOB_MIN_AGE = 3600  # seconds
+
+# Transaction documents store block_height, block_hash and a confirmation_state
+# (unconfirmed, confirmed, final) instead of num_confirmations, which clients
+# derive from the chain/tip document as tip - block_height + 1. The tip is polled
+# every CHAIN_TIP_POLL_INTERVAL seconds and written once per block. See services/chain.py.
+DERIVED_CONFIRMATIONS = True
+CHAIN_INDEX_DB_PATH = './state/chain.db'
+FINAL_CONFIRMATIONS = 6
+CHAIN_TIP_POLL_INTERVAL = 10  # seconds
+
+# Settled invoices and deposits are pushed to clients of GET /users/{user_id}/events
+# as server-sent events. Clients more than NOTIFICATION_BUFFER_SIZE events behind
+# are disconnected and resume with Last-Event-ID from the last
+# NOTIFICATION_HISTORY_SIZE events kept per user.
+NOTIFICATION_BUFFER_SIZE = 256
+NOTIFICATION_HISTORY_SIZE = 100
+NOTIFICATION_HISTORY_USERS = 10000
+NOTIFICATION_MAX_SUBSCRIBERS = 10000
+NOTIFICATION_KEEPALIVE = 15  # seconds
+# Every event of a record is published once, remembered here across restarts.
+# Events older than NOTIFICATION_MAX_EVENT_AGE (a backfill of history) are not published.
+NOTIFICATION_LOG_DB_PATH = './state/notifications.db'
+NOTIFICATION_MAX_EVENT_AGE = 3600  # seconds
+
+# With several workers only the holder of the stream lease ingests, the
+# others serve HTTP. 'file' coordinates the workers of one host through a
+# lock file, 'firestore' coordinates hosts through a lease document, None
+# makes every worker ingest. See GET /leader/status.
+STREAM_LEASE = 'file'
+STREAM_LEASE_PATH = './state/stream.lock'
+STREAM_LEASE_DOCUMENT = 'leases/lnd_streams'
+STREAM_LEASE_TTL = 15  # seconds, Firestore lease only
+STREAM_LEASE_RENEW_INTERVAL = 5  # seconds
+STREAM_LEASE_RETRY_INTERVAL = 1  # seconds
+
+def node_settings() -> NodeSettings:
+    return NodeSettings(
+        timeout=LND_TIMEOUT,
+        connect_timeout=LND_CONNECT_TIMEOUT,
+        max_connections=LND_MAX_CONNECTIONS,
+        invoice_page_size=INVOICE_PAGE_SIZE,
+        transaction_page_blocks=TRANSACTION_PAGE_BLOCKS,
+        transactions_first_block=TRANSACTIONS_FIRST_BLOCK,
+        reorg_safety_blocks=REORG_SAFETY_BLOCKS,
+        stream_workers=STREAM_WORKERS,
+        stream_queue_size=STREAM_QUEUE_SIZE,
+        stream_high_watermark=STREAM_HIGH_WATERMARK,
+        pipeline_drain_timeout=PIPELINE_DRAIN_TIMEOUT,
+        transaction_coalesce_window=TRANSACTION_COALESCE_WINDOW,
+        invoice_coalesce_window=INVOICE_COALESCE_WINDOW,
+        backfill_concurrency=BACKFILL_CONCURRENCY,
+        backfill_queue_size=BACKFILL_QUEUE_SIZE,
+        journal_read_batch=JOURNAL_READ_BATCH,
+        journal_retry_delay=JOURNAL_RETRY_DELAY,
+        journal_max_retry_delay=JOURNAL_MAX_RETRY_DELAY,
+        stream_retry_delay=STREAM_RETRY_DELAY,
+        stream_max_retry_delay=STREAM_MAX_RETRY_DELAY,
+        stream_idle_timeout=STREAM_IDLE_TIMEOUT,
+        stream_stable_after=STREAM_STABLE_AFTER,
+    )
+
+def node_configs() -> List[LndNodeConfig]:
+    if os.path.exists(LND_NODES_PATH):
+        return load_node_configs(LND_NODES_PATH)
+    return [LndNodeConfig(DEFAULT_NODE_NAME, REST_HOST, MACAROON_PATH, TLS_CERT_PATH)]
+
+def firestore_client():
+    """Initialize the Firebase app on first use and return a Firestore client."""
+    # The Firebase SDK is slow to import, so it is only loaded when a client is needed
+    import firebase_admin
+    from firebase_admin import credentials, firestore
+
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        # Use a service account.
+        firebase_admin.initialize_app(credentials.Certificate(FIREBASE_CREDENTIALS_PATH))
+    return firestore.client()
+
+def stream_lease(db):
+    if STREAM_LEASE == 'file':
+        return FileLease(STREAM_LEASE_PATH)
+    if STREAM_LEASE == 'firestore':
+        return FirestoreLease(db, STREAM_LEASE_DOCUMENT, ttl=STREAM_LEASE_TTL)
+    if STREAM_LEASE is None:
+        return None
+    raise ValueError(f"Unknown STREAM_LEASE {STREAM_LEASE!r}")
+
+def build_runtime(db, configs: List[LndNodeConfig]) -> Runtime:
+    address_index = AddressIndex(db, BTC_ADDRESSES_COLLECTION)
+    fingerprints = FingerprintCache(max_entries=FINGERPRINT_CACHE_SIZE, path=FINGERPRINT_DB_PATH)
+
+    def write_failed(path: str, error):
+        fingerprints.forget(path)
+        blobs.forget(path)
+        if chain is not None:
+            chain.forget(path)
+
+    writer = BatchWriter(db, batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL,
+                         on_failure=write_failed, on_commit=fingerprints.committed)
+    blobs = BlobStore(db, writer, max_cached=BLOB_CACHE_SIZE)
+    activity_cache = ActivityCache(max_records=ACTIVITY_CACHE_MAX_RECORDS,
+                                   max_records_per_user=ACTIVITY_CACHE_MAX_RECORDS_PER_USER)
+    chain = None
+    if DERIVED_CONFIRMATIONS:
+        chain = ChainTracker(db, writer, fingerprints, BlockHeightIndex(CHAIN_INDEX_DB_PATH), cache=activity_cache,
+                             final_confirmations=FINAL_CONFIRMATIONS, reorg_depth=REORG_SAFETY_BLOCKS)
+    checkpoints = CheckpointStore(CHECKPOINT_DB_PATH)
+    journal = EventJournal(JOURNAL_DB_PATH, compact_interval=JOURNAL_COMPACT_INTERVAL)
+
+    def commit_checkpoints(ok: bool):
+        if ok:
+            checkpoints.commit_staged()
+            journal.commit_staged()
+        else:
+            checkpoints.discard_staged()
+            fingerprints.discard_unsaved()
+            journal.rewind()
+
+    writer.add_drain_listener(commit_checkpoints)
+    executor = ThreadPoolExecutor(max_workers=PERSISTENCE_WORKERS, thread_name_prefix='persistence')
+    aggregator = Aggregator(db, writer, address_index, path=AGGREGATES_DB_PATH)
+    ledger = None
+    if LEDGER_PATH:
+        # Fail at startup rather than with the first flush
+        pyarrow_modules()
+        ledger = LedgerWriter(LEDGER_PATH, address_index, flush_rows=LEDGER_FLUSH_ROWS,
+                              flush_interval=LEDGER_FLUSH_INTERVAL)
+    notifications = NotificationHub(buffer_size=NOTIFICATION_BUFFER_SIZE, history_size=NOTIFICATION_HISTORY_SIZE,
+                                    max_history_users=NOTIFICATION_HISTORY_USERS,
+                                    max_subscribers=NOTIFICATION_MAX_SUBSCRIBERS,
+                                    log=NotificationLog(NOTIFICATION_LOG_DB_PATH),
+                                    max_event_age=NOTIFICATION_MAX_EVENT_AGE)
+    # Owner lookup and Firestore writes are shared by every node
+    ingestor = Ingestor(db, address_index, writer, fingerprints, cache=activity_cache, aggregates=aggregator,
+                        ledger=ledger, notifications=notifications,
+                        projections=DEFAULT_PROJECTIONS if DOCUMENT_PROJECTIONS else None, blobs=blobs,
+                        chain=chain)
+    settings = node_settings()
+    nodes = [LndNode(config, settings, ingestor, checkpoints, executor, journal) for config in configs]
+    return Runtime(db, address_index, writer, fingerprints, checkpoints, executor, ingestor, nodes,
+                   activity_cache, ActivityReader(db, activity_cache, chain=chain), aggregator=aggregator, journal=journal,
+                   ledger=ledger, notifications=notifications, chain=chain, chain_poll_interval=CHAIN_TIP_POLL_INTERVAL,
+                   blob_collect_interval=BLOB_COLLECT_INTERVAL, blob_min_age=BLOB_MIN_AGE,
+                   address_index_ready_timeout=ADDRESS_INDEX_READY_TIMEOUT, lease=stream_lease(db),
+                   lease_renew_interval=STREAM_LEASE_RENEW_INTERVAL,
+                   lease_retry_interval=STREAM_LEASE_RETRY_INTERVAL)
+
+def get_runtime(request: Request) -> Runtime:
+    return request.app.state.runtime
+
+def activity_response(runtime: Runtime, request: Request, user_id: str, collection: str,
+                      query: ActivityQuery) -> Response:
+    try:
+        page = runtime.activity.read(user_id, collection, query)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    headers = {"ETag": page.etag, "Cache-Control": "private, no-cache"}
+    if page.matches(request.headers.get("if-none-match")):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(page.to_json(), headers=headers)
+
+def create_app(db_factory: Callable = firestore_client,
+               node_configs_factory: Callable[[], List[LndNodeConfig]] = node_configs,
+               configure_logs: bool = True,
+               verify_token: Callable[[str], dict] = verify_firebase_token) -> FastAPI:
     """
-    Calculates the Unix timestamp for 'now - x_hours'.
-    
-    Args:
-        hours_ago (int): The number of hours to subtract from the current time.
+    Create the application. The Firestore client, LND clients and everything
+    built on them are created by the lifespan handler when the app starts,
+    so creating (and importing) the app needs no credentials.
 
-    Returns:
-        int: Unix timestamp in seconds.
+    Per-user routes need an `Authorization: Bearer` token whose claims
+    `verify_token` returns with the user's id in `uid`. Maintenance routes
+    need a token with the ADMIN_CLAIM custom claim set to true.
     """
-    current_time = time.time()  # Current time in seconds since the Unix epoch
-    timestamp = int(current_time - (hours_ago * 3600))  # Subtract 'x' hours (3600 seconds per hour)
-    return timestamp
-
-
-
-def get_invoices(creation_date_start=None) -> List[Invoice]:
-    url = f"{REST_HOST}/v1/invoices"
-    macaroon_path = './private_files/lnd_admin.macaroon'
-    
-    # Confirm the macaroon file exists
-    if not os.path.exists(macaroon_path):
-        raise FileNotFoundError(f"Macaroon file not found at {macaroon_path}")
-
-    # Read the macaroon file
-    with open(macaroon_path, 'rb') as f:
-        macaroon = codecs.encode(f.read(), 'hex').decode()
-
-    headers = {"Grpc-Metadata-macaroon": macaroon}
+    if configure_logs:
+        configure_logging(LOG_LEVEL, LOG_SAMPLE_RATE)
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        runtime = build_runtime(db_factory(), node_configs_factory())
+        app.state.runtime = runtime
+        await runtime.start()
+        try:
+            yield
+        finally:
+            await runtime.stop()
+
+    app = FastAPI(lifespan=lifespan)
+
+    def caller_claims(authorization: Optional[str] = Header(None)) -> dict:
+        token = bearer_token(authorization)
+        if token is None:
+            raise HTTPException(status_code=401, detail="Missing bearer token", headers={"WWW-Authenticate": "Bearer"})
+        try:
+            return verify_token(token)
+        except InvalidToken:
+            raise HTTPException(status_code=401, detail="Invalid token",
+                                headers={"WWW-Authenticate": 'Bearer error="invalid_token"'})
+
+    def owned_user_id(user_id: str, claims: dict = Depends(caller_claims)) -> str:
+        """The `user_id` of the path, if it is the caller's."""
+        if claims.get("uid") != user_id:
+            raise HTTPException(status_code=403, detail="Not your account")
+        return user_id
+
+    def admin(claims: dict = Depends(caller_claims)):
+        if claims.get(ADMIN_CLAIM) is not True:
+            raise HTTPException(status_code=403, detail="Admins only")
+
+    @app.get("/metrics")
+    def prometheus_metrics():
+        payload, content_type = metrics.render()
+        return Response(content=payload, media_type=content_type)
+
+    @app.get("/users/{user_id}/transactions")
+    def user_transactions(request: Request, user_id: str = Depends(owned_user_id),
+                          limit: int = Query(ACTIVITY_PAGE_SIZE, ge=1, le=ACTIVITY_MAX_PAGE_SIZE),
+                          cursor: Optional[str] = None, start_time: Optional[int] = None,
+                          end_time: Optional[int] = None, runtime: Runtime = Depends(get_runtime)):
+        query = ActivityQuery(limit, cursor, start_time, end_time)
+        return activity_response(runtime, request, user_id, TRANSACTIONS_SUBCOLLECTION, query)
+
+    @app.get("/users/{user_id}/invoices")
+    def user_invoices(request: Request, user_id: str = Depends(owned_user_id),
+                      limit: int = Query(ACTIVITY_PAGE_SIZE, ge=1, le=ACTIVITY_MAX_PAGE_SIZE),
+                      cursor: Optional[str] = None, start_time: Optional[int] = None,
+                      end_time: Optional[int] = None, state: Optional[str] = None,
+                      settled: Optional[bool] = None, runtime: Runtime = Depends(get_runtime)):
+        filters = {name: value for name, value in (('state', state), ('settled', settled)) if value is not None}
+        query = ActivityQuery(limit, cursor, start_time, end_time, filters)
+        return activity_response(runtime, request, user_id, INVOICES_SUBCOLLECTION, query)
+
+    @app.get("/users/{user_id}/events")
+    async def user_events(user_id: str = Depends(owned_user_id), last_event_id: Optional[str] = Header(None),
+                          runtime: Runtime = Depends(get_runtime)):
+        hub = runtime.notifications
+        if not hub.enabled:
+            # Only the worker that ingests publishes, the client retries until it reaches it
+            raise HTTPException(status_code=503, detail="This worker does not publish events",
+                                headers={"Retry-After": "1"})
+        try:
+            subscription = hub.subscribe(user_id, last_event_id)
+        except OverflowError as e:
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+        return StreamingResponse(event_stream(hub, subscription, keepalive=NOTIFICATION_KEEPALIVE),
+                                 media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    @app.get("/users/{user_id}/blobs/{digest}")
+    def user_blob(user_id: str = Depends(owned_user_id), digest: str = Path(pattern="^[0-9a-f]{32}$"),
+                  runtime: Runtime = Depends(get_runtime)):
+        blobs = runtime.ingestor.blobs
+        # Blobs are shared between users, only those of the caller's documents are served
+        bulky = blobs.get(digest) if blobs.referenced(digest, user_id) else None
+        if bulky is None:
+            raise HTTPException(status_code=404, detail="Unknown blob")
+        # Content-addressed, never changes
+        return JSONResponse(bulky, headers={"Cache-Control": "private, max-age=31536000, immutable"})
+
+    @app.post("/aggregates/reconcile", status_code=202, dependencies=[Depends(admin)])
+    async def reconcile_aggregates(runtime: Runtime = Depends(get_runtime)):
+        if not runtime.reconcile_aggregates():
+            raise HTTPException(status_code=409, detail="Not ingesting or a reconciliation is already running")
+        return runtime.aggregator.reconcile_progress.to_json()
+
+    @app.get("/aggregates/reconcile/status", dependencies=[Depends(admin)])
+    def reconcile_status(runtime: Runtime = Depends(get_runtime)):
+        return runtime.aggregator.reconcile_progress.to_json()
+
+    @app.get("/leader/status")
+    def leader_status(runtime: Runtime = Depends(get_runtime)):
+        return runtime.leadership_status()
+
+    @app.get("/nodes/status")
+    def nodes_status(runtime: Runtime = Depends(get_runtime)):
+        return {node.name: node.status() for node in runtime.nodes}
+
+    @app.get("/streams/status")
+    def streams_status(runtime: Runtime = Depends(get_runtime)):
+        return {
+            "healthy": bool(runtime.nodes) and all(node.streams_healthy() for node in runtime.nodes),
+            "nodes": {node.name: node.streams_status() for node in runtime.nodes},
+        }
 
-    all_invoices: List[Invoice] = []
-    index_offset = 0  # Start at offset 0
-    num_max_invoices = 100  # Fetch 100 invoices per request (adjust as needed)
-    more_invoices = True
+    @app.get("/pipelines/status")
+    def pipelines_status(runtime: Runtime = Depends(get_runtime)):
+        return {
+            pipeline.name: pipeline.status()
+            for node in runtime.nodes for pipeline in (node.transaction_pipeline, node.invoice_pipeline)
+        }
 
-    while more_invoices:
-        params = {
-            "index_offset": index_offset,
-            "num_max_invoices": num_max_invoices
+    @app.get("/backfill/status")
+    def backfill_status(runtime: Runtime = Depends(get_runtime)):
+        statuses = {node.name: node.backfill_status() for node in runtime.nodes}
+        return {
+            "ready": all(status["ready"] for status in statuses.values()),
+            "nodes": statuses,
         }
 
-        # Add the creation_date_start filter if provided
-        if creation_date_start:
-            params["creation_date_start"] = creation_date_start
-
-        # Fetch invoices with pagination parameters
-        response = requests.get(url, headers=headers, params=params, verify=False)
-        if response.status_code != 200:
-            raise Exception(f"Failed to fetch invoices: {response.status_code} - {response.text}")
-
-        data = response.json()
-
-        # Parse invoices and add to the list
-        invoices_list = data.get('invoices', [])
-        if not invoices_list:
-            break  # Exit if no more invoices are returned
-
-        all_invoices.extend([Invoice.from_json(inv) for inv in invoices_list])
-
-        # Update index_offset for pagination
-        index_offset = data.get('last_index_offset', 0)
-        more_invoices = len(invoices_list) >= num_max_invoices  # Stop if fewer results are returned
-
-    print(f"Total invoices retrieved: {len(all_invoices)}")
-    return all_invoices
-
-
-
-def post_invoice(invoice: Invoice):
- print(f'searching for invoice owner of: {invoice.payment_addr} with fallback_addr: {invoice.fallback_addr}')
- if not invoice.fallback_addr:
-   return
- query = db.collection(BTC_ADDRESSES_COLLECTION).where('addresses', 'array_contains', invoice.fallback_addr)
- results = list(query.stream())
- if results:
-  user_id = results[0].id
-  doc = db.collection(BACKEND_COLLECTION).document(user_id).get()
-  if not doc.exists:
-   db.collection(BACKEND_COLLECTION).document(user_id).create({})
-  inv_doc = db.collection(BACKEND_COLLECTION).document(user_id).collection(INVOICES_SUBCOLLECTION).document(invoice.payment_addr).get()
-  if not inv_doc.exists:
-   db.collection(BACKEND_COLLECTION).document(user_id).collection(INVOICES_SUBCOLLECTION).document(invoice.payment_addr).set(invoice.to_json())
-  else:
-   db.collection(BACKEND_COLLECTION).document(user_id).collection(INVOICES_SUBCOLLECTION).document(invoice.payment_addr).update(invoice.to_json())
-
-
-def post_invoices(invoices: List[Invoice]):
- for invoice in invoices:
-  post_invoice(invoice=invoice)
-
-
-def post_recent_invoices():
-   creation_date_start = calculate_unix_timestamp(12)
-   post_invoices(get_invoices(creation_date_start=creation_date_start))
-
-
-async def subscribe_invoices():
- url = f"{REST_HOST}/v1/invoices/subscribe"
- macaroon_path = './private_files/lnd_admin.macaroon'
- # Confirm the macaroon file exists
- if not os.path.exists(macaroon_path):
-  raise FileNotFoundError(f"Macaroon file not found at {macaroon_path}")
-
-    # Read the macaroon file
- with open(macaroon_path, 'rb') as f:
-  macaroon = codecs.encode(f.read(), 'hex').decode()
-
-
- headers = {"Grpc-Metadata-macaroon": macaroon}
- print('attempting to start invoices stream...')
- attempts = 0
- retries = 3
- while attempts < retries:
-  try:
-   with requests.get(url, headers=headers, stream=True, verify=False) as resp:
-    print('invoice stream began')
-    for raw_response in resp.iter_lines():
-     print('invoice stream new data')
-     json_response = json.loads(raw_response)
-     invoice = Invoice.from_json(json_response['result'])
-     post_invoice(invoice=invoice)
-  except requests.ConnectionError:
-     print("invoice stream stopped, retrying...")
-     attempts+= 1
-     time.sleep(2 ** attempts)
-     post_recent_invoices()
-  except Exception as e:
-     print(f'invoice stream stopped: unexcepted error {e}, retrying...')
-     attempts+=1
-     time.sleep(2**attempts)
-     post_recent_invoices()
-
-
-
-def subscribe_invoices_sync():
-    asyncio.run(subscribe_invoices())  # Blocking call for the thread
-
-def subscribe_transactions_sync():
-    asyncio.run(subscribe_transactions())  # Blocking call for the thread
+    return app
+
+app = create_app()
@@ -0,0 +1,334 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from services.ingestion import BACKEND_COLLECTION, INVOICES_SUBCOLLECTION, TRANSACTIONS_SUBCOLLECTION
+
+
+@dataclass(frozen=True)
+class CollectionSpec:
+    name: str
+    # Field the activity is ordered and range-filtered by, and the type it is stored as
+    time_field: str
+    time_type: type
+    # Fields that can be filtered on by equality
+    filters: Tuple[str, ...] = ()
+
+
+COLLECTIONS = {
+    TRANSACTIONS_SUBCOLLECTION: CollectionSpec(TRANSACTIONS_SUBCOLLECTION, 'time_stamp', int),
+    INVOICES_SUBCOLLECTION: CollectionSpec(INVOICES_SUBCOLLECTION, 'creation_date', int, ('state', 'settled')),
+}
+
+
+@dataclass
+class ActivityQuery:
+    """Newest-first page of a user's records, optionally limited to [start_time, end_time]."""
+    limit: int = 50
+    cursor: Optional[str] = None
+    start_time: Optional[int] = None
+    end_time: Optional[int] = None
+    filters: Dict[str, object] = field(default_factory=dict)
+
+    def is_first_unfiltered_page(self) -> bool:
+        return self.cursor is None and self.start_time is None and self.end_time is None and not self.filters
+
+    def key(self) -> str:
+        return json.dumps([self.limit, self.cursor, self.start_time, self.end_time, sorted(self.filters.items())])
+
+
+# An entity tag of an If-None-Match list, the quoted tag without its weak W/ prefix
+ENTITY_TAG = re.compile(r'(?:W/)?("[^"]*")')
+
+
+@dataclass
+class ActivityPage:
+    items: List[dict]
+    next_cursor: Optional[str]
+    source: str  # cache or firestore
+    etag: str
+
+    def to_json(self) -> dict:
+        return {"items": self.items, "next_cursor": self.next_cursor, "source": self.source}
+
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        """Whether an If-None-Match header lists this page's ETag, compared weakly as RFC 9110 has it."""
+        if if_none_match is None:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        # Entity tags may contain commas, they are matched whole rather than split on them
+        return self.etag.removeprefix("W/") in ENTITY_TAG.findall(if_none_match)
+
+
+def encode_cursor(time_value: int, document_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([time_value, document_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[int, str]:
+    try:
+        time_value, document_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return int(time_value), str(document_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+
+def time_of(spec: CollectionSpec, record: dict) -> int:
+    try:
+        return int(record.get(spec.time_field) or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+class _UserActivity:
+    def __init__(self, covered_from: float):
+        # collection -> {document_id: record}
+        self.records: Dict[str, Dict[str, dict]] = {name: {} for name in COLLECTIONS}
+        # Every record of a collection with a time at or after this is cached
+        self.covered_from: Dict[str, float] = {name: covered_from for name in COLLECTIONS}
+        self.versions: Dict[str, int] = {name: 0 for name in COLLECTIONS}
+
+
+class ActivityCache:
+    """
+    Per-user cache of recently written transactions and invoices, filled by
+    the ingestion path as it writes.
+
+    The cache only answers a page if it provably holds every matching record
+    for it. Once ingestion has started (`reset`) every record with a time at
+    or after that moment passes through `record`. Older records are only
+    known once the newest ones were loaded from Firestore (`load`), or not
+    at all. The coverage window per user and collection is tracked and
+    narrowed when records are evicted. Pages outside it return None and are
+    read from Firestore instead.
+
+    Only the process that ingests can keep the cache current, so it stays
+    disabled until `reset` and is disabled again by `clear`. At most
+    `max_records` records are held, evicting the least recently used users,
+    and at most `max_records_per_user` per user and collection.
+    """
+
+    def __init__(self, max_records: int = 100000, max_records_per_user: int = 200):
+        self.max_records = max_records
+        self.max_records_per_user = max_records_per_user
+        self.enabled = False
+        # Distinguishes this process' ETags from other workers'
+        self._instance = os.urandom(4).hex()
+        self._epoch = 0
+        self._covered_from = float('inf')
+        self._users: "OrderedDict[str, _UserActivity]" = OrderedDict()
+        self._size = 0
+        self._evicted = False
+        # Versions come from one counter so they never repeat for a user that was evicted
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def reset(self, started_at: Optional[float] = None):
+        """Start caching, everything at or after `started_at` will be recorded."""
+        with self._lock:
+            self._users.clear()
+            self._size = 0
+            self._evicted = False
+            self._epoch += 1
+            self._covered_from = started_at if started_at is not None else time.time()
+            self.enabled = True
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._size = 0
+            self._evicted = False
+            self._epoch += 1
+            self.enabled = False
+
+    def record(self, user_id: str, collection: str, document_id: str, data: dict, cleared: Iterable[str] = ()):
+        """Merge a written record into the cache, dropping the `cleared` fields it no longer has."""
+        if not self.enabled or collection not in COLLECTIONS:
+            return
+        with self._lock:
+            user = self._user(user_id)
+            records = user.records[collection]
+            previous = records.get(document_id)
+            if previous is None:
+                records[document_id] = dict(data)
+                self._size += 1
+            else:
+                previous.update(data)
+                for name in cleared:
+                    if name not in data:
+                        previous.pop(name, None)
+            self._clock += 1
+            user.versions[collection] = self._clock
+            self._trim(user, collection)
+            self._evict()
+
+    def load(self, user_id: str, collection: str, records: List[Tuple[str, dict]], complete: bool):
+        """
+        Add the newest records of a user read from Firestore. `complete` means
+        there are no older ones. Records already cached are newer and kept.
+        """
+        if not self.enabled or collection not in COLLECTIONS:
+            return
+        spec = COLLECTIONS[collection]
+        with self._lock:
+            user = self._user(user_id)
+            cached = user.records[collection]
+            for document_id, data in records:
+                if document_id not in cached:
+                    cached[document_id] = dict(data)
+                    self._size += 1
+            if complete:
+                user.covered_from[collection] = float('-inf')
+            elif records:
+                # Records at the oldest loaded time may continue past the page
+                oldest = min(time_of(spec, data) for _, data in records)
+                user.covered_from[collection] = min(user.covered_from[collection], oldest + 1)
+            self._clock += 1
+            user.versions[collection] = self._clock
+            self._trim(user, collection)
+            self._evict()
+
+    def page(self, user_id: str, collection: str, query: ActivityQuery) -> Optional[ActivityPage]:
+        """Answer `query` from the cache, or return None if the cache may be missing records."""
+        if not self.enabled:
+            return None
+        spec = COLLECTIONS[collection]
+        after = decode_cursor(query.cursor) if query.cursor else None
+        with self._lock:
+            user = self._users.get(user_id)
+            covered_from = user.covered_from[collection] if user else self._new_user_covered_from()
+            # Copied, records may be updated while the page is serialized
+            records = [(document_id, dict(data)) for document_id, data in user.records[collection].items()] if user else []
+            version = user.versions[collection] if user else 0
+            if user:
+                self._users.move_to_end(user_id)
+            etag = self.etag(user_id, collection, version, query)
+
+        matches = []
+        for document_id, data in records:
+            time_value = time_of(spec, data)
+            if time_value < covered_from:
+                continue
+            if query.start_time is not None and time_value < query.start_time:
+                continue
+            if query.end_time is not None and time_value > query.end_time:
+                continue
+            if after is not None and (time_value, document_id) >= after:
+                continue
+            if any(data.get(name) != value for name, value in query.filters.items()):
+                continue
+            matches.append((time_value, document_id, data))
+        matches.sort(key=lambda match: (match[0], match[1]), reverse=True)
+
+        # Every missing record is older than the matches, so a full page is always right.
+        # A short page is only the full answer if the whole requested range is covered.
+        covered = covered_from == float('-inf') or (query.start_time is not None and query.start_time >= covered_from)
+        if len(matches) > query.limit or (len(matches) == query.limit and not covered):
+            items = matches[:query.limit]
+            last = items[-1]
+            return ActivityPage([data for _, _, data in items], encode_cursor(last[0], last[1]), 'cache', etag)
+        if covered:
+            return ActivityPage([data for _, _, data in matches], None, 'cache', etag)
+        return None
+
+    def etag(self, user_id: str, collection: str, version: int, query: ActivityQuery) -> str:
+        digest = hashlib.blake2b(f"{user_id}/{collection}/{query.key()}".encode(), digest_size=8).hexdigest()
+        return f'"{self._instance}-{self._epoch}-{version}-{digest}"'
+
+    def _user(self, user_id: str) -> _UserActivity:
+        user = self._users.get(user_id)
+        if user is None:
+            user = self._users[user_id] = _UserActivity(self._new_user_covered_from())
+        self._users.move_to_end(user_id)
+        return user
+
+    def _new_user_covered_from(self) -> float:
+        # An evicted user may come back without the records recorded before, so
+        # once users have been evicted new entries only cover what comes next
+        return time.time() if self._evicted else self._covered_from
+
+    def _trim(self, user: _UserActivity, collection: str):
+        records = user.records[collection]
+        excess = len(records) - self.max_records_per_user
+        if excess <= 0:
+            return
+        spec = COLLECTIONS[collection]
+        oldest = sorted(records.items(), key=lambda item: (time_of(spec, item[1]), item[0]))[:excess]
+        for document_id, data in oldest:
+            del records[document_id]
+            self._size -= 1
+            # Records at the evicted time may be gone, only later ones are complete
+            user.covered_from[collection] = max(user.covered_from[collection], time_of(spec, data) + 1)
+
+    def _evict(self):
+        while self._size > self.max_records and self._users:
+            _, user = self._users.popitem(last=False)
+            self._evicted = True
+            self._size -= sum(len(records) for records in user.records.values())
+
+
+class ActivityReader:
+    """
+    Pages of a user's transactions and invoices, from the cache when it can
+    answer them and from cursor-paginated Firestore queries otherwise.
+
+    The Firestore queries order by the collection's time field and the
+    document id, so queries that also filter on state or settled need the
+    matching composite indexes.
+
+    With a `chain` (services.chain.ChainTracker) transactions are returned
+    with the num_confirmations derived from the chain tip, which is part of
+    their ETag.
+    """
+
+    def __init__(self, db, cache: ActivityCache, chain=None):
+        self._db = db
+        self.cache = cache
+        self.chain = chain
+
+    def read(self, user_id: str, collection: str, query: ActivityQuery) -> ActivityPage:
+        page = self.cache.page(user_id, collection, query)
+        if page is None:
+            items, next_cursor, records = self._query(user_id, collection, query)
+            if query.is_first_unfiltered_page():
+                # The newest records double as a warm-up of the cache for this user
+                self.cache.load(user_id, collection, records, complete=next_cursor is None)
+            body = json.dumps([items, next_cursor], sort_keys=True, default=str).encode()
+            etag = f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"'
+            page = ActivityPage(items, next_cursor, 'firestore', etag)
+        if self.chain is None or collection != TRANSACTIONS_SUBCOLLECTION:
+            return page
+        tip_height = self.chain.tip_height
+        items = [self.chain.with_confirmations(item, tip_height) for item in page.items]
+        return ActivityPage(items, page.next_cursor, page.source, f'{page.etag[:-1]}-{tip_height}"')
+
+    def _query(self, user_id: str, collection: str, query: ActivityQuery):
+        spec = COLLECTIONS[collection]
+        ref = self._db.collection(BACKEND_COLLECTION).document(user_id).collection(collection)
+        firestore_query = ref
+        if query.start_time is not None:
+            firestore_query = firestore_query.where(spec.time_field, '>=', spec.time_type(query.start_time))
+        if query.end_time is not None:
+            firestore_query = firestore_query.where(spec.time_field, '<=', spec.time_type(query.end_time))
+        for name, value in query.filters.items():
+            firestore_query = firestore_query.where(name, '==', value)
+        firestore_query = (firestore_query.order_by(spec.time_field, direction='DESCENDING')
+                           .order_by('__name__', direction='DESCENDING'))
+        if query.cursor:
+            time_value, document_id = decode_cursor(query.cursor)
+            firestore_query = firestore_query.start_after({spec.time_field: spec.time_type(time_value),
+                                                           '__name__': document_id})
+        snapshots = list(firestore_query.limit(query.limit + 1).stream())
+        records = [(snapshot.id, snapshot.to_dict() or {}) for snapshot in snapshots[:query.limit]]
+        next_cursor = None
+        if len(snapshots) > query.limit:
+            document_id, data = records[-1]
+            next_cursor = encode_cursor(time_of(spec, data), document_id)
+        return [data for _, data in records], next_cursor, records
@@ -0,0 +1,98 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Set
+
+
+class AddressIndex:
+    """
+    Local address -> user_id index over the bitcoin_addresses collection.
+
+    The index is built from the initial snapshot of a Firestore listener and
+    kept current from its change events, so resolving an owner is a dict
+    lookup. Until the first snapshot has arrived (or if the listener is never
+    started) lookups fall back to an array_contains query. Addresses nobody
+    owns are remembered in a bounded LRU negative cache.
+    """
+
+    def __init__(self, db, collection: str, negative_cache_size: int = 10000):
+        self._db = db
+        self._collection = collection
+        self._negative_cache_size = negative_cache_size
+        self._owners: Dict[str, str] = {}
+        self._addresses_by_user: Dict[str, Set[str]] = {}
+        self._unowned: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._watch = None
+
+    def start(self):
+        """Start the snapshot listener that builds and maintains the index."""
+        if self._watch is None:
+            self._watch = self._db.collection(self._collection).on_snapshot(self._on_snapshot)
+
+    def stop(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+        self._ready.clear()
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Block until the initial snapshot has been loaded."""
+        return self._ready.wait(timeout)
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def get_owner(self, address: str) -> Optional[str]:
+        """Return the user_id owning `address`, or None if nobody owns it."""
+        with self._lock:
+            user_id = self._owners.get(address)
+            if user_id is not None:
+                return user_id
+            if address in self._unowned:
+                self._unowned.move_to_end(address)
+                return None
+            if self._ready.is_set():
+                self._remember_unowned(address)
+                return None
+
+        # The listener has not delivered its first snapshot yet, ask Firestore directly.
+        query = self._db.collection(self._collection).where('addresses', 'array_contains', address).limit(1)
+        results = list(query.stream())
+        with self._lock:
+            if results:
+                user_id = results[0].id
+                self._owners[address] = user_id
+                self._addresses_by_user.setdefault(user_id, set()).add(address)
+                return user_id
+            self._remember_unowned(address)
+            return None
+
+    def _remember_unowned(self, address: str):
+        self._unowned[address] = None
+        self._unowned.move_to_end(address)
+        while len(self._unowned) > self._negative_cache_size:
+            self._unowned.popitem(last=False)
+
+    def _set_user_addresses(self, user_id: str, addresses):
+        for address in self._addresses_by_user.pop(user_id, set()):
+            if self._owners.get(address) == user_id:
+                del self._owners[address]
+        owned = set(addresses or [])
+        for address in owned:
+            self._owners[address] = user_id
+            self._unowned.pop(address, None)
+        if owned:
+            self._addresses_by_user[user_id] = owned
+
+    def _on_snapshot(self, docs, changes, read_time):
+        with self._lock:
+            for change in changes:
+                user_id = change.document.id
+                if change.type.name == 'REMOVED':
+                    self._set_user_addresses(user_id, [])
+                else:
+                    data = change.document.to_dict() or {}
+                    self._set_user_addresses(user_id, data.get('addresses', []))
+        self._ready.set()
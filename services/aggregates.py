@@ -0,0 +1,278 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Optional
+
+from services.ingestion import BACKEND_COLLECTION, INVOICES_SUBCOLLECTION, TRANSACTIONS_SUBCOLLECTION
+
+logger = logging.getLogger(__name__)
+
+# Aggregates of a user live in backend/{user_id}/aggregates/summary
+AGGREGATES_SUBCOLLECTION = "aggregates"
+SUMMARY_DOCUMENT = "summary"
+
+# Totals that are kept as sums of per-record contributions
+SUM_FIELDS = (
+    "onchain_confirmed_sat",
+    "onchain_unconfirmed_sat",
+    "lightning_received_sat",
+    "transaction_count",
+    "invoice_count",
+    "settled_invoice_count",
+)
+# Fields of the stored records the contributions are computed from
+TRANSACTION_FIELDS = ("output_details", "num_confirmations", "block_height", "time_stamp")
+INVOICE_FIELDS = ("state", "amt_paid_sat", "settle_date", "creation_date")
+
+LOCK_STRIPES = 64
+
+
+def _int(value) -> int:
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def empty_totals() -> dict:
+    totals = {name: 0 for name in SUM_FIELDS}
+    totals["last_activity_at"] = 0
+    return totals
+
+
+def transaction_contribution(data: dict, owns: Callable[[str], bool]) -> dict:
+    """What a stored transaction adds to the totals of the user `owns` recognises the addresses of."""
+    amount = sum(_int(output.get("amount")) for output in data.get("output_details") or []
+                 if output.get("is_our_address") and owns(output.get("address")))
+    # Stored transactions may only have the block height, see services/chain.py
+    confirmed = _int(data.get("block_height")) > 0 or _int(data.get("num_confirmations")) > 0
+    return {
+        "onchain_confirmed_sat": amount if confirmed else 0,
+        "onchain_unconfirmed_sat": 0 if confirmed else amount,
+        "transaction_count": 1,
+        "last_activity_at": _int(data.get("time_stamp")),
+    }
+
+
+def invoice_contribution(data: dict) -> dict:
+    settled = data.get("state") == "SETTLED"
+    return {
+        "lightning_received_sat": _int(data.get("amt_paid_sat")) if settled else 0,
+        "invoice_count": 1,
+        "settled_invoice_count": 1 if settled else 0,
+        "last_activity_at": _int(data.get("settle_date")) if settled else _int(data.get("creation_date")),
+    }
+
+
+def add_contribution(totals: dict, contribution: dict, sign: int = 1):
+    for name in SUM_FIELDS:
+        totals[name] += sign * contribution.get(name, 0)
+    if sign > 0:
+        totals["last_activity_at"] = max(totals["last_activity_at"], contribution.get("last_activity_at", 0))
+
+
+@dataclass
+class ReconcileProgress:
+    state: str = 'pending'  # pending, running, done, cancelled or failed
+    users: int = 0
+    mismatched: int = 0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+
+    def to_json(self) -> dict:
+        return {
+            "state": self.state,
+            "users": self.users,
+            "mismatched": self.mismatched,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+
+
+class AggregateStore:
+    """
+    SQLite record of what every written record contributed to its user's
+    totals, and of the totals themselves.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        # Survives the process crashing, which is what replays after a restart need
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS contributions "
+                           "(path TEXT PRIMARY KEY, user_id TEXT NOT NULL, data TEXT NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS contributions_user ON contributions (user_id)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS totals (user_id TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def totals(self, user_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM totals WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def contribution(self, path: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM contributions WHERE path = ?", (path,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, user_id: str, path: str, contribution: dict, totals: dict):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO contributions (path, user_id, data) VALUES (?, ?, ?)",
+                               (path, user_id, json.dumps(contribution)))
+            self._conn.execute("INSERT OR REPLACE INTO totals (user_id, data) VALUES (?, ?)", (user_id, json.dumps(totals)))
+            self._conn.commit()
+
+    def replace_user(self, user_id: str, contributions: Dict[str, dict], totals: dict):
+        with self._lock:
+            self._conn.execute("DELETE FROM contributions WHERE user_id = ?", (user_id,))
+            self._conn.executemany("INSERT OR REPLACE INTO contributions (path, user_id, data) VALUES (?, ?, ?)",
+                                   [(path, user_id, json.dumps(data)) for path, data in contributions.items()])
+            self._conn.execute("INSERT OR REPLACE INTO totals (user_id, data) VALUES (?, ?)", (user_id, json.dumps(totals)))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class Aggregator:
+    """
+    Per-user balance and activity totals, maintained incrementally as records
+    are written and mirrored to backend/{user_id}/aggregates/summary.
+
+    The contribution of each record (on-chain amount received on the user's
+    addresses, confirmed or not, settled Lightning amount, counts, activity
+    time) is remembered in the local `AggregateStore`, and only the
+    difference to the previous contribution is applied. Replaying a record is
+    therefore a no-op. A user the store has never seen, e.g. after the state
+    directory was lost or on a new host, is rebuilt from Firestore before
+    the first delta is applied. Records are applied once their document is
+    committed (see Ingestor.written).
+
+    `rebuild` recomputes a user from scratch and reports whether the stored
+    or published totals were off. `reconcile` does that for every user.
+    """
+
+    def __init__(self, db, writer, address_index, path: Optional[str] = None):
+        self._db = db
+        self._writer = writer
+        self._address_index = address_index
+        self._store = AggregateStore(path)
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self.reconcile_progress = ReconcileProgress()
+        self._cancel_reconcile = threading.Event()
+
+    def apply(self, user_id: str, collection: str, document_id: str, data: dict,
+              received_at: Optional[float] = None):
+        """Apply the change of one record of `user_id` written with `data` (the full record)."""
+        path = self._record_path(user_id, collection, document_id)
+        contribution = self._contribution(user_id, collection, data)
+        with self._lock(user_id):
+            totals = self._store.totals(user_id)
+            rebuilt = totals is None
+            if rebuilt:
+                totals = self._rebuild(user_id)[0]
+            previous = self._store.contribution(path)
+            if previous == contribution:
+                if rebuilt:
+                    # Applied once the record is committed, so the rebuild already counted it
+                    self._publish(user_id, totals, received_at)
+                return
+            if previous is not None:
+                add_contribution(totals, previous, -1)
+            add_contribution(totals, contribution)
+            self._store.update(user_id, path, contribution, totals)
+            self._publish(user_id, totals, received_at)
+
+    def rebuild(self, user_id: str) -> bool:
+        """Recompute the totals of `user_id` from Firestore, return True if they were wrong."""
+        # Anything still queued for this user has to be visible to the rebuild. Flushed before taking the
+        # lock, the records committed by the flush are applied under it.
+        self._writer.flush()
+        with self._lock(user_id):
+            stored = self._store.totals(user_id)
+            published = self._summary_ref(user_id).get().to_dict()
+            totals, _ = self._rebuild(user_id)
+            mismatched = (stored is not None and stored != totals) or not published or any(
+                published.get(name) != value for name, value in totals.items())
+            if mismatched:
+                logger.warning('aggregates did not match their records',
+                               extra={'user_id': user_id, 'stored': stored, 'published': published, 'rebuilt': totals})
+            self._publish(user_id, totals)
+            return mismatched
+
+    def reconcile(self, user_ids: Optional[Iterable[str]] = None):
+        """Rebuild and verify the aggregates of `user_ids`, by default every user."""
+        progress = self.reconcile_progress = ReconcileProgress(state='running', started_at=time.time())
+        try:
+            if user_ids is None:
+                user_ids = (ref.id for ref in self._db.collection(BACKEND_COLLECTION).list_documents())
+            for user_id in user_ids:
+                if self._cancel_reconcile.is_set():
+                    progress.state = 'cancelled'
+                    return
+                if self.rebuild(user_id):
+                    progress.mismatched += 1
+                progress.users += 1
+        except Exception as e:
+            progress.state = 'failed'
+            progress.error = repr(e)
+            raise
+        else:
+            progress.state = 'done'
+        finally:
+            progress.finished_at = time.time()
+            self._cancel_reconcile.clear()
+            self._writer.flush()
+
+    def cancel_reconcile(self):
+        """Stop a running `reconcile` after the user it is working on."""
+        self._cancel_reconcile.set()
+
+    def close(self):
+        self._store.close()
+
+    def _rebuild(self, user_id: str):
+        user_ref = self._db.collection(BACKEND_COLLECTION).document(user_id)
+        totals = empty_totals()
+        contributions = {}
+        for collection, fields in ((TRANSACTIONS_SUBCOLLECTION, TRANSACTION_FIELDS),
+                                   (INVOICES_SUBCOLLECTION, INVOICE_FIELDS)):
+            for snapshot in user_ref.collection(collection).select(fields).stream():
+                contribution = self._contribution(user_id, collection, snapshot.to_dict() or {})
+                contributions[self._record_path(user_id, collection, snapshot.id)] = contribution
+                add_contribution(totals, contribution)
+        self._store.replace_user(user_id, contributions, totals)
+        return totals, contributions
+
+    def _contribution(self, user_id: str, collection: str, data: dict) -> dict:
+        if collection == TRANSACTIONS_SUBCOLLECTION:
+            return transaction_contribution(data, lambda address: self._address_index.get_owner(address) == user_id)
+        return invoice_contribution(data)
+
+    def _publish(self, user_id: str, totals: dict, received_at: Optional[float] = None):
+        self._writer.upsert(self._summary_ref(user_id), {**totals, "updated_at": time.time()}, received_at=received_at)
+
+    def _summary_ref(self, user_id: str):
+        return (self._db.collection(BACKEND_COLLECTION).document(user_id)
+                .collection(AGGREGATES_SUBCOLLECTION).document(SUMMARY_DOCUMENT))
+
+    def _lock(self, user_id: str) -> threading.Lock:
+        return self._locks[zlib.crc32(user_id.encode()) % LOCK_STRIPES]
+
+    @staticmethod
+    def _record_path(user_id: str, collection: str, document_id: str) -> str:
+        return f"{BACKEND_COLLECTION}/{user_id}/{collection}/{document_id}"
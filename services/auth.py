@@ -0,0 +1,28 @@
+from typing import Optional
+
+
+class InvalidToken(ValueError):
+    """The bearer token is malformed, expired, revoked or not signed for this project."""
+
+
+def bearer_token(authorization: Optional[str]) -> Optional[str]:
+    """The token of an `Authorization: Bearer <token>` header, None without one."""
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+    return token.strip()
+
+
+def verify_firebase_token(token: str) -> dict:
+    """
+    Claims of a Firebase ID token, with the user id in `uid`. Needs the
+    Firebase app initialized by main.firestore_client. Failing to fetch the
+    signing keys is raised as is, it says nothing about the token.
+    """
+    # The Firebase SDK is slow to import, so it is only loaded when a token is checked
+    from firebase_admin import auth
+
+    try:
+        return auth.verify_id_token(token)
+    except (auth.InvalidIdTokenError, ValueError) as e:
+        raise InvalidToken(str(e)) from None
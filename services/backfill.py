@@ -0,0 +1,117 @@
+import asyncio
+import itertools
+import time
+from dataclasses import dataclass
+from typing import Callable, Iterable, List, Optional
+
+
+@dataclass
+class BackfillProgress:
+    state: str = 'pending'  # pending, running, done or failed
+    fetched: int = 0
+    resolved: int = 0
+    unowned: int = 0
+    written: int = 0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+
+    def rate(self) -> float:
+        """Records processed per second since the job started."""
+        if self.started_at is None:
+            return 0.0
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        if elapsed <= 0:
+            return 0.0
+        return (self.resolved + self.unowned) / elapsed
+
+    def to_json(self) -> dict:
+        return {
+            "state": self.state,
+            "fetched": self.fetched,
+            "resolved": self.resolved,
+            "unowned": self.unowned,
+            "written": self.written,
+            "rate": round(self.rate(), 2),
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+
+
+_DONE = object()
+
+
+class BackfillJob:
+    """
+    Bounded producer/consumer pipeline for one kind of historical record.
+
+    A single producer pulls records from `fetch` in chunks of `fetch_chunk`
+    and puts them on a queue of at most `queue_size` records, so paging from
+    LND overlaps with the consumers. `concurrency` consumers resolve the
+    owners of each record and hand it to `write`. Blocking calls run on
+    `executor`.
+    """
+
+    def __init__(self, name: str, fetch: Callable[[], Iterable], resolve: Callable[[object], List[str]],
+                 write: Callable[[object, List[str]], None], executor, concurrency: int = 4,
+                 queue_size: int = 1000, fetch_chunk: int = 100):
+        self.name = name
+        self.progress = BackfillProgress()
+        self._fetch = fetch
+        self._resolve = resolve
+        self._write = write
+        self._executor = executor
+        self._concurrency = concurrency
+        self._queue_size = queue_size
+        self._fetch_chunk = fetch_chunk
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self._queue_size)
+        self.progress.state = 'running'
+        self.progress.started_at = time.time()
+        producer = asyncio.create_task(self._produce(loop, queue))
+        consumers = [asyncio.create_task(self._consume(loop, queue)) for _ in range(self._concurrency)]
+        tasks = [producer, *consumers]
+        try:
+            # A failed consumer would leave the producer blocked on a full queue, so the first error ends the job
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        except BaseException as e:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.progress.state = 'failed'
+            self.progress.error = repr(e)
+            self.progress.finished_at = time.time()
+            raise
+        self.progress.state = 'done'
+        self.progress.finished_at = time.time()
+
+    async def _produce(self, loop, queue: asyncio.Queue):
+        records = iter(await loop.run_in_executor(self._executor, self._fetch))
+        while True:
+            chunk = await loop.run_in_executor(self._executor, list, itertools.islice(records, self._fetch_chunk))
+            if not chunk:
+                break
+            for record in chunk:
+                self.progress.fetched += 1
+                await queue.put(record)
+        for _ in range(self._concurrency):
+            await queue.put(_DONE)
+
+    async def _consume(self, loop, queue: asyncio.Queue):
+        while True:
+            record = await queue.get()
+            if record is _DONE:
+                return
+            owners = await loop.run_in_executor(self._executor, self._resolve, record)
+            if not owners:
+                self.progress.unowned += 1
+                continue
+            self.progress.resolved += 1
+            await loop.run_in_executor(self._executor, self._write, record, owners)
+            self.progress.written += 1
@@ -0,0 +1,299 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+from services.ingestion import BACKEND_COLLECTION, TRANSACTIONS_SUBCOLLECTION
+
+logger = logging.getLogger(__name__)
+
+# The chain tip clients derive confirmation counts from lives in chain/tip
+CHAIN_COLLECTION = "chain"
+CHAIN_TIP_DOCUMENT = "tip"
+
+# Confirmation milestone stored on transaction documents instead of num_confirmations
+CONFIRMATION_FIELD = "confirmation_state"
+UNCONFIRMED = "unconfirmed"
+CONFIRMED = "confirmed"
+# At least `final_confirmations` confirmations
+FINAL = "final"
+# Fields of transaction documents readers derive from the tip, deleted from the stored documents
+DERIVED_FIELDS = ("num_confirmations",)
+
+
+def _int(value) -> int:
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def confirmations(block_height: int, tip_height: Optional[int]) -> Optional[int]:
+    """Confirmations of a transaction mined at `block_height`, None while the tip is unknown."""
+    if block_height <= 0:
+        return 0
+    if tip_height is None:
+        return None
+    return max(tip_height - block_height + 1, 1)
+
+
+def confirmation_state(block_height: int, tip_height: Optional[int], final_confirmations: int) -> str:
+    """Milestone of a transaction mined at `block_height` (0 or less if unconfirmed) at the tip `tip_height`."""
+    count = confirmations(block_height, tip_height)
+    if not count:
+        return UNCONFIRMED if count == 0 else CONFIRMED
+    return FINAL if count >= final_confirmations else CONFIRMED
+
+
+@dataclass(frozen=True)
+class ChainTip:
+    block_height: int
+    block_hash: str
+
+
+@dataclass
+class IndexedTransaction:
+    user_id: str
+    tx_hash: str
+    block_height: int
+    block_hash: str
+    state: str
+
+
+class BlockHeightIndex:
+    """
+    SQLite index of the user transaction documents by block height and
+    confirmation milestone, and the last chain tip seen.
+
+    Only transactions that can still reach or lose a milestone are needed:
+    final ones buried more than a reorg deep are pruned.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS transactions (user_id TEXT NOT NULL, tx_hash TEXT NOT NULL, "
+                           "block_height INTEGER NOT NULL, block_hash TEXT NOT NULL, state TEXT NOT NULL, "
+                           "PRIMARY KEY (user_id, tx_hash))")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS transactions_height ON transactions (block_height)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS transactions_state ON transactions (state, block_height)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS tip (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                           "block_height INTEGER NOT NULL, block_hash TEXT NOT NULL)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def tip(self) -> Optional[ChainTip]:
+        with self._lock:
+            row = self._conn.execute("SELECT block_height, block_hash FROM tip").fetchone()
+        return ChainTip(*row) if row else None
+
+    def set_tip(self, tip: ChainTip):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO tip (id, block_height, block_hash) VALUES (0, ?, ?)",
+                               (tip.block_height, tip.block_hash))
+            self._conn.commit()
+
+    def get(self, user_id: str, tx_hash: str) -> Optional[IndexedTransaction]:
+        with self._lock:
+            row = self._conn.execute("SELECT user_id, tx_hash, block_height, block_hash, state FROM transactions "
+                                     "WHERE user_id = ? AND tx_hash = ?", (user_id, tx_hash)).fetchone()
+        return IndexedTransaction(*row) if row else None
+
+    def put(self, transaction: IndexedTransaction):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO transactions (user_id, tx_hash, block_height, block_hash, state) "
+                               "VALUES (?, ?, ?, ?, ?)", (transaction.user_id, transaction.tx_hash,
+                                                          transaction.block_height, transaction.block_hash,
+                                                          transaction.state))
+            self._conn.commit()
+
+    def set_state(self, transactions: List[IndexedTransaction], state: str):
+        with self._lock:
+            self._conn.executemany("UPDATE transactions SET state = ? WHERE user_id = ? AND tx_hash = ?",
+                                   [(state, transaction.user_id, transaction.tx_hash) for transaction in transactions])
+            self._conn.commit()
+
+    def in_range(self, low: int, high: int, state: Optional[str] = None) -> List[IndexedTransaction]:
+        """Mined transactions with a block height in [low, high], optionally only those in `state`."""
+        query = ("SELECT user_id, tx_hash, block_height, block_hash, state FROM transactions "
+                 "WHERE block_height BETWEEN ? AND ?")
+        params = [max(low, 1), high]
+        if state is not None:
+            query += " AND state = ?"
+            params.append(state)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [IndexedTransaction(*row) for row in rows]
+
+    def other_hash_at(self, block_height: int, block_hash: str) -> bool:
+        """Whether a transaction at `block_height` was indexed with a different block hash."""
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM transactions WHERE block_height = ? AND block_hash != ? LIMIT 1",
+                                     (block_height, block_hash)).fetchone()
+        return row is not None
+
+    def prune(self, below_height: int) -> int:
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM transactions WHERE state = ? AND block_height BETWEEN 1 AND ?",
+                                        (FINAL, below_height - 1))
+            self._conn.commit()
+        return cursor.rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ChainTracker:
+    """
+    Confirmation milestones of user transactions, derived from the chain tip
+    instead of LND's num_confirmations.
+
+    Transaction documents keep block_height and block_hash and a
+    `confirmation_state` (unconfirmed, confirmed, or final from
+    `final_confirmations` on) instead of a count, so the per-block re-emits
+    of recent transactions no longer change them. The tip is kept in a single
+    chain/tip document, written once per block, and readers derive the count
+    as tip - block_height + 1.
+
+    `annotate` sets the milestone of every transaction document written and
+    indexes it by height (`BlockHeightIndex`). `advance` moves the tip and
+    only writes the transactions that reach the final milestone, or lose it
+    in a reorganization. A reorganization shows as the tip going back or
+    changing its hash, or as a transaction mined in a block with a different
+    hash than one indexed at the same height. `advance` then returns the
+    height the transactions have to be fetched again from, `reorg_depth`
+    below the fork.
+    """
+
+    derived_fields = DERIVED_FIELDS
+
+    def __init__(self, db, writer, fingerprints, index: BlockHeightIndex, cache=None, final_confirmations: int = 6,
+                 reorg_depth: int = 6):
+        self._db = db
+        self._writer = writer
+        self._fingerprints = fingerprints
+        self.index = index
+        self.cache = cache
+        self.final_confirmations = final_confirmations
+        self.reorg_depth = reorg_depth
+        self.tip: Optional[ChainTip] = index.tip()
+        self._reorg_from: Optional[int] = None
+        self._lock = threading.Lock()
+
+    @property
+    def tip_height(self) -> Optional[int]:
+        tip = self.tip
+        return tip.block_height if tip else None
+
+    def state_of(self, block_height: int) -> str:
+        return confirmation_state(block_height, self.tip_height, self.final_confirmations)
+
+    def with_confirmations(self, record: dict, tip_height: Optional[int] = None) -> dict:
+        """A stored transaction `record` with the num_confirmations derived from the tip, or `tip_height`."""
+        if tip_height is None:
+            tip_height = self.tip_height
+        return {**record, "num_confirmations": confirmations(_int(record.get("block_height")), tip_height)}
+
+    def annotate(self, user_id: str, tx_hash: str, document: dict) -> dict:
+        """The transaction `document` to write for `user_id`, with its milestone instead of num_confirmations."""
+        document = {name: value for name, value in document.items() if name not in DERIVED_FIELDS}
+        block_height = _int(document.get("block_height"))
+        block_hash = document.get("block_hash") or ""
+        with self._lock:
+            state = self.state_of(block_height)
+            document[CONFIRMATION_FIELD] = state
+            indexed = self.index.get(user_id, tx_hash)
+            if indexed is not None and (indexed.block_height, indexed.block_hash, indexed.state) == (block_height, block_hash, state):
+                return document
+            if indexed is None and state == FINAL and block_height < self._prune_height():
+                # Buried deeper than a reorg reaches, e.g. from a backfill, nothing left to track
+                return document
+            if block_height > 0 and self.index.other_hash_at(block_height, block_hash):
+                logger.warning('conflicting block hashes, chain reorganized',
+                               extra={'block_height': block_height, 'block_hash': block_hash})
+                self._reorg_at(block_height)
+            self.index.put(IndexedTransaction(user_id, tx_hash, block_height, block_hash, state))
+        return document
+
+    def advance(self, block_height: int, block_hash: str) -> Optional[int]:
+        """
+        Move to the tip reported by LND. Return the height to fetch the
+        transactions again from if the chain reorganized, else None.
+        """
+        tip = ChainTip(block_height, block_hash)
+        with self._lock:
+            previous = self.tip
+            if previous != tip:
+                if previous is not None and (block_height < previous.block_height or (
+                        block_height == previous.block_height and block_hash != previous.block_hash)):
+                    logger.warning('chain tip went back or changed, chain reorganized',
+                                   extra={'block_height': block_height, 'previous_height': previous.block_height})
+                    self._reorg_at(block_height)
+                self.tip = tip
+                self.index.set_tip(tip)
+                self._writer.upsert(self._db.collection(CHAIN_COLLECTION).document(CHAIN_TIP_DOCUMENT), {
+                    "block_height": block_height,
+                    "block_hash": block_hash,
+                    "final_confirmations": self.final_confirmations,
+                    "updated_at": time.time(),
+                })
+                self._update_milestones(previous, tip)
+            reorg_from, self._reorg_from = self._reorg_from, None
+        return reorg_from
+
+    def forget(self, path: str):
+        """Called when the write of document `path` failed, so a milestone written there is written again."""
+        parts = path.split("/")
+        if len(parts) != 4 or parts[0] != BACKEND_COLLECTION or parts[2] != TRANSACTIONS_SUBCOLLECTION:
+            return
+        with self._lock:
+            indexed = self.index.get(parts[1], parts[3])
+            if indexed is not None and indexed.state == FINAL:
+                # Final again on the next advance
+                self.index.set_state([indexed], CONFIRMED)
+
+    def close(self):
+        self.index.close()
+
+    def _update_milestones(self, previous: Optional[ChainTip], tip: ChainTip):
+        # Mined at or below this height means final
+        final_height = tip.block_height - self.final_confirmations + 1
+        # Everything not yet final is looked at again after a restart or a reorg, else only the new blocks
+        reached = self.index.in_range(1, final_height, CONFIRMED)
+        lost = []
+        if previous is not None and final_height < previous.block_height - self.final_confirmations + 1:
+            lost = self.index.in_range(final_height + 1, previous.block_height, FINAL)
+        self._write_state(reached, FINAL)
+        self._write_state(lost, CONFIRMED)
+        self.index.prune(self._prune_height())
+
+    def _write_state(self, transactions: List[IndexedTransaction], state: str):
+        if not transactions:
+            return
+        for transaction in transactions:
+            doc_ref = (self._db.collection(BACKEND_COLLECTION).document(transaction.user_id)
+                       .collection(TRANSACTIONS_SUBCOLLECTION).document(transaction.tx_hash))
+            changes = self._fingerprints.merge(doc_ref.path, {CONFIRMATION_FIELD: state})
+            if changes:
+                self._writer.upsert(doc_ref, changes)
+            if self.cache is not None:
+                self.cache.record(transaction.user_id, TRANSACTIONS_SUBCOLLECTION, transaction.tx_hash,
+                                  {CONFIRMATION_FIELD: state})
+        self.index.set_state(transactions, state)
+
+    def _prune_height(self) -> int:
+        # Final transactions mined below this height are no longer indexed
+        return self.tip.block_height - self.final_confirmations + 1 - self.reorg_depth
+
+    def _reorg_at(self, block_height: int):
+        height = max(block_height - self.reorg_depth, 1)
+        self._reorg_from = height if self._reorg_from is None else min(self._reorg_from, height)
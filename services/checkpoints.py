@@ -0,0 +1,72 @@
+import os
+import sqlite3
+import threading
+from typing import Dict, Optional
+
+# Checkpoint keys
+TRANSACTIONS_BLOCK_HEIGHT = "transactions.block_height"
+INVOICES_ADD_INDEX = "invoices.add_index"
+INVOICES_SETTLE_INDEX = "invoices.settle_index"
+
+
+class CheckpointStore:
+    """
+    Durable sync checkpoints kept in a local SQLite database.
+
+    Checkpoints only move forward. Values are first staged in memory while the
+    records they cover are still waiting to be written, and `commit_staged`
+    persists them once those writes have been committed. A drain with failed
+    writes drops them with `discard_staged` instead.
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS checkpoints (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._staged: Dict[str, int] = {}
+
+    def get(self, key: str) -> Optional[int]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM checkpoints WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def advance(self, key: str, value: int):
+        """Persist `value` for `key` unless the stored checkpoint is already further."""
+        with self._lock:
+            self._advance(key, value)
+            self._conn.commit()
+
+    def stage(self, key: str, value: int):
+        """Remember `value` for `key` until the next `commit_staged`."""
+        with self._lock:
+            if value > self._staged.get(key, -1):
+                self._staged[key] = value
+
+    def commit_staged(self):
+        with self._lock:
+            if not self._staged:
+                return
+            for key, value in self._staged.items():
+                self._advance(key, value)
+            self._conn.commit()
+            self._staged.clear()
+
+    def discard_staged(self):
+        """Drop the staged values, the writes of the records they cover failed."""
+        with self._lock:
+            self._staged.clear()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _advance(self, key: str, value: int):
+        self._conn.execute(
+            "INSERT INTO checkpoints (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value WHERE excluded.value > checkpoints.value",
+            (key, value),
+        )
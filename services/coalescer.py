@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from services.metrics import EVENTS_COALESCED
+
+logger = logging.getLogger(__name__)
+
+
+class Coalescer:
+    """
+    Short-window coalescing of repeated updates to the same key.
+
+    An event is held for `window` seconds. Further events for the same key in
+    that window replace it, so only the latest state is forwarded once through
+    `forward(key, payload, received_at)`. The earliest receive time is kept so
+    lag is measured from the first update. Events for which `flush_now`
+    returns True (e.g. a SETTLED invoice) are forwarded immediately together
+    with anything pending for their key. A window of 0 disables coalescing.
+    At most `max_pending` keys are held, the oldest is forwarded early when
+    that limit is hit.
+    """
+
+    def __init__(self, name: str, forward: Callable[[str, object, Optional[float]], Awaitable], window: float,
+                 flush_now: Optional[Callable[[object], bool]] = None, max_pending: int = 10000):
+        self.name = name
+        self.window = window
+        self._forward = forward
+        self._flush_now = flush_now or (lambda payload: False)
+        self._max_pending = max_pending
+        # key -> (deadline, payload, received_at), in deadline order
+        self._pending: "OrderedDict[str, tuple]" = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None and self.window > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the flusher and forward everything still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def submit(self, key: str, payload, received_at: Optional[float] = None):
+        pending = self._pending.get(key)
+        if pending is not None:
+            EVENTS_COALESCED.labels(self.name).inc()
+            if pending[2] is not None:
+                received_at = pending[2] if received_at is None else min(pending[2], received_at)
+        if self.window <= 0 or self._flush_now(payload):
+            self._pending.pop(key, None)
+            await self._forward(key, payload, received_at)
+            return
+        if pending is not None:
+            self._pending[key] = (pending[0], payload, received_at)
+            return
+        self._pending[key] = (time.monotonic() + self.window, payload, received_at)
+        if len(self._pending) > self._max_pending:
+            oldest, (_, oldest_payload, oldest_received_at) = self._pending.popitem(last=False)
+            await self._forward(oldest, oldest_payload, oldest_received_at)
+        if len(self._pending) == 1:
+            self._wakeup.set()
+
+    async def flush(self):
+        while self._pending:
+            key, (_, payload, received_at) = self._pending.popitem(last=False)
+            await self._forward(key, payload, received_at)
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    async def _run(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            key = next(iter(self._pending))
+            delay = self._pending[key][0] - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, payload, received_at = self._pending.pop(key)
+            try:
+                await self._forward(key, payload, received_at)
+            except Exception:
+                logger.exception('forwarding coalesced event failed', extra={'coalescer': self.name, 'key': key})
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import zlib
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+from services.metrics import BACKPRESSURE_WAITS, QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PipelineEvent:
+    seq: int
+    key: str
+    payload: object
+    received_at: Optional[float]
+
+
+class EventPipeline:
+    """
+    Bounded queue between a stream reader and a pool of persistence workers.
+
+    Events are sharded over `workers` queues by key, so events with the same
+    key (tx_hash, payment_addr) are handled one at a time and in order while
+    different keys are handled in parallel. `handler(payload, received_at)`
+    runs on `executor`.
+
+    `submit` waits while the queue of the event's shard is full, which pauses
+    the reader instead of buffering without bound. Crossing `high_watermark`
+    queued events is logged and every wait is counted.
+
+    `on_processed(payload)` is called in submission order once an event and
+    every event submitted before it have been handled, so it is safe to
+    advance checkpoints from it. Events whose handler raised are reported to
+    `on_failed(payload, error)` first.
+    """
+
+    def __init__(self, name: str, handler: Callable, executor, workers: int = 4, queue_size: int = 10000,
+                 high_watermark: Optional[int] = None, on_processed: Optional[Callable] = None,
+                 on_failed: Optional[Callable] = None):
+        self.name = name
+        self._handler = handler
+        self._executor = executor
+        self._workers = workers
+        self._shard_size = max(queue_size // workers, 1)
+        self.high_watermark = high_watermark if high_watermark is not None else int(queue_size * 0.8)
+        self._on_processed = on_processed
+        self._on_failed = on_failed
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self._next_seq = 0
+        self._release_seq = 0
+        self._finished: Dict[int, PipelineEvent] = {}
+        self._above_watermark = False
+        self._depth = QUEUE_DEPTH.labels(name)
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queues = [asyncio.Queue(maxsize=self._shard_size) for _ in range(self._workers)]
+        self._tasks = [asyncio.create_task(self._work(queue)) for queue in self._queues]
+
+    async def stop(self, timeout: Optional[float] = None):
+        """Wait up to `timeout` seconds for queued events to be handled, then stop the workers."""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning('pipeline stopped with events still queued', extra={'pipeline': self.name, 'depth': self.depth()})
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def depth(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    def status(self) -> dict:
+        return {
+            "depth": self.depth(),
+            "capacity": self._shard_size * self._workers,
+            "high_watermark": self.high_watermark,
+            "above_high_watermark": self._above_watermark,
+            "workers": self._workers,
+        }
+
+    async def submit(self, key: str, payload, received_at: Optional[float] = None):
+        event = PipelineEvent(self._next_seq, key, payload, received_at)
+        self._next_seq += 1
+        queue = self._queues[zlib.crc32(key.encode()) % self._workers]
+        if queue.full():
+            BACKPRESSURE_WAITS.labels(self.name).inc()
+        await queue.put(event)
+        self._update_depth()
+
+    def _update_depth(self):
+        depth = self.depth()
+        self._depth.set(depth)
+        if depth >= self.high_watermark and not self._above_watermark:
+            self._above_watermark = True
+            logger.warning('event queue above high watermark', extra={'pipeline': self.name, 'depth': depth})
+        elif depth < self.high_watermark // 2 and self._above_watermark:
+            self._above_watermark = False
+            logger.info('event queue back below high watermark', extra={'pipeline': self.name, 'depth': depth})
+
+    async def _work(self, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            event = await queue.get()
+            try:
+                await loop.run_in_executor(self._executor, self._handler, event.payload, event.received_at)
+            except Exception as e:
+                logger.exception('event handler failed', extra={'pipeline': self.name, 'key': event.key})
+                if self._on_failed is not None:
+                    self._on_failed(event.payload, e)
+            finally:
+                queue.task_done()
+                self._update_depth()
+                self._release(event)
+
+    def _release(self, event: PipelineEvent):
+        self._finished[event.seq] = event
+        while self._release_seq in self._finished:
+            released = self._finished.pop(self._release_seq)
+            self._release_seq += 1
+            if self._on_processed is not None:
+                self._on_processed(released.payload)
@@ -0,0 +1,133 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+
+def field_digest(value) -> str:
+    """Stable digest of a JSON-compatible value."""
+    encoded = json.dumps(value, sort_keys=True, separators=(',', ':'), default=str).encode()
+    return hashlib.blake2b(encoded, digest_size=12).hexdigest()
+
+
+class FingerprintCache:
+    """
+    Bounded LRU of per-field digests of the documents last written.
+
+    `changes` compares a serialized record with the fingerprint of what was
+    last written to the same document and returns only the fields that
+    differ, or None if nothing changed. If `path` is given, fingerprints are
+    also kept in a SQLite database so they survive restarts. Only what
+    Firestore committed is persisted there: `committed` is called by the
+    BatchWriter with the writes of every committed batch, `forget` drops the
+    fingerprint of a write that failed and `discard_unsaved` every one not
+    committed yet.
+    """
+
+    def __init__(self, max_entries: int = 100000, path: Optional[str] = None):
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        # Keys whose fingerprint changed since their last committed write
+        self._unsaved: Set[str] = set()
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS fingerprints (key TEXT PRIMARY KEY, fields TEXT NOT NULL)")
+            self._conn.commit()
+
+    def changes(self, key: str, data: dict) -> Optional[dict]:
+        """Return the fields of `data` that changed since the last write of `key` and remember them."""
+        digests = {name: field_digest(value) for name, value in data.items()}
+        with self._lock:
+            previous = self._get(key)
+            if previous == digests:
+                self._entries.move_to_end(key)
+                return None
+            if previous is None:
+                changed = dict(data)
+            else:
+                changed = {name: data[name] for name, digest in digests.items() if previous.get(name) != digest}
+                if not changed:
+                    self._entries.move_to_end(key)
+                    return None
+            self._put(key, digests)
+        return changed
+
+    def merge(self, key: str, data: dict) -> Optional[dict]:
+        """Like `changes` for a merge write of only some fields of `key`, the other fields are kept."""
+        digests = {name: field_digest(value) for name, value in data.items()}
+        with self._lock:
+            previous = self._get(key)
+            if previous is None:
+                # Unknown document, written without remembering a partial fingerprint
+                return dict(data)
+            changed = {name: data[name] for name, digest in digests.items() if previous.get(name) != digest}
+            if not changed:
+                self._entries.move_to_end(key)
+                return None
+            self._put(key, {**previous, **digests})
+        return changed
+
+    def committed(self, writes: Iterable[Tuple[str, dict]]):
+        """Persist the fingerprints of the fields of `writes`, (key, data) pairs Firestore committed."""
+        if self._conn is None:
+            return
+        with self._lock:
+            written = False
+            for key, data in writes:
+                if key not in self._unsaved:
+                    continue
+                self._unsaved.discard(key)
+                row = self._conn.execute("SELECT fields FROM fingerprints WHERE key = ?", (key,)).fetchone()
+                # The writes are merges, the fields not written keep what was committed before
+                digests = json.loads(row[0]) if row else {}
+                digests.update((name, field_digest(value)) for name, value in data.items())
+                self._conn.execute("INSERT OR REPLACE INTO fingerprints (key, fields) VALUES (?, ?)",
+                                   (key, json.dumps(digests)))
+                written = True
+            if written:
+                self._conn.commit()
+
+    def discard_unsaved(self):
+        """Drop the fingerprints not yet committed, after a flush with failed writes."""
+        with self._lock:
+            for key in self._unsaved:
+                self._entries.pop(key, None)
+            self._unsaved.clear()
+
+    def forget(self, key: str):
+        """Drop the fingerprint of `key`, e.g. after its write failed."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._unsaved.discard(key)
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM fingerprints WHERE key = ?", (key,))
+                self._conn.commit()
+
+    def _get(self, key: str) -> Optional[Dict[str, str]]:
+        digests = self._entries.get(key)
+        if digests is None and self._conn is not None:
+            row = self._conn.execute("SELECT fields FROM fingerprints WHERE key = ?", (key,)).fetchone()
+            if row:
+                digests = json.loads(row[0])
+                self._remember(key, digests)
+        return digests
+
+    def _put(self, key: str, digests: Dict[str, str]):
+        self._remember(key, digests)
+        if self._conn is not None:
+            # Persisted by `committed` once the write is committed
+            self._unsaved.add(key)
+
+    def _remember(self, key: str, digests: Dict[str, str]):
+        self._entries[key] = digests
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,197 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from services.metrics import EVENT_PERSIST_LAG, FIRESTORE_WRITE_LATENCY
+
+logger = logging.getLogger(__name__)
+
+# Firestore rejects batches with more than 500 writes
+MAX_BATCH_SIZE = 500
+
+
+class BatchWriter:
+    """
+    Collects document upserts and commits them through Firestore WriteBatch.
+
+    Every upsert is written with set(merge=True), so no read is needed to find
+    out whether the document exists. Pending writes are committed once
+    `batch_size` documents are queued or `flush_interval` seconds after the
+    first queued write, whichever comes first. Upserts of a document that is
+    still pending are merged into the pending write.
+
+    If a batch commit fails its documents are retried one by one so a single
+    bad document cannot hold back the rest of the batch. Documents that still
+    fail after `max_retries` attempts are kept in `failures` and reported to
+    `on_failure`. The writes of every committed batch, and of every document
+    retried successfully, are reported to `on_commit` as (path, data) pairs.
+    An upsert can also carry its own `then` callback, called once the write
+    it was merged into is committed and dropped if that write fails for
+    good. Callbacks run on the flushing thread and may queue upserts, which
+    are committed by the same flush.
+
+    `received_at` (a time.time() timestamp) of the oldest upsert merged into a
+    write is used to report the event-to-persisted lag once it is committed.
+
+    Drain listeners are called with `ok=True` when a flush has committed every
+    pending write without a permanent failure. They run while new upserts are
+    held back, so anything queued before the call is known to be committed.
+    """
+
+    def __init__(self, db, batch_size: int = MAX_BATCH_SIZE, flush_interval: float = 1.0,
+                 max_retries: int = 3, on_failure: Optional[Callable[[str, Exception], None]] = None,
+                 on_commit: Optional[Callable[[List[Tuple[str, dict]]], None]] = None):
+        if not 0 < batch_size <= MAX_BATCH_SIZE:
+            raise ValueError(f"batch_size must be between 1 and {MAX_BATCH_SIZE}")
+        self._db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.on_failure = on_failure
+        self.on_commit = on_commit
+        self.failures: Dict[str, Exception] = {}
+        # path -> (ref, data, received_at, callbacks)
+        self._pending: Dict[str, Tuple[object, dict, Optional[float], Tuple[Callable[[], None], ...]]] = {}
+        self._pending_since: Optional[float] = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._drain_listeners: List[Callable[[bool], None]] = []
+        self._flush_failed = False
+        # Set while the callbacks of committed writes run, their upserts do not flush inline
+        self._in_callbacks = threading.local()
+
+    def add_drain_listener(self, listener: Callable[[bool], None]):
+        self._drain_listeners.append(listener)
+
+    def start(self):
+        """Start the background thread that flushes after `flush_interval`."""
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='firestore-batch-writer', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """Stop the background thread and commit everything still pending."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def upsert(self, ref, data: dict, received_at: Optional[float] = None,
+               then: Optional[Callable[[], None]] = None):
+        """Queue a merge write of `data` into the document at `ref`, and `then` to call once it is committed."""
+        callbacks = (then,) if then is not None else ()
+        with self._lock:
+            pending = self._pending.get(ref.path)
+            if pending is not None:
+                data = {**pending[1], **data}
+                if pending[2] is not None:
+                    received_at = pending[2] if received_at is None else min(pending[2], received_at)
+                callbacks = pending[3] + callbacks
+            self._pending[ref.path] = (ref, data, received_at, callbacks)
+            first = self._pending_since is None
+            if first:
+                self._pending_since = time.monotonic()
+            full = len(self._pending) >= self.batch_size
+        if full and not getattr(self._in_callbacks, 'active', False):
+            self.flush()
+        elif first:
+            self._wakeup.set()
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """Commit all pending writes, `batch_size` documents per batch."""
+        with self._flush_lock:
+            self._flush_failed = False
+            while True:
+                with self._lock:
+                    if not self._pending:
+                        self._pending_since = None
+                        for listener in self._drain_listeners:
+                            listener(not self._flush_failed)
+                        return
+                    paths = list(self._pending)[:self.batch_size]
+                    writes = [self._pending.pop(path) for path in paths]
+                    self._pending_since = time.monotonic() if self._pending else None
+                self._commit(writes)
+
+    def _commit(self, writes: List[Tuple[object, dict, Optional[float], Tuple[Callable[[], None], ...]]]):
+        batch = self._db.batch()
+        for ref, data, _, _ in writes:
+            batch.set(ref, data, merge=True)
+        try:
+            with FIRESTORE_WRITE_LATENCY.time():
+                batch.commit()
+        except Exception as e:
+            logger.warning('batch commit failed, retrying documents individually',
+                           extra={'documents': len(writes), 'error': repr(e)})
+            for ref, data, received_at, callbacks in writes:
+                self._retry_single(ref, data, received_at, callbacks)
+            return
+        for ref, _, received_at, _ in writes:
+            self.failures.pop(ref.path, None)
+            self._observe_lag(ref, received_at)
+        if self.on_commit:
+            self.on_commit([(ref.path, data) for ref, data, _, _ in writes])
+        self._run_callbacks([callback for _, _, _, callbacks in writes for callback in callbacks])
+
+    def _observe_lag(self, ref, received_at: Optional[float]):
+        if received_at is not None:
+            EVENT_PERSIST_LAG.labels(ref.parent.id).observe(time.time() - received_at)
+
+    def _retry_single(self, ref, data: dict, received_at: Optional[float], callbacks: Tuple[Callable[[], None], ...]):
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                ref.set(data, merge=True)
+                self.failures.pop(ref.path, None)
+                self._observe_lag(ref, received_at)
+                if self.on_commit:
+                    self.on_commit([(ref.path, data)])
+                self._run_callbacks(callbacks)
+                return
+            except Exception as e:
+                error = e
+                if attempt < self.max_retries:
+                    time.sleep(0.1 * 2 ** attempt)
+        logger.error('document write failed', extra={'path': ref.path, 'attempts': self.max_retries, 'error': repr(error)})
+        self.failures[ref.path] = error
+        self._flush_failed = True
+        if self.on_failure:
+            self.on_failure(ref.path, error)
+
+    def _run_callbacks(self, callbacks: List[Callable[[], None]]):
+        self._in_callbacks.active = True
+        try:
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    logger.exception('commit callback failed')
+        finally:
+            self._in_callbacks.active = False
+
+    def _run(self):
+        while not self._stopped.is_set():
+            with self._lock:
+                since = self._pending_since
+            if since is None:
+                timeout = self.flush_interval
+            else:
+                timeout = since + self.flush_interval - time.monotonic()
+            if timeout > 0:
+                self._wakeup.wait(timeout)
+                self._wakeup.clear()
+                continue
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('background flush failed')
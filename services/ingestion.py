@@ -0,0 +1,219 @@
+import logging
+from typing import List, Optional, Tuple
+
+from data_classes.invoice import Invoice
+from data_classes.transaction import Transaction
+from services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Firestore collection constants
+BTC_ADDRESSES_COLLECTION = "bitcoin_addresses"
+BACKEND_COLLECTION = "backend"
+TRANSACTIONS_SUBCOLLECTION = "transactions"
+INVOICES_SUBCOLLECTION = "invoices"
+# Bulky fields moved out of user documents, see services/projection.py
+BLOBS_COLLECTION = "blobs"
+# Field of a user document naming the blob with its bulky fields
+BLOB_FIELD = "blob"
+# Fields the activity API orders and range-filters user documents by. LND
+# encodes them as strings, they are stored as integers on every write path.
+TIME_FIELDS = {TRANSACTIONS_SUBCOLLECTION: "time_stamp", INVOICES_SUBCOLLECTION: "creation_date"}
+
+
+def with_int_time(subcollection: str, document: dict) -> dict:
+    """`document` with its time field, if any, as an integer."""
+    name = TIME_FIELDS.get(subcollection)
+    value = document.get(name) if name else None
+    if not isinstance(value, str):
+        return document
+    try:
+        return {**document, name: int(value)}
+    except ValueError:
+        return document
+
+
+def with_deleted(document: dict, names) -> dict:
+    """`document` with Firestore's DELETE_FIELD for the fields of `names` it does not set."""
+    deleted = [name for name in names if name not in document]
+    if not deleted:
+        return document
+    # Imported here like the rest of the Firebase SDK, see main.firestore_client
+    from google.cloud import firestore
+
+    return {**document, **{name: firestore.DELETE_FIELD for name in deleted}}
+
+
+class Ingestor:
+    """
+    Owner lookup and Firestore write layer shared by every LND node.
+
+    Records are resolved to their owners through the address index and
+    queued on the batch writer under backend/{user_id}/{subcollection}.
+    Every written record is also handed to the optional activity `cache`
+    that serves the read API. Changed records go to the optional
+    `aggregates` that keep the per-user totals, the optional `ledger`
+    (services.ledger) used for reporting and the optional `notifications`
+    hub that pushes them to connected clients, once the batch writer has
+    committed their document.
+
+    With `projections` (collection -> services.projection.Projection) the
+    documents written and cached hold only the projected hot fields, and the
+    bulky fields go to the `blobs` store, referenced by the digest in the
+    document's `blob` field.
+
+    With a `chain` (services.chain.ChainTracker) transaction documents carry
+    a confirmation milestone instead of num_confirmations, which readers
+    derive from the chain tip.
+    """
+
+    def __init__(self, db, address_index, writer, fingerprints, cache=None, aggregates=None, ledger=None,
+                 notifications=None, projections=None, blobs=None, chain=None):
+        self._db = db
+        self.address_index = address_index
+        self.writer = writer
+        self.fingerprints = fingerprints
+        self.cache = cache
+        self.aggregates = aggregates
+        self.ledger = ledger
+        self.notifications = notifications
+        self.projections = projections or {}
+        self.blobs = blobs
+        self.chain = chain
+        self._known_users = set()
+
+    def upsert_user_document(self, user_id: str, subcollection: str, document_id: str, data: dict,
+                             received_at: Optional[float] = None):
+        """
+        Queue a merge write of `data` into backend/{user_id}/{subcollection}/{document_id}.
+
+        Only the fields that changed since the document was last written are sent,
+        and nothing is written if the record is unchanged. Fields the document
+        no longer has are deleted, the writes being merges.
+        """
+        document, blob = self.project(subcollection, data)
+        # Fields a stored document can still hold that `document` no longer sets
+        cleared = self.cleared_fields(subcollection, data)
+        if self.chain is not None and subcollection == TRANSACTIONS_SUBCOLLECTION:
+            document = self.chain.annotate(user_id, document_id, document)
+            cleared.extend(self.chain.derived_fields)
+        if self.cache is not None:
+            self.cache.record(user_id, subcollection, document_id, document, cleared=cleared)
+        user_ref = self._db.collection(BACKEND_COLLECTION).document(user_id)
+        doc_ref = user_ref.collection(subcollection).document(document_id)
+        # The deletes go through the fingerprints too, so they are only sent again when the document was not
+        changes = self.fingerprints.changes(doc_ref.path, with_deleted(document, cleared))
+        if not changes:
+            return
+        try:
+            if blob is not None and BLOB_FIELD in changes:
+                # Queued before the document that references it
+                self.blobs.put(*blob, received_at=received_at)
+            if user_id not in self._known_users:
+                # Make sure the parent user document exists, once per process
+                self.writer.upsert(user_ref, {})
+                self._known_users.add(user_id)
+            self.writer.upsert(doc_ref, changes, received_at=received_at,
+                               then=lambda: self.written(user_id, subcollection, document_id, data, changes, received_at))
+        except Exception:
+            # The write may not be queued, it must not count as written
+            self.fingerprints.forget(doc_ref.path)
+            raise
+        metrics.EVENTS_WRITTEN.labels(subcollection).inc()
+
+    def written(self, user_id: str, subcollection: str, document_id: str, data: dict, changes: dict,
+                received_at: Optional[float] = None):
+        """
+        Hand a record to the aggregates, ledger and notifications once its
+        document is committed. Their failures are logged, the document is
+        written regardless.
+        """
+        if self.aggregates is not None:
+            try:
+                self.aggregates.apply(user_id, subcollection, document_id, data, received_at)
+            except Exception:
+                # Repaired by the next aggregate reconciliation
+                logger.exception('aggregate update failed', extra={'collection': subcollection, 'document': document_id})
+        if self.ledger is not None:
+            try:
+                self.ledger.record(user_id, subcollection, data)
+            except Exception:
+                logger.exception('ledger record failed', extra={'collection': subcollection, 'document': document_id})
+        if self.notifications is not None:
+            try:
+                self.notifications.notify(user_id, subcollection, data, changes,
+                                          lambda address: self.address_index.get_owner(address) == user_id)
+            except Exception:
+                logger.exception('notification failed', extra={'collection': subcollection, 'document': document_id})
+
+    def project(self, subcollection: str, data: dict) -> Tuple[dict, Optional[Tuple[str, bytes]]]:
+        """The document written for `data`, and the digest and encoding of its bulky fields if any."""
+        projection = self.projections.get(subcollection)
+        if projection is None or self.blobs is None:
+            return with_int_time(subcollection, data), None
+        document, bulky = projection.split(data)
+        document = with_int_time(subcollection, document)
+        if not bulky:
+            return document, None
+        digest, compressed = projection.encode(bulky)
+        document[BLOB_FIELD] = digest
+        return document, (digest, compressed)
+
+    def cleared_fields(self, subcollection: str, data: dict) -> List[str]:
+        """
+        The projected fields of `data` that are now empty, e.g. block_hash
+        after a reorganization, and the blob reference, which `project`
+        leaves out when there are no bulky fields.
+        """
+        projection = self.projections.get(subcollection)
+        if projection is None or self.blobs is None:
+            return []
+        return projection.omitted(data) + [BLOB_FIELD]
+
+    def post_transaction(self, transaction: Transaction, received_at: Optional[float] = None):
+        logger.debug('searching for transaction owner', extra={'tx_hash': transaction.tx_hash, 'sampled': True})
+        self.write_transaction(transaction, self.resolve_transaction_owners(transaction), received_at)
+
+    def resolve_transaction_owners(self, transaction: Transaction) -> List[str]:
+        owners = []
+        for output_detail in transaction.output_details:
+            if output_detail.is_our_address:
+                logger.debug('checking address', extra={'address': output_detail.address, 'sampled': True})
+                with metrics.OWNER_LOOKUP_LATENCY.time():
+                    user_id = self.address_index.get_owner(output_detail.address)
+                if user_id and user_id not in owners:
+                    owners.append(user_id)
+        count_resolution(TRANSACTIONS_SUBCOLLECTION, owners)
+        return owners
+
+    def write_transaction(self, transaction: Transaction, owners: List[str], received_at: Optional[float] = None):
+        for user_id in owners:
+            self.upsert_user_document(user_id, TRANSACTIONS_SUBCOLLECTION, transaction.tx_hash,
+                                      transaction.to_json(), received_at)
+
+    def post_invoice(self, invoice: Invoice, received_at: Optional[float] = None):
+        logger.debug('searching for invoice owner',
+                     extra={'payment_addr': invoice.payment_addr, 'fallback_addr': invoice.fallback_addr, 'sampled': True})
+        self.write_invoice(invoice, self.resolve_invoice_owners(invoice), received_at)
+
+    def resolve_invoice_owners(self, invoice: Invoice) -> List[str]:
+        if not invoice.fallback_addr:
+            count_resolution(INVOICES_SUBCOLLECTION, [])
+            return []
+        with metrics.OWNER_LOOKUP_LATENCY.time():
+            user_id = self.address_index.get_owner(invoice.fallback_addr)
+        owners = [user_id] if user_id else []
+        count_resolution(INVOICES_SUBCOLLECTION, owners)
+        return owners
+
+    def write_invoice(self, invoice: Invoice, owners: List[str], received_at: Optional[float] = None):
+        for user_id in owners:
+            self.upsert_user_document(user_id, INVOICES_SUBCOLLECTION, invoice.payment_addr,
+                                      invoice.to_json(), received_at)
+
+
+def count_resolution(stream: str, owners: List[str]):
+    if owners:
+        metrics.EVENTS_RESOLVED.labels(stream).inc()
+    else:
+        metrics.EVENTS_UNOWNED.labels(stream).inc()
@@ -0,0 +1,307 @@
+import asyncio
+import heapq
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from typing import Callable, Dict, List, Optional, Set
+
+from services.metrics import JOURNAL_BACKLOG
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class JournalEntry:
+    seq: int
+    key: str
+    record: object
+    received_at: Optional[float]
+    # Set on the entry handed on when handling it failed, a retry gets a fresh copy
+    failed: bool = False
+
+
+class EventJournal:
+    """
+    Append-only local log of the events received from the LND streams, kept
+    in a SQLite database in WAL mode.
+
+    Events are appended as they are read from a stream, before anything
+    downstream sees them, and stay in the journal until the Firestore writes
+    they lead to are known to be committed. Like sync checkpoints, the
+    position up to which a stream has been handled is first staged and only
+    persisted by `commit_staged` once the batch writer has drained without a
+    failure. Persisting it also compacts the journal by deleting the entries
+    it covers. A failed drain instead calls `rewind`, which makes every
+    stream replay from its persisted position.
+
+    Compaction runs on a connection of its own, so appends only wait for it
+    in SQLite and not for the lock of the appending connection.
+    """
+
+    def __init__(self, path: str, compact_interval: float = 60.0):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.compact_interval = compact_interval
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # Free pages are handed back to the filesystem by `compact`, must be set before the tables exist
+        self._conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Appends survive the process crashing, only an OS crash can lose the last ones
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS events (seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                           "stream TEXT NOT NULL, key TEXT NOT NULL, data TEXT NOT NULL, received_at REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS events_stream ON events (stream, seq)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS positions (stream TEXT PRIMARY KEY, seq INTEGER NOT NULL)")
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._staged: Dict[str, int] = {}
+        self._backlog: Dict[str, int] = dict(
+            self._conn.execute("SELECT stream, COUNT(*) FROM events GROUP BY stream").fetchall())
+        for stream, count in self._backlog.items():
+            JOURNAL_BACKLOG.labels(stream).set(count)
+        self._compacted_at = time.monotonic()
+        # An in-memory journal is private to its connection and has no file to compact
+        self._compact_conn = sqlite3.connect(path, check_same_thread=False) if path != ":memory:" else None
+        self._compact_lock = threading.Lock()
+        # Bumped by every `rewind`, see JournalStream
+        self.generation = 0
+        # Runs the appends of every JournalStream, one thread keeps them in order
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='journal')
+
+    def append(self, stream: str, key: str, data: dict, received_at: Optional[float] = None) -> int:
+        with self._lock:
+            cursor = self._conn.execute("INSERT INTO events (stream, key, data, received_at) VALUES (?, ?, ?, ?)",
+                                        (stream, key, json.dumps(data), received_at))
+            self._conn.commit()
+            self._backlog[stream] = self._backlog.get(stream, 0) + 1
+            JOURNAL_BACKLOG.labels(stream).set(self._backlog[stream])
+            return cursor.lastrowid
+
+    def append_many(self, stream: str, entries: List[tuple], received_at: Optional[float] = None):
+        """Append (key, data) `entries` in order, in one transaction."""
+        self.append_rows(stream, [(key, data, received_at) for key, data in entries])
+
+    def append_rows(self, stream: str, entries: List[tuple]):
+        """Append (key, data, received_at) `entries` in order, in one transaction."""
+        with self._lock:
+            self._conn.executemany("INSERT INTO events (stream, key, data, received_at) VALUES (?, ?, ?, ?)",
+                                   [(stream, key, json.dumps(data), received_at) for key, data, received_at in entries])
+            self._conn.commit()
+            self._backlog[stream] = self._backlog.get(stream, 0) + len(entries)
+            JOURNAL_BACKLOG.labels(stream).set(self._backlog[stream])
+
+    def read(self, stream: str, after: int, limit: int) -> List[tuple]:
+        """Up to `limit` (seq, key, data, received_at) entries of `stream` after `after`, oldest first."""
+        with self._lock:
+            rows = self._conn.execute("SELECT seq, key, data, received_at FROM events "
+                                      "WHERE stream = ? AND seq > ? ORDER BY seq LIMIT ?",
+                                      (stream, after, limit)).fetchall()
+        return [(seq, key, json.loads(data), received_at) for seq, key, data, received_at in rows]
+
+    def position(self, stream: str) -> int:
+        """Seq up to which `stream` is persisted downstream."""
+        with self._lock:
+            row = self._conn.execute("SELECT seq FROM positions WHERE stream = ?", (stream,)).fetchone()
+        return row[0] if row else 0
+
+    def backlog(self, stream: str) -> int:
+        with self._lock:
+            return self._backlog.get(stream, 0)
+
+    def stage(self, stream: str, seq: int):
+        """Remember that `stream` is handled up to `seq` until the next `commit_staged`."""
+        with self._lock:
+            if seq > self._staged.get(stream, -1):
+                self._staged[stream] = seq
+
+    def commit_staged(self):
+        """Persist the staged positions and drop the entries they cover."""
+        with self._lock:
+            if not self._staged:
+                return
+            for stream, seq in self._staged.items():
+                self._conn.execute(
+                    "INSERT INTO positions (stream, seq) VALUES (?, ?) "
+                    "ON CONFLICT(stream) DO UPDATE SET seq = excluded.seq WHERE excluded.seq > positions.seq",
+                    (stream, seq),
+                )
+                deleted = self._conn.execute("DELETE FROM events WHERE stream = ? AND seq <= ?", (stream, seq)).rowcount
+                self._backlog[stream] = max(self._backlog.get(stream, 0) - deleted, 0)
+                JOURNAL_BACKLOG.labels(stream).set(self._backlog[stream])
+            self._conn.commit()
+            self._staged.clear()
+        if time.monotonic() - self._compacted_at >= self.compact_interval:
+            self.compact()
+
+    def rewind(self):
+        """Forget the staged positions and make every stream replay from its persisted one."""
+        with self._lock:
+            self._staged.clear()
+            self.generation += 1
+
+    def compact(self):
+        with self._compact_lock:
+            self._compacted_at = time.monotonic()
+            if self._compact_conn is None:
+                return
+            # Hand the pages of deleted entries back and keep the WAL file from growing. executescript
+            # steps the vacuum to the end, execute stops after the first page
+            self._compact_conn.executescript("PRAGMA incremental_vacuum")
+            self._compact_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        # Let the appends already handed to the executor finish first
+        self.executor.shutdown()
+        with self._compact_lock:
+            if self._compact_conn is not None:
+                self._compact_conn.close()
+        with self._lock:
+            self._conn.close()
+
+
+class JournalStream:
+    """
+    One stream's view of the journal: entries are appended by the stream
+    reader and read back in order by a drainer that hands them on.
+
+    Every entry read is pending until `done` is called for it or for a later
+    entry with the same key, which carries the newer state of the same
+    record. The position staged in the journal is just below the oldest
+    pending entry. Entries reported through `failed` stay pending and are
+    handed out again by `take_failed`. After a journal `rewind` the stream
+    starts reading again from its persisted position.
+
+    Appends are buffered and written in order by a task that runs the
+    inserts on the journal executor, so the stream reader never waits on
+    SQLite. The drainer only reads what is written: nothing is handed on
+    before it is journaled.
+    """
+
+    def __init__(self, journal: EventJournal, name: str, parse: Callable[[dict], object]):
+        self.journal = journal
+        self.name = name
+        self._parse = parse
+        self._position = journal.position(name)
+        self._generation = journal.generation
+        # key -> seqs read and not yet done, and all of them in a heap that may hold done ones
+        self._pending: Dict[str, Set[int]] = {}
+        self._live: Set[int] = set()
+        self._heap: List[int] = []
+        self._failed: Dict[int, JournalEntry] = {}
+        self._wakeup = asyncio.Event()
+        # (key, data, received_at) appended and not yet handed to the journal
+        self._buffer: List[tuple] = []
+        self._writing: Optional[asyncio.Task] = None
+
+    def append(self, key: str, data: dict, received_at: Optional[float] = None):
+        self.append_many([(key, data)], received_at)
+
+    def append_many(self, entries: List[tuple], received_at: Optional[float] = None):
+        if not entries:
+            return
+        self._buffer.extend((key, data, received_at) for key, data in entries)
+        if self._writing is None or self._writing.done():
+            self._writing = asyncio.create_task(self._write())
+
+    async def flush(self):
+        """Wait for the buffered appends to be journaled."""
+        while self._buffer or (self._writing is not None and not self._writing.done()):
+            if self._writing is None or self._writing.done():
+                self._writing = asyncio.create_task(self._write())
+            await asyncio.wait({self._writing})
+
+    def discard(self):
+        """Stop writing and drop the buffered appends."""
+        if self._writing is not None:
+            self._writing.cancel()
+        self._buffer = []
+
+    async def _write(self):
+        loop = asyncio.get_running_loop()
+        while self._buffer:
+            entries, self._buffer = self._buffer, []
+            try:
+                await loop.run_in_executor(self.journal.executor, self.journal.append_rows, self.name, entries)
+            except Exception:
+                logger.exception('journal append failed, retrying', extra={'stream': self.name, 'entries': len(entries)})
+                self._buffer[:0] = entries
+                await asyncio.sleep(1.0)
+                continue
+            self._wakeup.set()
+
+    def read(self, limit: int) -> List[JournalEntry]:
+        entries = [JournalEntry(seq, key, self._parse(data), received_at)
+                   for seq, key, data, received_at in self.journal.read(self.name, self._position, limit)]
+        for entry in entries:
+            self._pending.setdefault(entry.key, set()).add(entry.seq)
+            if entry.seq not in self._live:
+                self._live.add(entry.seq)
+                heapq.heappush(self._heap, entry.seq)
+            self._position = entry.seq
+        return entries
+
+    async def wait(self, timeout: float):
+        """Wait up to `timeout` seconds for an append."""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    def done(self, entry: JournalEntry):
+        if entry.failed:
+            return
+        seqs = self._pending.get(entry.key)
+        if seqs is None:
+            return
+        for seq in [seq for seq in seqs if seq <= entry.seq]:
+            seqs.discard(seq)
+            self._live.discard(seq)
+            self._failed.pop(seq, None)
+        if not seqs:
+            del self._pending[entry.key]
+        self.journal.stage(self.name, self.handled_up_to())
+
+    def failed(self, entry: JournalEntry):
+        entry.failed = True
+        if entry.seq in self._pending.get(entry.key, ()):
+            self._failed[entry.seq] = entry
+
+    def take_failed(self) -> List[JournalEntry]:
+        """Failed entries that no later entry has replaced since, oldest first."""
+        entries = [replace(entry, failed=False) for entry in self._failed.values()
+                   if entry.seq in self._pending.get(entry.key, ())]
+        self._failed.clear()
+        return sorted(entries, key=lambda entry: entry.seq)
+
+    def rewound(self) -> bool:
+        return self._generation != self.journal.generation
+
+    def rewind(self):
+        self._generation = self.journal.generation
+        self._position = self.journal.position(self.name)
+        self._pending.clear()
+        self._live.clear()
+        self._heap = []
+        self._failed.clear()
+
+    def handled_up_to(self) -> int:
+        while self._heap and self._heap[0] not in self._live:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return self._position
+        return self._heap[0] - 1
+
+    def status(self) -> dict:
+        return {
+            "backlog": self.journal.backlog(self.name),
+            "buffered": len(self._buffer),
+            "pending": len(self._live),
+            "failed": len(self._failed),
+        }
@@ -0,0 +1,133 @@
+import fcntl
+import logging
+import os
+import socket
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def default_holder_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class FileLease:
+    """
+    Stream ownership lease for workers on one host, held as an exclusive
+    flock on `path`.
+
+    The operating system drops the lock the moment the holding process
+    exits, so a waiting worker takes over on its next attempt.
+    """
+
+    def __init__(self, path: str, holder_id: Optional[str] = None):
+        self.path = path
+        self.holder_id = holder_id or default_holder_id()
+        self._file = None
+
+    def try_acquire(self) -> bool:
+        if self._file is not None:
+            return True
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        lock_file = open(self.path, 'a+')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        # Record the holder for whoever inspects the lock file
+        lock_file.truncate(0)
+        lock_file.write(self.holder_id)
+        lock_file.flush()
+        self._file = lock_file
+        return True
+
+    def renew(self) -> bool:
+        return self._file is not None
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+class FirestoreLease:
+    """
+    Stream ownership lease shared across hosts, kept in the Firestore document
+    `document_path` as {holder, expires_at}.
+
+    The lease is claimed and renewed in a transaction that only succeeds when
+    the document is missing, expired or already ours, and lasts `ttl` seconds
+    from each renewal. A holder that dies without releasing is replaced once
+    its lease expires. Expiry times are compared with the local clock, so
+    hosts are assumed to be synchronized well within `ttl`.
+
+    If renewing fails for another reason (e.g. Firestore is unreachable) the
+    lease is still treated as held while more than `safety_margin` seconds of
+    it remain, then given up.
+    """
+
+    def __init__(self, db, document_path: str, ttl: float = 15.0, holder_id: Optional[str] = None,
+                 safety_margin: Optional[float] = None):
+        self._db = db
+        self._ref = db.document(document_path)
+        self.ttl = ttl
+        self.holder_id = holder_id or default_holder_id()
+        self.safety_margin = safety_margin if safety_margin is not None else ttl / 3
+        self._expires_at = 0.0
+
+    def try_acquire(self) -> bool:
+        try:
+            return self._claim()
+        except Exception as e:
+            logger.warning('claiming the stream lease failed', extra={'holder': self.holder_id, 'error': repr(e)})
+            return False
+
+    def renew(self) -> bool:
+        try:
+            return self._claim()
+        except Exception as e:
+            still_valid = time.time() < self._expires_at - self.safety_margin
+            logger.warning('renewing the stream lease failed',
+                           extra={'holder': self.holder_id, 'error': repr(e), 'still_valid': still_valid})
+            return still_valid
+
+    def release(self):
+        from google.cloud import firestore
+
+        @firestore.transactional
+        def clear(transaction):
+            snapshot = self._ref.get(transaction=transaction)
+            if snapshot.exists and (snapshot.to_dict() or {}).get('holder') == self.holder_id:
+                transaction.delete(self._ref)
+
+        try:
+            clear(self._db.transaction())
+        except Exception as e:
+            logger.warning('releasing the stream lease failed', extra={'holder': self.holder_id, 'error': repr(e)})
+        self._expires_at = 0.0
+
+    def _claim(self) -> bool:
+        # Imported here like the rest of the Firebase SDK, see main.firestore_client
+        from google.cloud import firestore
+
+        @firestore.transactional
+        def claim(transaction):
+            snapshot = self._ref.get(transaction=transaction)
+            data = (snapshot.to_dict() or {}) if snapshot.exists else {}
+            now = time.time()
+            if data.get('holder') not in (None, self.holder_id) and data.get('expires_at', 0) > now:
+                return None
+            expires_at = now + self.ttl
+            transaction.set(self._ref, {'holder': self.holder_id, 'expires_at': expires_at})
+            return expires_at
+
+        expires_at = claim(self._db.transaction())
+        if expires_at is None:
+            return False
+        self._expires_at = expires_at
+        return True
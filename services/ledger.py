@@ -0,0 +1,381 @@
+"""
+Columnar ledger of the transactions and invoices written for users, kept as
+Parquet files partitioned per day and per group of users:
+
+    {root}/transactions/date=2024-05-01/user_bucket=7/part-....parquet
+    {root}/invoices/date=2024-05-01/user_bucket=7/part-....parquet
+
+A user's rows are all in the bucket `user_bucket(user_id)`, and sorted by
+user within each file, so reports for some users only read their buckets.
+A directory per user would leave millions of tiny files that take longer
+to open than to aggregate.
+
+Rows are appended by the ingestion path as records are written (see
+Ingestor) and by the export mode of this module, which pages every record
+out of the configured LND nodes. Updated records are appended again, and
+services.reporting keeps the latest row of every record. Every flush adds a
+file per partition it touches, `--compact-before` merges them for days
+that are over.
+
+pyarrow is only needed once rows are written or read. Run the export from
+the repository root:
+
+    python -m services.ledger --ledger ./state/ledger
+    python -m services.ledger --ledger ./state/ledger --compact-before 2024-05-01
+"""
+import argparse
+import logging
+import os
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from services.ingestion import INVOICES_SUBCOLLECTION, TRANSACTIONS_SUBCOLLECTION
+
+logger = logging.getLogger(__name__)
+
+# Users are spread over this many partitions per day. Changing it needs a new ledger directory.
+LEDGER_USER_BUCKETS = 16
+
+# Columns of the ledger files and their Arrow types. `date` and
+# `user_bucket` are stored as the partition directories, not in the files.
+LEDGER_COLUMNS = {
+    TRANSACTIONS_SUBCOLLECTION: (
+        ("user_id", "string"),
+        ("tx_hash", "string"),
+        ("time_stamp", "int64"),
+        ("block_height", "int64"),
+        ("num_confirmations", "int64"),
+        ("amount", "int64"),
+        ("total_fees", "int64"),
+        # Sum of the outputs paying the user's addresses
+        ("received_sat", "int64"),
+        ("recorded_at", "int64"),
+    ),
+    INVOICES_SUBCOLLECTION: (
+        ("user_id", "string"),
+        ("payment_addr", "string"),
+        ("r_hash", "string"),
+        ("creation_date", "int64"),
+        ("settle_date", "int64"),
+        ("state", "string"),
+        ("value", "int64"),
+        ("amt_paid_sat", "int64"),
+        ("recorded_at", "int64"),
+    ),
+}
+# Columns identifying a record
+LEDGER_KEYS = {
+    TRANSACTIONS_SUBCOLLECTION: ("user_id", "tx_hash"),
+    INVOICES_SUBCOLLECTION: ("user_id", "payment_addr"),
+}
+
+
+def pyarrow_modules():
+    """Import pyarrow and pyarrow.parquet, which are only required for the ledger."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("The ledger needs pyarrow, install it with `pip install pyarrow`")
+    return pyarrow, pyarrow.parquet
+
+
+def ledger_schema(pa, collection: str):
+    return pa.schema([(name, getattr(pa, type_name)()) for name, type_name in LEDGER_COLUMNS[collection]])
+
+
+def latest(table, keys):
+    """Keep the row with the highest `recorded_at` of every `keys` combination of a pyarrow Table."""
+    if table.num_rows == 0:
+        return table
+    # Grouping without threads keeps the order, so the last row of a group is the newest
+    others = [name for name in table.column_names if name not in keys]
+    newest = table.sort_by("recorded_at").group_by(list(keys), use_threads=False).aggregate(
+        [(name, "last") for name in others])
+    aggregated = {f"{name}_last": name for name in others}
+    return newest.rename_columns([aggregated.get(name, name) for name in newest.column_names]).select(table.column_names)
+
+
+def user_bucket(user_id: str, buckets: int = LEDGER_USER_BUCKETS) -> int:
+    return zlib.crc32(user_id.encode()) % buckets
+
+
+def _int(value) -> int:
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def partition_date(timestamp: int) -> str:
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d")
+
+
+def transaction_row(user_id: str, data: dict, owns: Callable[[str], bool]) -> dict:
+    received = sum(_int(output.get("amount")) for output in data.get("output_details") or []
+                   if output.get("is_our_address") and owns(output.get("address")))
+    return {
+        "user_id": user_id,
+        "tx_hash": data.get("tx_hash"),
+        "time_stamp": _int(data.get("time_stamp")),
+        "block_height": _int(data.get("block_height")),
+        "num_confirmations": _int(data.get("num_confirmations")),
+        "amount": _int(data.get("amount")),
+        "total_fees": _int(data.get("total_fees")),
+        "received_sat": received,
+    }
+
+
+def invoice_row(user_id: str, data: dict) -> dict:
+    return {
+        "user_id": user_id,
+        "payment_addr": data.get("payment_addr"),
+        "r_hash": data.get("r_hash"),
+        "creation_date": _int(data.get("creation_date")),
+        "settle_date": _int(data.get("settle_date")),
+        "state": data.get("state"),
+        "value": _int(data.get("value")),
+        "amt_paid_sat": _int(data.get("amt_paid_sat")),
+    }
+
+
+class LedgerWriter:
+    """
+    Buffers ledger rows and appends them as new Parquet files, one per
+    partition touched and sorted by user, once `flush_rows` rows are
+    buffered or `flush_interval` seconds after the last flush. Files are
+    written under a temporary name and renamed, so readers never see a
+    partial file.
+
+    Once `start`ed the flushes run on a background thread, so recording a
+    row never waits for Parquet writes and never raises their errors.
+    Without it (the export mode) `record` flushes inline. Partitions a
+    flush could not write go back to the buffer and are written with the
+    next one.
+    """
+
+    def __init__(self, root: str, address_index, flush_rows: int = 50000, flush_interval: float = 60.0,
+                 user_buckets: int = LEDGER_USER_BUCKETS):
+        self.root = root
+        self.user_buckets = user_buckets
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self._address_index = address_index
+        # (collection, date, user_bucket) -> rows
+        self._buffer: Dict[Tuple[str, str, str], List[dict]] = {}
+        self._buffered = 0
+        self._flushed_at = time.monotonic()
+        self._files = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start the background thread that flushes."""
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='ledger-writer', daemon=True)
+            self._thread.start()
+
+    def record(self, user_id: str, collection: str, data: dict):
+        """Buffer the row of a record of `user_id` written with `data` (the full record)."""
+        if collection == TRANSACTIONS_SUBCOLLECTION:
+            row = transaction_row(user_id, data, lambda address: self._address_index.get_owner(address) == user_id)
+            date = partition_date(row["time_stamp"])
+        elif collection == INVOICES_SUBCOLLECTION:
+            row = invoice_row(user_id, data)
+            date = partition_date(row["creation_date"])
+        else:
+            return
+        row["recorded_at"] = time.time_ns()
+        with self._lock:
+            self._buffer.setdefault((collection, date, user_bucket(user_id, self.user_buckets)), []).append(row)
+            self._buffered += 1
+            full = self._buffered >= self.flush_rows
+        if self._thread is not None:
+            if full:
+                self._wakeup.set()
+        elif full or self._due():
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                buffer, self._buffer = self._buffer, {}
+                self._buffered = 0
+                self._flushed_at = time.monotonic()
+            if not buffer:
+                return
+            written = 0
+            try:
+                pa, pq = pyarrow_modules()
+                for (collection, date, bucket), rows in buffer.items():
+                    rows.sort(key=lambda row: row["user_id"])
+                    table = pa.Table.from_pylist(rows, schema=ledger_schema(pa, collection))
+                    directory = os.path.join(self.root, collection, f"date={date}", f"user_bucket={bucket}")
+                    os.makedirs(directory, exist_ok=True)
+                    self._files += 1
+                    name = f"part-{time.time_ns()}-{os.getpid()}-{self._files}.parquet"
+                    pq.write_table(table, os.path.join(directory, f".{name}.tmp"))
+                    os.replace(os.path.join(directory, f".{name}.tmp"), os.path.join(directory, name))
+                    written += 1
+            except BaseException:
+                self._restore(list(buffer.items())[written:])
+                raise
+            logger.info('ledger flushed', extra={'partitions': len(buffer),
+                                                 'rows': sum(len(rows) for rows in buffer.values())})
+
+    def close(self):
+        """Stop the background thread and write everything still buffered."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _due(self) -> bool:
+        with self._lock:
+            return bool(self._buffer) and time.monotonic() - self._flushed_at >= self.flush_interval
+
+    def _restore(self, partitions: List[Tuple[Tuple[str, str, str], List[dict]]]):
+        # Put in front of the rows recorded meanwhile, recorded_at keeps the order of updates anyway
+        with self._lock:
+            for key, rows in partitions:
+                self._buffer[key] = rows + self._buffer.get(key, [])
+                self._buffered += len(rows)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                return
+            with self._lock:
+                full = self._buffered >= self.flush_rows
+            if not (full or self._due()):
+                continue
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('ledger flush failed, rows kept for the next one')
+
+
+def compact(root: str, before_date: str) -> int:
+    """
+    Merge the files of every partition dated before `before_date` into one
+    holding the latest row of each record, return the number of partitions
+    compacted. Files appended meanwhile are
+    left alone.
+    """
+    pa, pq = pyarrow_modules()
+    compacted = 0
+    for collection in LEDGER_COLUMNS:
+        collection_dir = os.path.join(root, collection)
+        if not os.path.isdir(collection_dir):
+            continue
+        for date_dir in sorted(os.listdir(collection_dir)):
+            if not date_dir.startswith("date=") or date_dir[len("date="):] >= before_date:
+                continue
+            for bucket_dir in os.listdir(os.path.join(collection_dir, date_dir)):
+                directory = os.path.join(collection_dir, date_dir, bucket_dir)
+                files = sorted(name for name in os.listdir(directory) if name.endswith(".parquet"))
+                if len(files) < 2:
+                    continue
+                table = pa.concat_tables([pq.read_table(os.path.join(directory, name), schema=ledger_schema(pa, collection))
+                                          for name in files])
+                # Rows replaced by a later one are not needed anymore
+                table = latest(table, LEDGER_KEYS[collection]).sort_by("user_id")
+                name = f"part-{time.time_ns()}-{os.getpid()}-compacted.parquet"
+                pq.write_table(table, os.path.join(directory, f".{name}.tmp"))
+                os.replace(os.path.join(directory, f".{name}.tmp"), os.path.join(directory, name))
+                for old in files:
+                    os.remove(os.path.join(directory, old))
+                compacted += 1
+    return compacted
+
+
+def export(nodes, ingestor, ledger: LedgerWriter, positions):
+    """
+    Append every record of `nodes` not exported yet to `ledger`. What was
+    exported per node is tracked in the CheckpointStore `positions`.
+    """
+    for node in nodes:
+        block_key = f"{node.name}:{TRANSACTIONS_SUBCOLLECTION}.block_height"
+        add_index_key = f"{node.name}:{INVOICES_SUBCOLLECTION}.add_index"
+        start_height = positions.get(block_key)
+        tip_height = start_height or 0
+        count = 0
+        for transaction in node.iter_transactions(block_height_start=start_height):
+            for user_id in ingestor.resolve_transaction_owners(transaction):
+                ledger.record(user_id, TRANSACTIONS_SUBCOLLECTION, transaction.to_json())
+            tip_height = max(tip_height, transaction.block_height or 0)
+            count += 1
+        add_index = positions.get(add_index_key) or 0
+        last_add_index = add_index
+        for invoice in node.iter_invoices(index_offset=add_index):
+            for user_id in ingestor.resolve_invoice_owners(invoice):
+                ledger.record(user_id, INVOICES_SUBCOLLECTION, invoice.to_json())
+            last_add_index = max(last_add_index, int(invoice.add_index or 0))
+            count += 1
+        ledger.flush()
+        # Transactions are exported again from the last block, they may have been mined since
+        if tip_height:
+            positions.advance(block_key, tip_height)
+        positions.advance(add_index_key, last_add_index)
+        logger.info('ledger export done', extra={'node': node.name, 'records': count})
+
+
+def main():
+    # Imported here so the rest of the module does not depend on the app
+    from concurrent.futures import ThreadPoolExecutor
+
+    from main import firestore_client, node_configs, node_settings
+    from services.address_index import AddressIndex
+    from services.checkpoints import CheckpointStore
+    from services.ingestion import BTC_ADDRESSES_COLLECTION, Ingestor
+    from services.journal import EventJournal
+    from services.lnd_node import LndNode
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ledger", default="./state/ledger", help="ledger directory")
+    parser.add_argument("--ready-timeout", type=float, default=60.0, help="seconds to wait for the address index")
+    parser.add_argument("--compact-before", metavar="YYYY-MM-DD",
+                        help="only merge the files of the partitions dated before this day, nothing is exported")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.compact_before:
+        logger.info('ledger compacted', extra={'partitions': compact(args.ledger, args.compact_before)})
+        return
+
+    db = firestore_client()
+    address_index = AddressIndex(db, BTC_ADDRESSES_COLLECTION)
+    address_index.start()
+    if not address_index.wait_ready(args.ready_timeout):
+        logger.warning('address index not ready yet, falling back to owner queries')
+    # Only owner lookup is used, nothing is written to Firestore
+    ingestor = Ingestor(db, address_index, writer=None, fingerprints=None)
+    ledger = LedgerWriter(args.ledger, address_index)
+    positions = CheckpointStore(os.path.join(args.ledger, "_export.db"))
+    # The nodes are never started, only their paging is used
+    journal = EventJournal(":memory:")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        nodes = [LndNode(config, node_settings(), ingestor, positions, executor, journal) for config in node_configs()]
+        try:
+            export(nodes, ingestor, ledger, positions)
+        finally:
+            for node in nodes:
+                node.lnd.close()
+            ledger.close()
+            positions.close()
+            address_index.stop()
+
+
+if __name__ == "__main__":
+    main()
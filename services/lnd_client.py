@@ -0,0 +1,107 @@
+import codecs
+import os
+import ssl
+from contextlib import asynccontextmanager
+from typing import Optional, Tuple
+
+import httpx
+
+from services.metrics import LND_REQUEST_LATENCY
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class LndRestClient:
+    """
+    Shared client for the LND REST API.
+
+    The macaroon is read once and every request goes through pooled
+    keep-alive connections, using HTTP/2 when the `h2` package is installed.
+    TLS is verified against LND's own certificate at `tls_cert_path` instead
+    of being disabled. The synchronous client is used for paging from worker
+    threads, the asynchronous one for the subscription streams.
+    """
+
+    def __init__(self, host: str, macaroon_path: str, tls_cert_path: str, timeout: float = 30.0,
+                 connect_timeout: float = 10.0, max_connections: int = 20):
+        # Confirm the macaroon file exists
+        if not os.path.exists(macaroon_path):
+            raise FileNotFoundError(f"Macaroon file not found at {macaroon_path}")
+        if not os.path.exists(tls_cert_path):
+            raise FileNotFoundError(f"TLS certificate not found at {tls_cert_path}")
+
+        # Read the macaroon file
+        with open(macaroon_path, 'rb') as f:
+            macaroon = codecs.encode(f.read(), 'hex').decode()
+
+        self.host = host
+        self._headers = {"Grpc-Metadata-macaroon": macaroon}
+        # Only LND's certificate is trusted, which pins it
+        self._ssl_context = ssl.create_default_context(cafile=tls_cert_path)
+        self._timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        # Streams may stay silent for a long time, so only connecting is bounded
+        self._stream_timeout = httpx.Timeout(connect_timeout, read=None)
+        self._limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self._client = httpx.Client(**self._client_options())
+        self._async_client: Optional[httpx.AsyncClient] = None
+
+    def _client_options(self) -> dict:
+        return {
+            "base_url": self.host,
+            "headers": self._headers,
+            "verify": self._ssl_context,
+            "http2": HTTP2_AVAILABLE,
+            "timeout": self._timeout,
+            "limits": self._limits,
+        }
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        # Created lazily so it binds to the running event loop
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(**self._client_options())
+        return self._async_client
+
+    def get_json(self, path: str, params: Optional[dict] = None) -> dict:
+        with LND_REQUEST_LATENCY.labels(path).time():
+            response = self._client.get(path, params=params)
+        if response.status_code != 200:
+            raise Exception(f"Failed to fetch {path}: {response.status_code} - {response.text}")
+        return response.json()
+
+    async def aget_json(self, path: str, params: Optional[dict] = None) -> dict:
+        with LND_REQUEST_LATENCY.labels(path).time():
+            response = await self.async_client.get(path, params=params)
+        if response.status_code != 200:
+            raise Exception(f"Failed to fetch {path}: {response.status_code} - {response.text}")
+        return response.json()
+
+    @asynccontextmanager
+    async def stream(self, path: str, params: Optional[dict] = None):
+        """Open a streaming GET on `path` and yield the response for `aiter_lines()`."""
+        async with self.async_client.stream('GET', path, params=params, timeout=self._stream_timeout) as response:
+            if response.status_code != 200:
+                await response.aread()
+                raise Exception(f"Failed to open {path}: {response.status_code} - {response.text}")
+            yield response
+
+    def get_block_height(self) -> int:
+        return self.get_json('/v1/getinfo')['block_height']
+
+    def get_chain_tip(self) -> Tuple[int, str, bool]:
+        """Block height and hash of the node's tip, and whether it is synced to the chain."""
+        info = self.get_json('/v1/getinfo')
+        return info['block_height'], info.get('block_hash', ''), bool(info.get('synced_to_chain', True))
+
+    def close(self):
+        self._client.close()
+
+    async def aclose(self):
+        self._client.close()
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
@@ -0,0 +1,592 @@
+import asyncio
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Set
+
+from data_classes.invoice import Invoice
+from data_classes.transaction import Transaction
+from services import metrics
+from services.backfill import BackfillJob
+from services.checkpoints import INVOICES_ADD_INDEX, INVOICES_SETTLE_INDEX, TRANSACTIONS_BLOCK_HEIGHT
+from services.coalescer import Coalescer
+from services.event_pipeline import EventPipeline
+from services.ingestion import INVOICES_SUBCOLLECTION, TRANSACTIONS_SUBCOLLECTION
+from services.journal import JournalEntry, JournalStream
+from services.lnd_client import LndRestClient
+from services.paging import prefetched
+from services.supervisor import STREAMING, StreamSupervisor
+
+logger = logging.getLogger(__name__)
+
+# Checkpoints of the node with this name keep their original, unprefixed keys
+DEFAULT_NODE_NAME = "default"
+
+# Invoice states that are written immediately
+INVOICE_FLUSH_STATES = ('SETTLED', 'CANCELED')
+
+
+def flush_transaction_now(entry: JournalEntry) -> bool:
+    # The first confirmation is written immediately
+    return entry.record.num_confirmations == 1
+
+
+def flush_invoice_now(entry: JournalEntry) -> bool:
+    return entry.record.state in INVOICE_FLUSH_STATES
+
+
+@dataclass
+class LndNodeConfig:
+    name: str
+    rest_host: str
+    macaroon_path: str
+    tls_cert_path: str
+
+    @classmethod
+    def from_json(cls, data: dict) -> "LndNodeConfig":
+        return cls(
+            name=data["name"],
+            rest_host=data["rest_host"],
+            macaroon_path=data["macaroon_path"],
+            tls_cert_path=data["tls_cert_path"],
+        )
+
+
+def load_node_configs(path: str) -> List[LndNodeConfig]:
+    """Read a JSON list of {name, rest_host, macaroon_path, tls_cert_path} objects."""
+    with open(path) as f:
+        configs = [LndNodeConfig.from_json(node) for node in json.load(f)]
+    names = [config.name for config in configs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"LND node names must be unique, got {names}")
+    return configs
+
+
+@dataclass
+class NodeSettings:
+    """Tuning shared by every node."""
+    timeout: float = 30
+    connect_timeout: float = 10
+    max_connections: int = 20
+    invoice_page_size: int = 100
+    transaction_page_blocks: int = 5000
+    transactions_first_block: int = 1
+    # Transactions are re-fetched from a few blocks below the checkpoint in case of reorgs
+    reorg_safety_blocks: int = 6
+    stream_workers: int = 4
+    stream_queue_size: int = 10000
+    stream_high_watermark: int = 8000
+    pipeline_drain_timeout: float = 30
+    transaction_coalesce_window: float = 2.0
+    invoice_coalesce_window: float = 0.5
+    backfill_concurrency: int = 4
+    backfill_queue_size: int = 1000
+    journal_read_batch: int = 500
+    journal_poll_interval: float = 1.0
+    journal_retry_delay: float = 1.0
+    journal_max_retry_delay: float = 60.0
+    stream_retry_delay: float = 1.0
+    stream_max_retry_delay: float = 60.0
+    # LND sends nothing on an idle stream, so this also reopens quiet healthy ones
+    stream_idle_timeout: float = 300.0
+    stream_stable_after: float = 30.0
+
+
+def calculate_unix_timestamp(hours_ago: int) -> int:
+    """
+    Calculates the Unix timestamp for 'now - x_hours'.
+
+    Args:
+        hours_ago (int): The number of hours to subtract from the current time.
+
+    Returns:
+        int: Unix timestamp in seconds.
+    """
+    current_time = time.time()  # Current time in seconds since the Unix epoch
+    timestamp = int(current_time - (hours_ago * 3600))  # Subtract 'x' hours (3600 seconds per hour)
+    return timestamp
+
+
+class LndNode:
+    """
+    One LND backend: its REST client, transaction and invoice subscriptions,
+    backfill, checkpoints and health state.
+
+    Every node runs on the shared event loop and hands its records to the
+    shared `ingestor`. Checkpoints live in the shared store under keys
+    prefixed with the node name.
+
+    Stream events are appended to the shared `journal` (see
+    services.journal) as they are read and handed on to the coalescers by
+    a drainer per stream, so a slow or failing Firestore never holds up the
+    streams. Events whose handling failed are retried with a backoff, and
+    whatever was not persisted before a restart is replayed.
+
+    Each stream is kept open by a StreamSupervisor (services.supervisor).
+    After a reconnect the records missed in between are fetched while the
+    new stream already runs, and journaled unless the stream delivered them.
+    """
+
+    def __init__(self, config: LndNodeConfig, settings: NodeSettings, ingestor, checkpoints, executor, journal):
+        self.name = config.name
+        self.settings = settings
+        self.ingestor = ingestor
+        self.checkpoints = checkpoints
+        self.executor = executor
+        self.lnd = LndRestClient(config.rest_host, config.macaroon_path, config.tls_cert_path,
+                                 timeout=settings.timeout, connect_timeout=settings.connect_timeout,
+                                 max_connections=settings.max_connections)
+        self.backfill_jobs: List[BackfillJob] = []
+        # Highest checkpoint values journaled from the streams, see resume_checkpoint
+        self.received_marks: Dict[str, int] = {}
+        # Keys of the journal entries whose handler failed and no later entry has written since, per stream
+        self.failed_keys: Dict[str, Set[str]] = {}
+        self._tasks: List[asyncio.Task] = []
+
+        self.transaction_journal = JournalStream(journal, f'{self.name}.{TRANSACTIONS_SUBCOLLECTION}', Transaction.from_json)
+        self.invoice_journal = JournalStream(journal, f'{self.name}.{INVOICES_SUBCOLLECTION}', Invoice.from_json)
+        # The pipelines and coalescers carry journal entries, the handlers get the records
+        self.transaction_pipeline = EventPipeline(
+            f'{self.name}.{TRANSACTIONS_SUBCOLLECTION}',
+            lambda entry, received_at: ingestor.post_transaction(entry.record, received_at), executor,
+            workers=settings.stream_workers, queue_size=settings.stream_queue_size,
+            high_watermark=settings.stream_high_watermark,
+            on_processed=lambda entry: self.entry_processed(self.transaction_journal, entry, self.transaction_checkpoints),
+            on_failed=lambda entry, error: self.transaction_journal.failed(entry),
+        )
+        self.invoice_pipeline = EventPipeline(
+            f'{self.name}.{INVOICES_SUBCOLLECTION}',
+            lambda entry, received_at: ingestor.post_invoice(entry.record, received_at), executor,
+            workers=settings.stream_workers, queue_size=settings.stream_queue_size,
+            high_watermark=settings.stream_high_watermark,
+            on_processed=lambda entry: self.entry_processed(self.invoice_journal, entry, self.invoice_checkpoints),
+            on_failed=lambda entry, error: self.invoice_journal.failed(entry),
+        )
+        self.transaction_coalescer = Coalescer(
+            f'{self.name}.{TRANSACTIONS_SUBCOLLECTION}', self.transaction_pipeline.submit, settings.transaction_coalesce_window,
+            flush_now=flush_transaction_now,
+        )
+        self.invoice_coalescer = Coalescer(
+            f'{self.name}.{INVOICES_SUBCOLLECTION}', self.invoice_pipeline.submit, settings.invoice_coalesce_window,
+            flush_now=flush_invoice_now,
+        )
+        stream_options = dict(retry_delay=settings.stream_retry_delay, max_retry_delay=settings.stream_max_retry_delay,
+                              idle_timeout=settings.stream_idle_timeout, stable_after=settings.stream_stable_after)
+        self.transaction_stream = StreamSupervisor(
+            self.name, TRANSACTIONS_SUBCOLLECTION, lambda: self.lnd.stream('/v1/transactions/subscribe'),
+            self.transaction_received, catch_up=self.catch_up_transactions, **stream_options,
+        )
+        self.invoice_stream = StreamSupervisor(
+            self.name, INVOICES_SUBCOLLECTION,
+            lambda: self.lnd.stream('/v1/invoices/subscribe', params=self.invoice_subscription_params()),
+            self.invoice_received, catch_up=self.catch_up_invoices, **stream_options,
+        )
+
+    async def start(self):
+        self.transaction_pipeline.start()
+        self.invoice_pipeline.start()
+        self.transaction_coalescer.start()
+        self.invoice_coalescer.start()
+        self._tasks = [
+            asyncio.create_task(self.drain_journal(self.invoice_journal, self.invoice_coalescer)),
+            asyncio.create_task(self.drain_journal(self.transaction_journal, self.transaction_coalescer)),
+            asyncio.create_task(self.invoice_stream.run()),
+            asyncio.create_task(self.transaction_stream.run()),
+            # Backfill in the background so the app takes traffic immediately
+            asyncio.create_task(self.backfill()),
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Events left unjournaled are replayed by the next subscription, their checkpoints are not committed
+        streams = (self.transaction_journal, self.invoice_journal)
+        _, pending = await asyncio.wait([asyncio.create_task(stream.flush()) for stream in streams],
+                                        timeout=self.settings.pipeline_drain_timeout)
+        if pending:
+            logger.warning('journal appends left unwritten', extra={'node': self.name})
+        for task in pending:
+            task.cancel()
+        for stream in streams:
+            stream.discard()
+        await self.transaction_coalescer.stop()
+        await self.invoice_coalescer.stop()
+        await self.transaction_pipeline.stop(self.settings.pipeline_drain_timeout)
+        await self.invoice_pipeline.stop(self.settings.pipeline_drain_timeout)
+
+    async def close(self):
+        """Close the LND client once the node will not be started again."""
+        await self.lnd.aclose()
+
+    def streams_healthy(self) -> bool:
+        return all(stream.state == STREAMING for stream in (self.transaction_stream, self.invoice_stream))
+
+    def streams_status(self) -> dict:
+        return {
+            TRANSACTIONS_SUBCOLLECTION: self.transaction_stream.health.to_json(),
+            INVOICES_SUBCOLLECTION: self.invoice_stream.health.to_json(),
+        }
+
+    def status(self) -> dict:
+        return {
+            "streams": self.streams_status(),
+            "pipelines": {
+                TRANSACTIONS_SUBCOLLECTION: self.transaction_pipeline.status(),
+                INVOICES_SUBCOLLECTION: self.invoice_pipeline.status(),
+            },
+            "backfill": self.backfill_status(),
+            "journal": {
+                TRANSACTIONS_SUBCOLLECTION: self.transaction_journal.status(),
+                INVOICES_SUBCOLLECTION: self.invoice_journal.status(),
+            },
+        }
+
+    def backfill_status(self) -> dict:
+        return {
+            "ready": bool(self.backfill_jobs) and all(job.progress.state == 'done' for job in self.backfill_jobs),
+            "jobs": {job.name: job.progress.to_json() for job in self.backfill_jobs},
+        }
+
+    async def run_persistence(self, func, *args):
+        """Run a blocking persistence call on the persistence executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    # Journal
+
+    async def drain_journal(self, stream: JournalStream, coalescer: Coalescer):
+        """Hand the journaled events of `stream` to `coalescer` in order, retrying failed ones."""
+        settings = self.settings
+        delay = settings.journal_retry_delay
+        handled_up_to = stream.handled_up_to()
+        while True:
+            if stream.handled_up_to() > handled_up_to:
+                handled_up_to = stream.handled_up_to()
+                delay = settings.journal_retry_delay
+            if stream.rewound():
+                # Firestore writes failed, replay everything that is not known to be persisted
+                logger.warning('replaying journal after failed writes',
+                               extra={'node': self.name, 'stream': stream.name, 'delay': delay})
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, settings.journal_max_retry_delay)
+                stream.rewind()
+                handled_up_to = stream.handled_up_to()
+                continue
+            failed = stream.take_failed()
+            if failed:
+                logger.warning('retrying failed journal entries',
+                               extra={'node': self.name, 'stream': stream.name, 'entries': len(failed), 'delay': delay})
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, settings.journal_max_retry_delay)
+                metrics.JOURNAL_RETRIES.labels(stream.name).inc(len(failed))
+                entries = failed
+            else:
+                entries = stream.read(settings.journal_read_batch)
+            if not entries:
+                await stream.wait(settings.journal_poll_interval)
+                continue
+            for entry in entries:
+                await coalescer.submit(entry.key, entry, entry.received_at)
+
+    def entry_processed(self, stream: JournalStream, entry: JournalEntry, checkpoints_of):
+        stream.done(entry)
+        failed = self.failed_keys.setdefault(stream.name, set())
+        if entry.failed:
+            failed.add(entry.key)
+            return
+        failed.discard(entry.key)
+        # Checkpoints are highest values, staging past a record that is still to be written would skip it
+        if not failed:
+            self.stage_checkpoints(checkpoints_of(entry.record))
+
+    async def catch_up(self, stream: JournalStream, collection: str, pages: Iterator[List[dict]], parse,
+                       key_of: Callable[[object], str], checkpoints_of, seen_live: Callable[[str], bool]) -> int:
+        """
+        Journal the records of `pages`, fetched on the persistence executor,
+        except those the live stream delivered meanwhile: its state is at
+        least as new and already journaled. Return the number journaled.
+        """
+        received = metrics.EVENTS_RECEIVED.labels(self.name, collection)
+        count = 0
+        while True:
+            page = await self.run_persistence(next, pages, None)
+            if page is None:
+                return count
+            received.inc(len(page))
+            records = [(record, key_of(record), data) for record, data in ((parse(data), data) for data in page)]
+            records = [(record, key, data) for record, key, data in records if not seen_live(key)]
+            stream.append_many([(key, data) for _, key, data in records], time.time())
+            # Keeps the pages from piling up in memory when the journal is slower than LND
+            await stream.flush()
+            for record, _, _ in records:
+                self.mark_received(checkpoints_of(record))
+            count += len(records)
+
+    # Checkpoints
+
+    def checkpoint_key(self, key: str) -> str:
+        if self.name == DEFAULT_NODE_NAME:
+            return key
+        return f'{self.name}:{key}'
+
+    def get_checkpoint(self, key: str) -> Optional[int]:
+        return self.checkpoints.get(self.checkpoint_key(key))
+
+    def mark_received(self, marks: dict):
+        for key, value in marks.items():
+            if value > self.received_marks.get(key, -1):
+                self.received_marks[key] = value
+
+    def resume_checkpoint(self, key: str) -> Optional[int]:
+        """
+        The checkpoint to resume a stream from: what is committed, or further
+        what was journaled since this node started, which is not lost either.
+        While a catch-up runs the live stream is ahead of a gap, so only the
+        catch-up moves the journaled marks.
+        """
+        committed = self.get_checkpoint(key)
+        received = self.received_marks.get(key)
+        if committed is None or received is None:
+            return received if committed is None else committed
+        return max(committed, received)
+
+    def stage_checkpoints(self, marks: dict):
+        for key, value in marks.items():
+            self.checkpoints.stage(self.checkpoint_key(key), value)
+
+    def transactions_resume_height(self) -> Optional[int]:
+        block_height = self.resume_checkpoint(TRANSACTIONS_BLOCK_HEIGHT)
+        if block_height is None:
+            return None
+        return max(block_height - self.settings.reorg_safety_blocks, 1)
+
+    @staticmethod
+    def transaction_checkpoints(transaction: Transaction) -> dict:
+        # Unconfirmed transactions have no block height yet
+        if transaction.block_height and transaction.block_height > 0:
+            return {TRANSACTIONS_BLOCK_HEIGHT: transaction.block_height}
+        return {}
+
+    @staticmethod
+    def invoice_checkpoints(invoice: Invoice) -> dict:
+        # LND encodes uint64 indices as strings
+        marks = {}
+        if invoice.add_index:
+            marks[INVOICES_ADD_INDEX] = int(invoice.add_index)
+        if invoice.settle_index:
+            marks[INVOICES_SETTLE_INDEX] = int(invoice.settle_index)
+        return marks
+
+    def invoice_subscription_params(self) -> dict:
+        """Resume parameters so LND replays invoices added or settled since the checkpoints."""
+        params = {}
+        add_index = self.resume_checkpoint(INVOICES_ADD_INDEX)
+        settle_index = self.resume_checkpoint(INVOICES_SETTLE_INDEX)
+        if add_index is not None:
+            params['add_index'] = add_index
+        if settle_index is not None:
+            params['settle_index'] = settle_index
+        return params
+
+    # Backfill
+
+    async def backfill(self):
+        # Only the delta since the last checkpoints is fetched
+        transaction_marks = {}
+        invoice_marks = {}
+        start_height = self.transactions_resume_height()
+        add_index = self.get_checkpoint(INVOICES_ADD_INDEX) or 0
+        settings = self.settings
+        self.backfill_jobs = [
+            BackfillJob(TRANSACTIONS_SUBCOLLECTION,
+                        lambda: self.track_records(self.iter_transactions(block_height_start=start_height),
+                                                   TRANSACTIONS_SUBCOLLECTION, self.transaction_checkpoints,
+                                                   lambda transaction: transaction.tx_hash, transaction_marks),
+                        self.ingestor.resolve_transaction_owners, self.ingestor.write_transaction,
+                        self.executor, concurrency=settings.backfill_concurrency, queue_size=settings.backfill_queue_size),
+            BackfillJob(INVOICES_SUBCOLLECTION,
+                        lambda: self.track_records(self.iter_invoices(index_offset=add_index),
+                                                   INVOICES_SUBCOLLECTION, self.invoice_checkpoints,
+                                                   lambda invoice: invoice.payment_addr, invoice_marks),
+                        self.ingestor.resolve_invoice_owners, self.ingestor.write_invoice,
+                        self.executor, concurrency=settings.backfill_concurrency, queue_size=settings.backfill_queue_size),
+        ]
+        results = await asyncio.gather(*(job.run() for job in self.backfill_jobs), return_exceptions=True)
+        # The marks are only staged once the writes are done, a mark staged before a failed drain would be dropped
+        await self.run_persistence(self.ingestor.writer.flush)
+        for job, result, marks in zip(self.backfill_jobs, results, (transaction_marks, invoice_marks)):
+            if isinstance(result, Exception):
+                logger.error('backfill failed', extra={'node': self.name, 'job': job.name, 'error': repr(result)})
+            else:
+                self.stage_checkpoints(self.backfilled_marks(job.name, marks))
+        await self.run_persistence(self.ingestor.writer.flush)
+
+    def track_records(self, records, stream: str, checkpoints_of, key_of: Callable[[object], str],
+                      marks: Dict[str, dict]):
+        """Yield `records` while counting them and keeping the checkpoint values of each in `marks`, by document id."""
+        received = metrics.EVENTS_RECEIVED.labels(self.name, stream)
+        for record in records:
+            received.inc()
+            record_marks = checkpoints_of(record)
+            if record_marks:
+                marks[key_of(record)] = record_marks
+            yield record
+
+    def backfilled_marks(self, collection: str, marks: Dict[str, dict]) -> dict:
+        """
+        The checkpoint values covered by a backfill of `collection`: the
+        highest ones in `marks`, but below those of any record whose write
+        failed, so it is fetched again.
+        """
+        failed = set()
+        for path in list(self.ingestor.writer.failures):
+            parts = path.split("/")
+            if len(parts) == 4 and parts[2] == collection:
+                failed.add(parts[3])
+        highest = {}
+        below = {}
+        for document_id, record_marks in marks.items():
+            for key, value in record_marks.items():
+                if document_id in failed:
+                    below[key] = min(below.get(key, value), value)
+                elif value > highest.get(key, -1):
+                    highest[key] = value
+        if below:
+            logger.warning('backfill writes failed, checkpoints held back',
+                           extra={'node': self.name, 'collection': collection, 'failed': len(failed)})
+        return {key: min(value, below[key] - 1) if key in below else value for key, value in highest.items()}
+
+    # Transactions
+
+    def get_transactions(self, block_height_start=None) -> List[Transaction]:
+        return list(self.iter_transactions(block_height_start=block_height_start))
+
+    def iter_transactions(self, block_height_start=None, page_blocks=None) -> Iterator[Transaction]:
+        """Yield transactions page by page while the next page is fetched in the background."""
+        for page in prefetched(self.iter_transaction_pages(block_height_start, page_blocks)):
+            yield from page
+
+    def iter_transaction_pages(self, block_height_start=None, page_blocks=None) -> Iterator[List[Transaction]]:
+        for page in self.iter_raw_transaction_pages(block_height_start, page_blocks):
+            yield [Transaction.from_json(tx) for tx in page]
+
+    def iter_raw_transaction_pages(self, block_height_start=None, page_blocks=None) -> Iterator[List[dict]]:
+        page_blocks = page_blocks or self.settings.transaction_page_blocks
+        tip_height = self.lnd.get_block_height()
+        start_height = block_height_start or self.settings.transactions_first_block
+        while True:
+            if start_height > tip_height:
+                # end_height -1 also returns unconfirmed transactions and anything mined meanwhile
+                end_height = -1
+            else:
+                end_height = min(start_height + page_blocks - 1, tip_height)
+            data = self.lnd.get_json('/v1/transactions', params={'start_height': start_height, 'end_height': end_height})
+            transactions_list: list = data.get('transactions', [])
+            logger.info('retrieved transactions page',
+                        extra={'node': self.name, 'count': len(transactions_list),
+                               'start_height': start_height, 'end_height': end_height})
+            yield transactions_list
+            if end_height == -1:
+                return
+            start_height = end_height + 1
+
+    def transaction_received(self, raw_response: str, received_at: float) -> str:
+        metrics.EVENTS_RECEIVED.labels(self.name, TRANSACTIONS_SUBCOLLECTION).inc()
+        logger.debug('transaction stream new data', extra={'node': self.name, 'sampled': True})
+        json_response = json.loads(raw_response)
+        transaction = Transaction.from_json(json_response)
+        self.transaction_journal.append(transaction.tx_hash, json_response, received_at)
+        if not self.transaction_stream.catching_up:
+            self.mark_received(self.transaction_checkpoints(transaction))
+        return transaction.tx_hash
+
+    async def catch_up_transactions(self, seen_live: Callable[[str], bool]) -> int:
+        """Journal the transactions since the checkpoint that the stream has not delivered."""
+        def pages():
+            start_height = self.transactions_resume_height()
+            if start_height is None:
+                # Nothing processed yet, fall back to the last 12 blocks
+                start_height = self.lnd.get_block_height() - 12
+            return self.iter_raw_transaction_pages(block_height_start=start_height)
+
+        return await self.catch_up(self.transaction_journal, TRANSACTIONS_SUBCOLLECTION, await self.run_persistence(pages),
+                                   Transaction.from_json, lambda transaction: transaction.tx_hash,
+                                   self.transaction_checkpoints, seen_live)
+
+    async def refetch_transactions(self, start_height: int) -> int:
+        """Journal every transaction from `start_height` again, e.g. after a chain reorganization."""
+        pages = await self.run_persistence(self.iter_raw_transaction_pages, start_height)
+        return await self.catch_up(self.transaction_journal, TRANSACTIONS_SUBCOLLECTION, pages,
+                                   Transaction.from_json, lambda transaction: transaction.tx_hash,
+                                   self.transaction_checkpoints, lambda key: False)
+
+    # Invoices
+
+    def get_invoices(self, creation_date_start=None, index_offset=0) -> List[Invoice]:
+        invoices = list(self.iter_invoices(creation_date_start=creation_date_start, index_offset=index_offset))
+        logger.info('retrieved invoices', extra={'node': self.name, 'count': len(invoices)})
+        return invoices
+
+    def iter_invoices(self, creation_date_start=None, index_offset=0, page_size=None) -> Iterator[Invoice]:
+        """Yield invoices page by page while the next page is fetched in the background."""
+        for page in prefetched(self.iter_invoice_pages(creation_date_start, index_offset, page_size)):
+            yield from page
+
+    def iter_invoice_pages(self, creation_date_start=None, index_offset=0, page_size=None) -> Iterator[List[Invoice]]:
+        for page in self.iter_raw_invoice_pages(creation_date_start, index_offset, page_size):
+            yield [Invoice.from_json(inv) for inv in page]
+
+    def iter_raw_invoice_pages(self, creation_date_start=None, index_offset=0, page_size=None) -> Iterator[List[dict]]:
+        # Invoices with an add_index above index_offset are returned
+        num_max_invoices = page_size or self.settings.invoice_page_size
+        more_invoices = True
+
+        while more_invoices:
+            params = {
+                "index_offset": index_offset,
+                "num_max_invoices": num_max_invoices
+            }
+
+            # Add the creation_date_start filter if provided
+            if creation_date_start:
+                params["creation_date_start"] = creation_date_start
+
+            # Fetch invoices with pagination parameters
+            data = self.lnd.get_json('/v1/invoices', params=params)
+
+            # Hand out the page
+            invoices_list = data.get('invoices', [])
+            if not invoices_list:
+                break  # Exit if no more invoices are returned
+
+            yield invoices_list
+
+            # Update index_offset for pagination
+            index_offset = data.get('last_index_offset', 0)
+            more_invoices = len(invoices_list) >= num_max_invoices  # Stop if fewer results are returned
+
+    @staticmethod
+    def invoice_key(invoice: Invoice) -> str:
+        return invoice.payment_addr or invoice.r_hash
+
+    def invoice_received(self, raw_response: str, received_at: float) -> str:
+        metrics.EVENTS_RECEIVED.labels(self.name, INVOICES_SUBCOLLECTION).inc()
+        logger.debug('invoice stream new data', extra={'node': self.name, 'sampled': True})
+        json_response = json.loads(raw_response)
+        invoice = Invoice.from_json(json_response['result'])
+        key = self.invoice_key(invoice)
+        self.invoice_journal.append(key, json_response['result'], received_at)
+        if not self.invoice_stream.catching_up:
+            self.mark_received(self.invoice_checkpoints(invoice))
+        return key
+
+    async def catch_up_invoices(self, seen_live: Callable[[str], bool]) -> int:
+        # A resumed subscription replays everything since the checkpoints
+        if self.resume_checkpoint(INVOICES_ADD_INDEX) is not None:
+            return 0
+        pages = self.iter_raw_invoice_pages(creation_date_start=calculate_unix_timestamp(12))
+        return await self.catch_up(self.invoice_journal, INVOICES_SUBCOLLECTION, pages, Invoice.from_json,
+                                   self.invoice_key, self.invoice_checkpoints, seen_live)
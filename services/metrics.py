@@ -0,0 +1,42 @@
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Event counters, labelled with the stream the record belongs to ("transactions" or "invoices")
+# and, for records read from LND, the name of the node
+EVENTS_RECEIVED = Counter('lnd_events_received_total', 'Records received from LND', ['node', 'stream'])
+EVENTS_RESOLVED = Counter('lnd_events_resolved_total', 'Records resolved to at least one owner', ['stream'])
+EVENTS_UNOWNED = Counter('lnd_events_unowned_total', 'Records no user owns', ['stream'])
+EVENTS_WRITTEN = Counter('lnd_events_written_total', 'Documents queued for a Firestore write', ['stream'])
+EVENTS_COALESCED = Counter('lnd_events_coalesced_total', 'Updates superseded by a later update in the coalescing window', ['stream'])
+STREAM_RECONNECTS = Counter('lnd_stream_reconnects_total', 'Subscription stream reconnects', ['node', 'stream'])
+STREAM_IDLE_TIMEOUTS = Counter('lnd_stream_idle_timeouts_total', 'Subscription streams reopened after reading nothing for the idle timeout', ['node', 'stream'])
+STREAM_CONNECTED = Gauge('lnd_stream_connected', 'Whether the subscription stream is open', ['node', 'stream'])
+STREAM_GAP = Histogram(
+    'lnd_stream_gap_seconds', 'Time from a subscription stream ending to it being open again', ['stream'],
+    buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+
+LND_REQUEST_LATENCY = Histogram('lnd_request_latency_seconds', 'LND REST request latency', ['path'])
+OWNER_LOOKUP_LATENCY = Histogram(
+    'owner_lookup_latency_seconds', 'Address owner lookup latency',
+    buckets=(.00001, .00005, .0001, .0005, .001, .005, .01, .05, .1, .5, 1),
+)
+FIRESTORE_WRITE_LATENCY = Histogram('firestore_write_latency_seconds', 'Firestore batch commit latency')
+EVENT_PERSIST_LAG = Histogram(
+    'event_persist_lag_seconds', 'Time from receiving a record to its Firestore commit', ['collection'],
+    buckets=(.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+
+QUEUE_DEPTH = Gauge('event_queue_depth', 'Events waiting for a persistence worker', ['pipeline'])
+BACKPRESSURE_WAITS = Counter('event_queue_backpressure_waits_total', 'Submissions that waited for queue space', ['pipeline'])
+
+JOURNAL_BACKLOG = Gauge('event_journal_backlog', 'Journaled events not yet known to be persisted', ['stream'])
+JOURNAL_RETRIES = Counter('event_journal_retries_total', 'Journaled events handed on again after a failure', ['stream'])
+
+NOTIFICATION_SUBSCRIBERS = Gauge('notification_subscribers', 'Connected push clients')
+NOTIFICATIONS_PUBLISHED = Counter('notifications_published_total', 'Events published to push clients', ['event'])
+NOTIFICATION_EVICTIONS = Counter('notification_evictions_total', 'Push clients disconnected for falling behind')
+
+
+def render():
+    """Return the metrics payload and its content type for the /metrics endpoint."""
+    return generate_latest(), CONTENT_TYPE_LATEST
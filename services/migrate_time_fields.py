@@ -0,0 +1,79 @@
+"""
+One-off migration of the time fields of user documents to integers.
+
+Transaction time_stamp and invoice creation_date (services.ingestion
+TIME_FIELDS) used to be stored as LND sends them, a string, by older
+versions and with DOCUMENT_PROJECTIONS off. The activity API range-filters
+and pages on them as integers, and Firestore never compares a string with a
+number, so those documents were missing from filtered pages. This rewrites
+every string value as an integer. Firestore needs a collection group index
+on each time field. Run from the repository root:
+
+    python -m services.migrate_time_fields --dry-run
+    python -m services.migrate_time_fields
+"""
+import argparse
+import json
+import logging
+from typing import Dict
+
+from services.ingestion import BACKEND_COLLECTION, TIME_FIELDS
+
+logger = logging.getLogger(__name__)
+
+
+def migrate_time_fields(db, writer, page_size: int = 500, dry_run: bool = False) -> Dict[str, int]:
+    """Queue the integer time field of every user document storing a string, return the count per collection."""
+    counts = {}
+    for collection, name in TIME_FIELDS.items():
+        # Range filters only match values of the same type, '' and up are exactly the strings
+        query = db.collection_group(collection).where(name, '>=', '').order_by(name).limit(page_size)
+        migrated = 0
+        last = None
+        while True:
+            page = list((query.start_after(last) if last is not None else query).stream())
+            for snapshot in page:
+                if not snapshot.reference.path.startswith(BACKEND_COLLECTION + "/"):
+                    continue
+                value = (snapshot.to_dict() or {}).get(name)
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    logger.warning('time field is not a number, left alone',
+                                   extra={'path': snapshot.reference.path, 'field': name})
+                    continue
+                if not dry_run:
+                    writer.upsert(snapshot.reference, {name: value})
+                migrated += 1
+            if len(page) < page_size:
+                break
+            last = page[-1]
+        logger.info('time fields migrated', extra={'collection': collection, 'field': name, 'documents': migrated,
+                                                   'dry_run': dry_run})
+        counts[collection] = migrated
+    return counts
+
+
+def main():
+    # Imported here so the rest of the module does not depend on the app
+    from main import WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL, firestore_client
+    from services.firestore_writer import BatchWriter
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--page-size", type=int, default=500, help="documents read per query")
+    parser.add_argument("--dry-run", action="store_true", help="count the documents without writing")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db = firestore_client()
+    writer = BatchWriter(db, batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL)
+    writer.start()
+    try:
+        counts = migrate_time_fields(db, writer, page_size=args.page_size, dry_run=args.dry_run)
+    finally:
+        writer.close()
+    print(json.dumps({"migrated": counts, "failed": sorted(writer.failures), "dry_run": args.dry_run}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
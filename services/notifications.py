@@ -0,0 +1,338 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from services.ingestion import INVOICES_SUBCOLLECTION, TRANSACTIONS_SUBCOLLECTION
+from services.metrics import NOTIFICATION_EVICTIONS, NOTIFICATION_SUBSCRIBERS, NOTIFICATIONS_PUBLISHED
+
+logger = logging.getLogger(__name__)
+
+# Event types pushed to clients
+INVOICE_SETTLED = "invoice_settled"
+DEPOSIT = "deposit"
+DEPOSIT_CONFIRMED = "deposit_confirmed"
+# Sent instead of a replay when the events since Last-Event-ID are not known anymore,
+# the client has to read the current state again
+RESET = "reset"
+
+
+def _int(value) -> int:
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def events_for(collection: str, data: dict, changes: dict, owns: Callable[[str], bool]) -> List[Tuple[str, dict]]:
+    """
+    The events a written record leads to. `changes` are the fields that
+    changed since the record was last written, all of them for a new one.
+    """
+    if collection == INVOICES_SUBCOLLECTION:
+        if "state" in changes and data.get("state") == "SETTLED":
+            return [(INVOICE_SETTLED, {
+                "payment_addr": data.get("payment_addr"),
+                "r_hash": data.get("r_hash"),
+                "amt_paid_sat": _int(data.get("amt_paid_sat")),
+                "settle_date": _int(data.get("settle_date")),
+            })]
+        return []
+    if collection != TRANSACTIONS_SUBCOLLECTION:
+        return []
+    # tx_hash never changes, so it is only among the changes of a new transaction
+    new = "tx_hash" in changes
+    mined = "block_height" in changes and _int(data.get("block_height")) > 0
+    if not new and not mined:
+        return []
+    payload = {
+        "tx_hash": data.get("tx_hash"),
+        "amount": sum(_int(output.get("amount")) for output in data.get("output_details") or []
+                      if output.get("is_our_address") and owns(output.get("address"))),
+        "num_confirmations": _int(data.get("num_confirmations")),
+        "block_height": _int(data.get("block_height")),
+    }
+    events = []
+    if new:
+        events.append((DEPOSIT, payload))
+    if mined:
+        events.append((DEPOSIT_CONFIRMED, payload))
+    return events
+
+
+def event_time(collection: str, data: dict) -> int:
+    """When the event of a record happened, as LND reports it."""
+    if collection == INVOICES_SUBCOLLECTION:
+        return _int(data.get("settle_date"))
+    return _int(data.get("time_stamp"))
+
+
+class NotificationLog:
+    """
+    SQLite record of the events already published per user and record, so
+    the same record written again (a restart backfill, a stream catch-up or
+    a reorg refetch) does not notify its user twice.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS notified (user_id TEXT NOT NULL, event TEXT NOT NULL, "
+                           "record_id TEXT NOT NULL, notified_at REAL NOT NULL, PRIMARY KEY (user_id, event, record_id))")
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def mark(self, user_id: str, event: str, record_id: str) -> bool:
+        """Remember an event of a record, return False if it was published before."""
+        with self._lock:
+            cursor = self._conn.execute("INSERT OR IGNORE INTO notified (user_id, event, record_id, notified_at) "
+                                        "VALUES (?, ?, ?, ?)", (user_id, event, record_id, time.time()))
+            self._conn.commit()
+        return cursor.rowcount == 1
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+@dataclass
+class Notification:
+    id: str
+    seq: int
+    event: str
+    data: dict
+    # Encoded once, however many clients it goes to
+    _frame: Optional[bytes] = field(default=None, repr=False, compare=False)
+
+    def encode(self) -> bytes:
+        """The notification as a server-sent event."""
+        if self._frame is None:
+            data = json.dumps(self.data, separators=(',', ':'))
+            self._frame = f"id: {self.id}\nevent: {self.event}\ndata: {data}\n\n".encode()
+        return self._frame
+
+
+class Subscription:
+    """One connected client. `None` in the queue means the hub closed it."""
+
+    def __init__(self, user_id: str, buffer_size: int):
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=buffer_size + 1)
+        self.buffer_size = buffer_size
+        self.closed_reason: Optional[str] = None
+
+
+class _UserHistory:
+    def __init__(self, complete_after: int, size: int):
+        self.events: Deque[Notification] = deque(maxlen=size)
+        # Every event of the user with a seq above this is in `events`
+        self.complete_after = complete_after
+
+
+class NotificationHub:
+    """
+    In-process pub/sub of per-user events for the push endpoint.
+
+    The ingestion path publishes from the persistence threads, delivery to
+    the subscribers of a user happens on the event loop. Every subscriber
+    has a queue of at most `buffer_size` events. A subscriber that falls
+    that far behind is evicted instead of holding events for it without
+    bound: its queue is cleared and closed, and the client is expected to
+    reconnect with the id of the last event it received.
+
+    The last `history_size` events of each user are kept, for at most
+    `max_history_users` users, so a reconnecting client gets what it missed.
+    Event ids are "{instance}-{seq}" and only meaningful to the hub that
+    issued them. If the events after an id are not all known anymore (or
+    the id comes from another process or a previous period of ingesting)
+    the client gets a `reset` event and has to read its state again.
+
+    Only the process that ingests publishes, so the hub is only enabled
+    between `start` and `stop`.
+
+    Records are written again after restarts, catch-ups and reorgs, with
+    changes that only look new to the fingerprint cache. With a `log`
+    (`NotificationLog`) every event of a record is published once, and
+    events that happened more than `max_event_age` seconds ago are only
+    remembered, so history seen for the first time is not pushed either.
+    """
+
+    def __init__(self, buffer_size: int = 256, history_size: int = 100, max_history_users: int = 10000,
+                 max_subscribers: int = 10000, log: Optional[NotificationLog] = None,
+                 max_event_age: Optional[float] = None):
+        self.buffer_size = buffer_size
+        self.history_size = history_size
+        self.max_history_users = max_history_users
+        self.max_subscribers = max_subscribers
+        self.log = log
+        self.max_event_age = max_event_age
+        self.enabled = False
+        self.instance = ""
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # Published events waiting for the event loop, drained by one callback per wakeup
+        self._inbox: List[Tuple[str, str, dict]] = []
+        self._inbox_lock = threading.Lock()
+        self._seq = 0
+        self._subscribers: Dict[str, Set[Subscription]] = {}
+        self._subscriber_count = 0
+        self._history: "OrderedDict[str, _UserHistory]" = OrderedDict()
+        # Events up to this seq may be missing from the history of users without one
+        self._forgotten_up_to = 0
+
+    def start(self):
+        """Enable publishing, called on the event loop. Earlier event ids are not resumable."""
+        self._loop = asyncio.get_running_loop()
+        self.instance = os.urandom(4).hex()
+        self._seq = 0
+        self._history.clear()
+        self._forgotten_up_to = 0
+        self.enabled = True
+
+    def stop(self):
+        """Disable publishing and disconnect every subscriber, called on the event loop."""
+        self.enabled = False
+        for subscriptions in list(self._subscribers.values()):
+            for subscription in list(subscriptions):
+                self._close(subscription, 'stopped')
+
+    def notify(self, user_id: str, collection: str, data: dict, changes: dict, owns: Callable[[str], bool]):
+        """Publish the events of a record written for `user_id`, from any thread."""
+        if not self.enabled:
+            return
+        events = events_for(collection, data, changes, owns)
+        if not events:
+            return
+        # A transaction broadcast long ago may be mined just now, only its first sighting can be history
+        old = self.max_event_age is not None and event_time(collection, data) < time.time() - self.max_event_age
+        stale = old and (collection == INVOICES_SUBCOLLECTION or any(event == DEPOSIT for event, _ in events))
+        record_id = data.get("payment_addr") if collection == INVOICES_SUBCOLLECTION else data.get("tx_hash")
+        for event, payload in events:
+            if self.log is not None and record_id and not self.log.mark(user_id, event, record_id):
+                continue
+            if not stale:
+                self.publish(user_id, event, payload)
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+
+    def publish(self, user_id: str, event: str, data: dict):
+        """Publish an event to the subscribers of `user_id`, from any thread."""
+        if not self.enabled or self._loop is None:
+            return
+        with self._inbox_lock:
+            self._inbox.append((user_id, event, data))
+            wake = len(self._inbox) == 1
+        if wake:
+            self._loop.call_soon_threadsafe(self._drain_inbox)
+
+    def subscribe(self, user_id: str, last_event_id: Optional[str] = None) -> Subscription:
+        """
+        Subscribe to the events of `user_id`, called on the event loop. With a
+        `last_event_id` the events after it are queued first, or a reset event.
+        """
+        if self._subscriber_count >= self.max_subscribers:
+            raise OverflowError("Too many subscribers")
+        subscription = Subscription(user_id, self.buffer_size)
+        if last_event_id:
+            for notification in self._missed(user_id, last_event_id):
+                subscription.queue.put_nowait(notification)
+        self._subscribers.setdefault(user_id, set()).add(subscription)
+        self._subscriber_count += 1
+        NOTIFICATION_SUBSCRIBERS.set(self._subscriber_count)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self._subscribers.get(subscription.user_id)
+        if subscriptions is None or subscription not in subscriptions:
+            return
+        subscriptions.discard(subscription)
+        if not subscriptions:
+            del self._subscribers[subscription.user_id]
+        self._subscriber_count -= 1
+        NOTIFICATION_SUBSCRIBERS.set(self._subscriber_count)
+
+    def subscriber_count(self) -> int:
+        return self._subscriber_count
+
+    def _missed(self, user_id: str, last_event_id: str) -> List[Notification]:
+        instance, _, seq = last_event_id.partition("-")
+        history = self._history.get(user_id)
+        complete_after = history.complete_after if history else self._forgotten_up_to
+        if instance != self.instance or not seq.isdigit() or int(seq) < complete_after:
+            return [Notification(f"{self.instance}-{self._seq}", self._seq, RESET, {})]
+        last_seq = int(seq)
+        return [notification for notification in (history.events if history else ())
+                if notification.seq > last_seq][-self.buffer_size:]
+
+    def _drain_inbox(self):
+        with self._inbox_lock:
+            published, self._inbox = self._inbox, []
+        if not self.enabled:
+            return
+        for user_id, event, data in published:
+            self._deliver(user_id, event, data)
+
+    def _deliver(self, user_id: str, event: str, data: dict):
+        self._seq += 1
+        notification = Notification(f"{self.instance}-{self._seq}", self._seq, event, data)
+        NOTIFICATIONS_PUBLISHED.labels(event).inc()
+        self._remember(user_id, notification)
+        for subscription in list(self._subscribers.get(user_id, ())):
+            if subscription.queue.qsize() >= subscription.buffer_size:
+                NOTIFICATION_EVICTIONS.inc()
+                logger.info('evicting slow notification subscriber', extra={'user_id': user_id})
+                self._close(subscription, 'slow_consumer')
+            else:
+                subscription.queue.put_nowait(notification)
+
+    def _remember(self, user_id: str, notification: Notification):
+        history = self._history.get(user_id)
+        if history is None:
+            history = self._history[user_id] = _UserHistory(self._forgotten_up_to, self.history_size)
+        self._history.move_to_end(user_id)
+        if len(history.events) == history.events.maxlen:
+            history.complete_after = history.events[0].seq
+        history.events.append(notification)
+        while len(self._history) > self.max_history_users:
+            self._history.popitem(last=False)
+            # A user without history may have had events up to now
+            self._forgotten_up_to = notification.seq
+
+    def _close(self, subscription: Subscription, reason: str):
+        subscription.closed_reason = reason
+        self.unsubscribe(subscription)
+        while not subscription.queue.empty():
+            subscription.queue.get_nowait()
+        subscription.queue.put_nowait(None)
+
+
+async def event_stream(hub: NotificationHub, subscription: Subscription, keepalive: float = 15.0,
+                       retry_ms: int = 1000) -> AsyncIterator[bytes]:
+    """Server-sent events for `subscription` until the hub closes it or the client goes away."""
+    try:
+        # Clients reconnect after `retry_ms` and send the id of the last event they got
+        yield f"retry: {retry_ms}\n\n".encode()
+        while True:
+            try:
+                notification = await asyncio.wait_for(subscription.queue.get(), keepalive)
+            except asyncio.TimeoutError:
+                # Keeps proxies from closing an idle connection
+                yield b": keepalive\n\n"
+                continue
+            if notification is None:
+                return
+            yield notification.encode()
+    finally:
+        hub.unsubscribe(subscription)
@@ -0,0 +1,51 @@
+import queue
+import threading
+from typing import Iterable, Iterator, TypeVar
+
+T = TypeVar('T')
+
+_END = object()
+
+
+def prefetched(pages: Iterable[T], depth: int = 1) -> Iterator[T]:
+    """
+    Yield items of `pages` while a background thread fetches up to `depth` items ahead.
+
+    Used with page iterators so the next page is already in flight while the
+    current one is being processed. Exceptions raised by `pages` are re-raised
+    in the consumer.
+    """
+    buffer: queue.Queue = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch():
+        try:
+            for page in pages:
+                if not put((page, None)):
+                    return
+        except BaseException as e:
+            put((_END, e))
+            return
+        put((_END, None))
+
+    thread = threading.Thread(target=fetch, name='page-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            page, error = buffer.get()
+            if page is _END:
+                if error is not None:
+                    raise error
+                return
+            yield page
+    finally:
+        stopped.set()
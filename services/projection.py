@@ -0,0 +1,230 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from services.ingestion import (BACKEND_COLLECTION, BLOB_FIELD, BLOBS_COLLECTION, INVOICES_SUBCOLLECTION,
+                                TRANSACTIONS_SUBCOLLECTION)
+
+logger = logging.getLogger(__name__)
+
+# Values left out of hot documents. False and 0 are kept, they are filtered on.
+OMITTED_VALUES = (None, "", [], {})
+
+
+def _to_int(value):
+    # LND encodes 64-bit integers as strings
+    if isinstance(value, str):
+        try:
+            return int(value)
+        except ValueError:
+            return value
+    return value
+
+
+@dataclass(frozen=True)
+class Projection:
+    """
+    How a record is split into the document written for a user and the
+    bulky fields kept in the blob store.
+
+    `bulky_fields` move to the blob, `int_fields` are stored as integers
+    and `nested_int_fields` maps a list of objects (e.g. output_details) to
+    the integer fields of its items. Values in OMITTED_VALUES are left out
+    of the hot document when `omit_empty` is set, `omitted` names them so
+    a stored document that still has them can be cleared. The bulky fields
+    are stored zlib compressed at `compress_level`.
+    """
+    bulky_fields: Tuple[str, ...] = ()
+    int_fields: Tuple[str, ...] = ()
+    nested_int_fields: Dict[str, Tuple[str, ...]] = field(default_factory=dict)
+    omit_empty: bool = True
+    compress_level: int = 6
+
+    def split(self, data: dict) -> Tuple[dict, dict]:
+        """Return the hot document and the bulky fields of `data`."""
+        hot = {}
+        bulky = {}
+        for name, value in data.items():
+            if name in self.bulky_fields:
+                if value not in OMITTED_VALUES:
+                    bulky[name] = value
+                continue
+            if self.omit_empty and value in OMITTED_VALUES:
+                continue
+            if name in self.int_fields:
+                value = _to_int(value)
+            elif name in self.nested_int_fields and isinstance(value, list):
+                names = self.nested_int_fields[name]
+                value = [{key: _to_int(item) if key in names else item for key, item in entry.items()}
+                         if isinstance(entry, dict) else entry for entry in value]
+            hot[name] = value
+        return hot, bulky
+
+    def omitted(self, data: dict) -> List[str]:
+        """The hot fields of `data` that `split` leaves out because they are empty."""
+        if not self.omit_empty:
+            return []
+        return [name for name, value in data.items() if name not in self.bulky_fields and value in OMITTED_VALUES]
+
+    def encode(self, bulky: dict) -> Tuple[str, bytes]:
+        return encode_blob(bulky, self.compress_level)
+
+
+DEFAULT_PROJECTIONS = {
+    TRANSACTIONS_SUBCOLLECTION: Projection(
+        bulky_fields=("raw_tx_hex", "previous_outpoints", "dest_addresses"),
+        int_fields=("amount", "total_fees", "time_stamp"),
+        nested_int_fields={"output_details": ("amount", "output_index")},
+    ),
+    INVOICES_SUBCOLLECTION: Projection(
+        bulky_fields=("htlcs", "route_hints", "payment_request", "features", "amp_invoice_state",
+                      "blinded_path_config"),
+        int_fields=("value", "value_msat", "amt_paid", "amt_paid_sat", "amt_paid_msat"),
+    ),
+}
+
+
+def blob_digest(encoded: bytes) -> str:
+    return hashlib.blake2b(encoded, digest_size=16).hexdigest()
+
+
+def encode_blob(bulky: dict, level: int = 6) -> Tuple[str, bytes]:
+    """Digest of the bulky fields and their compressed encoding."""
+    encoded = json.dumps(bulky, sort_keys=True, separators=(',', ':')).encode()
+    return blob_digest(encoded), zlib.compress(encoded, level)
+
+
+def decode_blob(compressed: bytes) -> dict:
+    return json.loads(zlib.decompress(compressed))
+
+
+class BlobStore:
+    """
+    Content-addressed store of compressed bulky fields in
+    blobs/{digest}, written through the batch writer.
+
+    A blob never changes once written, so identical bulky fields are stored
+    once and a blob written recently is not queued again. `get` reads a blob
+    on demand, the last `max_cached` written or read are kept compressed.
+
+    A document that is written again with other bulky fields references a
+    new blob and the old one may be left behind, `collect` deletes those.
+    Reference checks query the `blob` field of every transaction and invoice
+    document, Firestore needs a collection group index on it.
+    """
+
+    def __init__(self, db, writer, max_cached: int = 10000):
+        self._db = db
+        self._writer = writer
+        self._max_cached = max_cached
+        # digest -> compressed fields
+        self._cached: "OrderedDict[str, bytes]" = OrderedDict()
+        # digest -> time of the last `put` of a cached blob, written or not
+        self._put_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def put(self, digest: str, compressed: bytes, received_at: Optional[float] = None):
+        """Queue the write of a blob made by `encode_blob`, unless it was written recently."""
+        with self._lock:
+            if digest in self._cached:
+                self._cached.move_to_end(digest)
+                self._put_at[digest] = time.time()
+                return
+            self._remember(digest, compressed)
+            self._put_at[digest] = time.time()
+        # written_at changes the stored blob on every write, see `collect`
+        self._writer.upsert(self._ref(digest), {"data": compressed, "size": len(compressed), "written_at": time.time()},
+                            received_at=received_at)
+
+    def get(self, digest: str) -> Optional[dict]:
+        with self._lock:
+            compressed = self._cached.get(digest)
+            if compressed is not None:
+                self._cached.move_to_end(digest)
+        if compressed is None:
+            snapshot = self._ref(digest).get()
+            if not snapshot.exists:
+                return None
+            compressed = (snapshot.to_dict() or {})["data"]
+            with self._lock:
+                self._remember(digest, compressed)
+        return decode_blob(compressed)
+
+    def referenced(self, digest: str, user_id: Optional[str] = None) -> bool:
+        """Whether a document of `user_id`, or of anyone, references blob `digest`."""
+        for collection in (TRANSACTIONS_SUBCOLLECTION, INVOICES_SUBCOLLECTION):
+            if user_id is None:
+                documents = self._db.collection_group(collection)
+            else:
+                documents = self._db.collection(BACKEND_COLLECTION).document(user_id).collection(collection)
+            if list(documents.where(BLOB_FIELD, '==', digest).select([]).limit(1).stream()):
+                return True
+        return False
+
+    def collect(self, min_age: float, page_size: int = 500) -> int:
+        """
+        Delete the blobs written more than `min_age` seconds ago that no
+        document references, return how many.
+
+        Blobs put within `min_age`, even when not written again, are kept:
+        their document may still be queued. Candidates are dropped from the
+        cache and the queued writes flushed, so a document referencing one is
+        either committed before the check or makes `put` write the blob
+        again. The delete is conditional on the blob being unchanged since it
+        was read, which `written_at` makes true of any later write.
+        """
+        # Imported here like the rest of the Firebase SDK, see main.firestore_client
+        from google.api_core.exceptions import FailedPrecondition
+
+        query = self._db.collection(BLOBS_COLLECTION).select(["written_at"]).order_by("__name__").limit(page_size)
+        deleted = 0
+        last = None
+        while True:
+            page = list((query.start_after(last) if last is not None else query).stream())
+            written_before = time.time() - min_age
+            with self._lock:
+                candidates = [snapshot for snapshot in page
+                              if ((snapshot.to_dict() or {}).get("written_at") or 0) < written_before
+                              and self._put_at.get(snapshot.id, 0) < written_before]
+                for snapshot in candidates:
+                    self._cached.pop(snapshot.id, None)
+                    self._put_at.pop(snapshot.id, None)
+            if candidates:
+                self._writer.flush()
+            for snapshot in candidates:
+                if self.referenced(snapshot.id):
+                    continue
+                try:
+                    snapshot.reference.delete(option=self._db.write_option(last_update_time=snapshot.update_time))
+                except FailedPrecondition:
+                    continue
+                deleted += 1
+            if len(page) < page_size:
+                break
+            last = page[-1]
+        logger.info('orphaned blobs deleted', extra={'blobs': deleted})
+        return deleted
+
+    def forget(self, path: str):
+        """Called when the write of document `path` failed, so a blob there is written again."""
+        collection, _, digest = path.partition("/")
+        if collection == BLOBS_COLLECTION:
+            with self._lock:
+                self._cached.pop(digest, None)
+                self._put_at.pop(digest, None)
+
+    def _remember(self, digest: str, compressed: bytes):
+        self._cached[digest] = compressed
+        self._cached.move_to_end(digest)
+        while len(self._cached) > self._max_cached:
+            digest, _ = self._cached.popitem(last=False)
+            self._put_at.pop(digest, None)
+
+    def _ref(self, digest: str):
+        return self._db.collection(BLOBS_COLLECTION).document(digest)
@@ -0,0 +1,412 @@
+"""
+Consistency check of the user documents in Firestore against LND.
+
+Every transaction and invoice of the LND nodes is resolved to its owners and
+turned into the document the ingestion path would write. These expected
+documents are spilled to SQLite by user and document id. A pool of workers
+then takes the users one at a time and merges their expected documents with
+the stored ones, both in document id order, comparing content digests.
+Only missing documents and the fields that differ are written, and every
+difference goes to a JSON lines report. Repairs bypass the aggregates, so
+POST /aggregates/reconcile afterwards if anything was written. Run from the
+repository root, next to a running service if need be:
+
+    python -m services.reconcile --report ./state/reconcile.jsonl
+    python -m services.reconcile --dry-run --workers 16
+"""
+import argparse
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from services.chain import (CHAIN_COLLECTION, CHAIN_TIP_DOCUMENT, CONFIRMATION_FIELD, CONFIRMED, FINAL, UNCONFIRMED,
+                            confirmation_state)
+from services.fingerprints import field_digest
+from services.ingestion import BACKEND_COLLECTION, BLOB_FIELD, INVOICES_SUBCOLLECTION, TRANSACTIONS_SUBCOLLECTION
+from services.paging import prefetched
+
+logger = logging.getLogger(__name__)
+
+# Outcomes of the comparison of one document
+MISSING = "missing"
+DIVERGENT = "divergent"
+# Stored but not in LND, reported and left alone
+EXTRA = "extra"
+# Stored state further along than the LND snapshot, written by the streams meanwhile
+SKIPPED = "skipped"
+
+COLLECTIONS = (TRANSACTIONS_SUBCOLLECTION, INVOICES_SUBCOLLECTION)
+
+# How far along a record is, the reconciler never moves a document back
+CONFIRMATION_PROGRESS = {UNCONFIRMED: 0, CONFIRMED: 1, FINAL: 2}
+INVOICE_PROGRESS = {"OPEN": 0, "ACCEPTED": 1, "SETTLED": 2, "CANCELED": 2}
+
+
+def _int(value) -> int:
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def progress(collection: str, data: dict) -> Tuple[int, int]:
+    if collection == TRANSACTIONS_SUBCOLLECTION:
+        return int(_int(data.get("block_height")) > 0), CONFIRMATION_PROGRESS.get(data.get(CONFIRMATION_FIELD), 0)
+    return INVOICE_PROGRESS.get(data.get("state"), 0), 0
+
+
+@dataclass
+class ReconcileReport:
+    state: str = 'pending'  # pending, collecting, comparing, done or failed
+    lnd_records: int = 0
+    users: int = 0
+    compared: int = 0
+    matched: int = 0
+    missing: int = 0
+    divergent: int = 0
+    extra: int = 0
+    skipped: int = 0
+    written: int = 0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+
+    def to_json(self) -> dict:
+        return {
+            "state": self.state,
+            "lnd_records": self.lnd_records,
+            "users": self.users,
+            "compared": self.compared,
+            "matched": self.matched,
+            "missing": self.missing,
+            "divergent": self.divergent,
+            "extra": self.extra,
+            "skipped": self.skipped,
+            "written": self.written,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error,
+        }
+
+
+@dataclass
+class ExpectedDocument:
+    document_id: str
+    # Digest of the compared fields
+    digest: str
+    data: dict
+    blob: Optional[Tuple[str, bytes]]
+
+
+class ExpectedStore:
+    """
+    SQLite spill of the expected documents, so a large ledger is merged one
+    user at a time in document id order without holding it in memory.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self._conn = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS expected (user_id TEXT NOT NULL, collection TEXT NOT NULL, "
+                           "document_id TEXT NOT NULL, digest TEXT NOT NULL, data TEXT NOT NULL, "
+                           "blob_digest TEXT, blob BLOB, PRIMARY KEY (user_id, collection, document_id))")
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def put_many(self, rows: List[Tuple[str, str, ExpectedDocument]]):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO expected (user_id, collection, document_id, digest, data, blob_digest, blob) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(user_id, collection, expected.document_id, expected.digest, json.dumps(expected.data),
+                  expected.blob[0] if expected.blob else None, expected.blob[1] if expected.blob else None)
+                 for user_id, collection, expected in rows])
+            self._conn.commit()
+
+    def users(self) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute("SELECT DISTINCT user_id FROM expected ORDER BY user_id")]
+
+    def documents(self, user_id: str, collection: str) -> List[ExpectedDocument]:
+        """The expected documents of a user's collection in document id order."""
+        with self._lock:
+            rows = self._conn.execute("SELECT document_id, digest, data, blob_digest, blob FROM expected "
+                                      "WHERE user_id = ? AND collection = ? ORDER BY document_id",
+                                      (user_id, collection)).fetchall()
+        return [ExpectedDocument(document_id, digest, json.loads(data), (blob_digest, blob) if blob_digest else None)
+                for document_id, digest, data, blob_digest, blob in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class Reconciler:
+    """
+    Merge-diff of the documents LND's records should be stored as against
+    the stored user documents, repairing the difference.
+
+    `collect` pages through every record of `nodes` and spills the expected
+    documents, built with the `ingestor`'s owner resolution and projections.
+    With `final_confirmations` set, transactions carry the confirmation
+    milestone at the tip in chain/tip as the streams write them (see
+    services.chain), otherwise num_confirmations is not compared since it
+    changes with every block.
+
+    `compare` reads the stored documents of every user in pages of
+    `page_size`, `workers` users at a time. A document that matches costs
+    one read and no write. Missing documents are written in full, divergent
+    ones only with the fields that differ, both through `writer` unless
+    `dry_run`. The reconciler runs next to the live streams: it only adds
+    and merges, and leaves documents alone whose stored state is further
+    along than the LND snapshot. Every difference is passed to `on_diff`.
+    """
+
+    def __init__(self, db, writer, ingestor, expected: ExpectedStore, blobs=None,
+                 final_confirmations: Optional[int] = None, page_size: int = 500, dry_run: bool = False,
+                 on_diff: Optional[Callable[[dict], None]] = None):
+        self._db = db
+        self._writer = writer
+        self._ingestor = ingestor
+        self._expected = expected
+        self._blobs = blobs
+        self.final_confirmations = final_confirmations
+        self.page_size = page_size
+        self.dry_run = dry_run
+        self.on_diff = on_diff
+        self.tip_height: Optional[int] = None
+        self.report = ReconcileReport()
+        self._lock = threading.Lock()
+
+    def run(self, nodes, workers: int = 8) -> ReconcileReport:
+        report = self.report = ReconcileReport(started_at=time.time())
+        try:
+            report.state = 'collecting'
+            self.collect(nodes)
+            report.state = 'comparing'
+            self.compare(workers)
+        except Exception as e:
+            report.state = 'failed'
+            report.error = repr(e)
+            raise
+        else:
+            report.state = 'done'
+        finally:
+            report.finished_at = time.time()
+            if self._writer is not None:
+                self._writer.flush()
+        return report
+
+    def collect(self, nodes):
+        """Spill the expected documents of every record of `nodes`."""
+        if self.final_confirmations is not None:
+            # The tip the streams last wrote milestones for
+            tip = self._db.collection(CHAIN_COLLECTION).document(CHAIN_TIP_DOCUMENT).get().to_dict() or {}
+            self.tip_height = tip.get("block_height")
+        ingestor = self._ingestor
+        for node in nodes:
+            count = 0
+            for page in prefetched(node.iter_transaction_pages()):
+                self._spill(TRANSACTIONS_SUBCOLLECTION, ((transaction.tx_hash, transaction.to_json(),
+                                                          ingestor.resolve_transaction_owners(transaction))
+                                                         for transaction in page))
+                count += len(page)
+            for page in prefetched(node.iter_invoice_pages()):
+                self._spill(INVOICES_SUBCOLLECTION, ((invoice.payment_addr, invoice.to_json(),
+                                                      ingestor.resolve_invoice_owners(invoice))
+                                                     for invoice in page))
+                count += len(page)
+            self.report.lnd_records += count
+            logger.info('reconcile collected lnd records', extra={'node': node.name, 'records': count})
+
+    def compare(self, workers: int = 8):
+        """Compare and repair the documents of every user with expected documents."""
+        users = self._expected.users()
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='reconcile') as executor:
+            for _ in executor.map(self.reconcile_user, users):
+                pass
+
+    def reconcile_user(self, user_id: str):
+        counts: Dict[str, int] = {MISSING: 0, DIVERGENT: 0, EXTRA: 0, SKIPPED: 0, "matched": 0, "written": 0}
+        for collection in COLLECTIONS:
+            expected = iter(self._expected.documents(user_id, collection))
+            stored = self.iter_stored(user_id, collection)
+            for status, document_id, want, fields in self.merge(collection, expected, stored):
+                counts[status] += 1
+                if status == "matched":
+                    continue
+                if fields and self._repair(user_id, collection, document_id, fields, want.blob, counts):
+                    counts["written"] += 1
+                self._diff({"user_id": user_id, "collection": collection, "document_id": document_id,
+                            "status": status, "fields": sorted(fields) if status == DIVERGENT else []})
+        with self._lock:
+            report = self.report
+            report.users += 1
+            report.matched += counts["matched"]
+            report.missing += counts[MISSING]
+            report.divergent += counts[DIVERGENT]
+            report.extra += counts[EXTRA]
+            report.skipped += counts[SKIPPED]
+            report.written += counts["written"]
+            report.compared += counts["matched"] + counts[DIVERGENT] + counts[SKIPPED]
+        if counts[MISSING] or counts[DIVERGENT]:
+            logger.info('reconciled user', extra={'user_id': user_id, **counts})
+
+    def merge(self, collection: str, expected: Iterator[ExpectedDocument],
+              stored: Iterator[Tuple[str, dict]]) -> Iterator[Tuple[str, str, Optional[ExpectedDocument], Optional[dict]]]:
+        """
+        Yield (status, document_id, expected document, fields to write) for
+        two iterators in document id order, with status "matched" for the
+        documents that need nothing.
+        """
+        want = next(expected, None)
+        have = next(stored, None)
+        while want is not None or have is not None:
+            if have is None or (want is not None and want.document_id < have[0]):
+                yield MISSING, want.document_id, want, dict(want.data)
+                want = next(expected, None)
+            elif want is None or have[0] < want.document_id:
+                yield EXTRA, have[0], None, None
+                have = next(stored, None)
+            else:
+                status, fields = self.diff(collection, want, have[1])
+                yield status, want.document_id, want, fields
+                want = next(expected, None)
+                have = next(stored, None)
+
+    def diff(self, collection: str, expected: ExpectedDocument, stored: dict) -> Tuple[str, Optional[dict]]:
+        """Status of a stored document and the fields to write to it, if any."""
+        compared = self.compared_fields(expected.data)
+        if field_digest({name: stored.get(name) for name in compared}) == expected.digest:
+            return "matched", None
+        if progress(collection, stored) > progress(collection, expected.data):
+            return SKIPPED, None
+        return DIVERGENT, {name: expected.data[name] for name in compared
+                           if field_digest(stored.get(name)) != field_digest(expected.data[name])}
+
+    def iter_stored(self, user_id: str, collection: str) -> Iterator[Tuple[str, dict]]:
+        """The stored documents of a user's collection in document id order, read in pages."""
+        ref = self._db.collection(BACKEND_COLLECTION).document(user_id).collection(collection)
+        query = ref.order_by('__name__').limit(self.page_size)
+        while True:
+            snapshots = list(query.stream())
+            for snapshot in snapshots:
+                yield snapshot.id, snapshot.to_dict() or {}
+            if len(snapshots) < self.page_size:
+                return
+            query = ref.order_by('__name__').start_after(snapshots[-1]).limit(self.page_size)
+
+    def expected_document(self, collection: str, document_id: str, data: dict) -> ExpectedDocument:
+        document, blob = self._ingestor.project(collection, data)
+        if collection == TRANSACTIONS_SUBCOLLECTION and self.final_confirmations is not None:
+            document = {name: value for name, value in document.items() if name != "num_confirmations"}
+            document[CONFIRMATION_FIELD] = confirmation_state(_int(document.get("block_height")), self.tip_height,
+                                                              self.final_confirmations)
+        digest = field_digest({name: document[name] for name in self.compared_fields(document)})
+        return ExpectedDocument(document_id, digest, document, blob)
+
+    def compared_fields(self, document: dict) -> List[str]:
+        if self.final_confirmations is None:
+            return [name for name in document if name != "num_confirmations"]
+        return list(document)
+
+    def _spill(self, collection: str, records: Iterable[Tuple[str, dict, List[str]]]):
+        rows = []
+        for document_id, data, owners in records:
+            if not owners or not document_id:
+                continue
+            expected = self.expected_document(collection, document_id, data)
+            rows.extend((user_id, collection, expected) for user_id in owners)
+        if rows:
+            self._expected.put_many(rows)
+
+    def _repair(self, user_id: str, collection: str, document_id: str, fields: dict,
+                blob: Optional[Tuple[str, bytes]], counts: dict) -> bool:
+        if self.dry_run or self._writer is None:
+            return False
+        user_ref = self._db.collection(BACKEND_COLLECTION).document(user_id)
+        if counts["written"] == 0:
+            # Make sure the parent user document exists, like the ingestion path
+            self._writer.upsert(user_ref, {})
+        if blob is not None and BLOB_FIELD in fields and self._blobs is not None:
+            # Queued before the document that references it
+            self._blobs.put(*blob)
+        self._writer.upsert(user_ref.collection(collection).document(document_id), fields)
+        return True
+
+    def _diff(self, entry: dict):
+        if self.on_diff is not None:
+            with self._lock:
+                self.on_diff(entry)
+
+
+def main():
+    # Imported here so the rest of the module does not depend on the app
+    from main import (BLOB_CACHE_SIZE, DERIVED_CONFIRMATIONS, DOCUMENT_PROJECTIONS, FINAL_CONFIRMATIONS,
+                      WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL, firestore_client, node_configs, node_settings)
+    from services.address_index import AddressIndex
+    from services.checkpoints import CheckpointStore
+    from services.firestore_writer import BatchWriter
+    from services.ingestion import BTC_ADDRESSES_COLLECTION, Ingestor
+    from services.journal import EventJournal
+    from services.lnd_node import LndNode
+    from services.projection import DEFAULT_PROJECTIONS, BlobStore
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=8, help="users compared at a time")
+    parser.add_argument("--page-size", type=int, default=500, help="stored documents read per query")
+    parser.add_argument("--report", help="JSON lines file every difference is written to")
+    parser.add_argument("--dry-run", action="store_true", help="report the differences without writing")
+    parser.add_argument("--ready-timeout", type=float, default=60.0, help="seconds to wait for the address index")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    db = firestore_client()
+    address_index = AddressIndex(db, BTC_ADDRESSES_COLLECTION)
+    address_index.start()
+    if not address_index.wait_ready(args.ready_timeout):
+        logger.warning('address index not ready yet, falling back to owner queries')
+    writer = BatchWriter(db, batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL)
+    writer.start()
+    blobs = BlobStore(db, writer, max_cached=BLOB_CACHE_SIZE)
+    # Only owner lookup and projections are used, repairs go through `writer`
+    ingestor = Ingestor(db, address_index, writer=None, fingerprints=None,
+                        projections=DEFAULT_PROJECTIONS if DOCUMENT_PROJECTIONS else None, blobs=blobs)
+    spill_fd, spill_path = tempfile.mkstemp(prefix="reconcile-", suffix=".db")
+    os.close(spill_fd)
+    expected = ExpectedStore(spill_path)
+    report_file = open(args.report, "w") if args.report else None
+    reconciler = Reconciler(db, writer, ingestor, expected, blobs=blobs,
+                            final_confirmations=FINAL_CONFIRMATIONS if DERIVED_CONFIRMATIONS else None,
+                            page_size=args.page_size, dry_run=args.dry_run,
+                            on_diff=(lambda entry: report_file.write(json.dumps(entry) + "\n")) if report_file else None)
+    # The nodes are never started, only their paging is used
+    checkpoints = CheckpointStore(":memory:")
+    journal = EventJournal(":memory:")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        nodes = [LndNode(config, node_settings(), ingestor, checkpoints, executor, journal) for config in node_configs()]
+        try:
+            report = reconciler.run(nodes, workers=args.workers)
+            print(json.dumps(report.to_json(), indent=2))
+        finally:
+            for node in nodes:
+                node.lnd.close()
+            writer.close()
+            expected.close()
+            os.remove(spill_path)
+            if report_file is not None:
+                report_file.close()
+            checkpoints.close()
+            address_index.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Finance reports over the Parquet ledger written by services.ledger, computed
+as columnar aggregations with pyarrow.compute instead of folding records in
+Python.
+
+Every report first keeps the latest row of each record (rows are appended
+again when a record changes), then aggregates over whole columns. Date and
+user filters are applied to the partition directories, so only the files
+they select are read. Run from the repository root:
+
+    python -m services.reporting fees --ledger ./state/ledger
+    python -m services.reporting volume --from 2024-05-01 --to 2024-05-31
+    python -m services.reporting balances --user alice --user bob
+"""
+import argparse
+import os
+import sys
+from typing import Iterable, Optional
+
+from services.ingestion import INVOICES_SUBCOLLECTION, TRANSACTIONS_SUBCOLLECTION
+from services.ledger import LEDGER_KEYS, LEDGER_USER_BUCKETS, latest, ledger_schema, pyarrow_modules, user_bucket
+
+
+def load(root: str, collection: str, start_date: Optional[str] = None, end_date: Optional[str] = None,
+         user_ids: Optional[Iterable[str]] = None, user_buckets: int = LEDGER_USER_BUCKETS):
+    """
+    The latest row of every record of `collection` of `user_ids` in the
+    partitions between `start_date` and `end_date` (YYYY-MM-DD, inclusive),
+    as a pyarrow Table with the `date` and `user_bucket` partition columns.
+    """
+    pa, _ = pyarrow_modules()
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+
+    partition_schema = pa.schema([("date", pa.string()), ("user_bucket", pa.int32())])
+    schema = pa.unify_schemas([ledger_schema(pa, collection), partition_schema])
+    directory = os.path.join(root, collection)
+    if not os.path.isdir(directory):
+        return schema.empty_table()
+    dataset = ds.dataset(directory, format="parquet", schema=schema,
+                         partitioning=ds.partitioning(partition_schema, flavor="hive"))
+    if user_ids is not None:
+        user_ids = list(user_ids)
+    condition = None
+    for clause in (
+        pc.field("date") >= start_date if start_date else None,
+        pc.field("date") <= end_date if end_date else None,
+        # The bucket prunes directories, the user filter rows
+        pc.field("user_bucket").isin(sorted({user_bucket(user_id, user_buckets) for user_id in user_ids}))
+        if user_ids is not None else None,
+        pc.field("user_id").isin(user_ids) if user_ids is not None else None,
+    ):
+        if clause is not None:
+            condition = clause if condition is None else condition & clause
+    return latest(dataset.to_table(filter=condition), LEDGER_KEYS[collection])
+
+
+def fee_totals(root: str, start_date: Optional[str] = None, end_date: Optional[str] = None):
+    """On-chain fees per day. A transaction paying several users is counted once."""
+    table = load(root, TRANSACTIONS_SUBCOLLECTION, start_date, end_date)
+    table = latest(table.drop_columns(["user_id"]), ("tx_hash",))
+    per_day = table.group_by("date").aggregate([("total_fees", "sum"), ("tx_hash", "count")])
+    return per_day.rename_columns(["date", "total_fees", "transactions"]).sort_by("date")
+
+
+def settled_volume(root: str, start_date: Optional[str] = None, end_date: Optional[str] = None):
+    """Settled Lightning amount and count per day, by the day the invoices were created."""
+    import pyarrow.compute as pc
+
+    table = load(root, INVOICES_SUBCOLLECTION, start_date, end_date)
+    settled = table.filter(pc.equal(table["state"], "SETTLED"))
+    per_day = settled.group_by("date").aggregate([("amt_paid_sat", "sum"), ("payment_addr", "count")])
+    return per_day.rename_columns(["date", "settled_sat", "settled_invoices"]).sort_by("date")
+
+
+def user_balances(root: str, user_ids: Optional[Iterable[str]] = None, end_date: Optional[str] = None):
+    """
+    Per user: confirmed and unconfirmed on-chain amounts received, settled
+    Lightning amount and the time of the last activity.
+    """
+    pa, _ = pyarrow_modules()
+    import pyarrow.compute as pc
+
+    user_ids = list(user_ids) if user_ids is not None else None
+    transactions = load(root, TRANSACTIONS_SUBCOLLECTION, end_date=end_date, user_ids=user_ids)
+    confirmed = pc.greater(transactions["num_confirmations"], 0)
+    transactions = transactions.append_column(
+        "onchain_confirmed_sat", pc.if_else(confirmed, transactions["received_sat"], 0)
+    ).append_column(
+        "onchain_unconfirmed_sat", pc.if_else(confirmed, 0, transactions["received_sat"])
+    )
+    onchain = transactions.group_by("user_id").aggregate([
+        ("onchain_confirmed_sat", "sum"), ("onchain_unconfirmed_sat", "sum"), ("time_stamp", "max"),
+    ]).rename_columns(["user_id", "onchain_confirmed_sat", "onchain_unconfirmed_sat", "last_onchain_at"])
+
+    invoices = load(root, INVOICES_SUBCOLLECTION, end_date=end_date, user_ids=user_ids)
+    settled = invoices.filter(pc.equal(invoices["state"], "SETTLED"))
+    lightning = settled.group_by("user_id").aggregate([
+        ("amt_paid_sat", "sum"), ("settle_date", "max"),
+    ]).rename_columns(["user_id", "lightning_received_sat", "last_settled_at"])
+
+    balances = onchain.join(lightning, keys="user_id", join_type="full outer")
+    columns = {"user_id": balances["user_id"]}
+    for name in ("onchain_confirmed_sat", "onchain_unconfirmed_sat", "lightning_received_sat"):
+        columns[name] = pc.fill_null(balances[name], 0)
+    columns["last_activity_at"] = pc.max_element_wise(pc.fill_null(balances["last_onchain_at"], 0),
+                                                      pc.fill_null(balances["last_settled_at"], 0))
+    return pa.table(columns).sort_by("user_id")
+
+
+REPORTS = {
+    "fees": lambda args: fee_totals(args.ledger, args.start_date, args.end_date),
+    "volume": lambda args: settled_volume(args.ledger, args.start_date, args.end_date),
+    "balances": lambda args: user_balances(args.ledger, args.user or None, args.end_date),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("report", choices=sorted(REPORTS))
+    parser.add_argument("--ledger", default="./state/ledger", help="ledger directory")
+    parser.add_argument("--from", dest="start_date", metavar="YYYY-MM-DD")
+    parser.add_argument("--to", dest="end_date", metavar="YYYY-MM-DD")
+    parser.add_argument("--user", action="append", help="only these users, balances report only")
+    parser.add_argument("--csv", action="store_true", help="print CSV instead of a table")
+    args = parser.parse_args()
+
+    table = REPORTS[args.report](args)
+    if args.csv:
+        import pyarrow.csv
+
+        pyarrow.csv.write_csv(table, sys.stdout.buffer)
+        return
+    print("\t".join(table.column_names))
+    for row in table.to_pylist():
+        print("\t".join(str(row[name]) for name in table.column_names))
+
+
+if __name__ == "__main__":
+    main()
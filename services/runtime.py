@@ -0,0 +1,257 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+from services.activity import ActivityCache, ActivityReader
+from services.chain import ChainTip
+from services.lnd_node import LndNode
+
+logger = logging.getLogger(__name__)
+
+
+class Runtime:
+    """
+    Everything one process runs: the shared owner-lookup and Firestore write
+    layers and the LND nodes feeding them.
+
+    Built by the application's lifespan handler once the Firestore client
+    exists, so nothing here is created at import time.
+
+    Without a `lease` this process ingests as soon as it starts. With one
+    (see services.leadership) only the worker holding the lease runs the
+    subscriptions, backfill and writer. The others keep trying to acquire it
+    every `lease_retry_interval` seconds and serve HTTP in the meantime. The
+    holder renews it every `lease_renew_interval` seconds and stops ingesting
+    as soon as a renewal fails.
+
+    With a `chain` (services.chain.ChainTracker) the ingesting process polls
+    the chain tip of every node every `chain_poll_interval` seconds, follows
+    the highest one among the nodes that answered and are synced to the
+    chain, and has every node fetch the transactions of reorganized blocks
+    again.
+
+    With a `blob_collect_interval` the ingesting process deletes the blobs
+    no document references anymore (see services.projection.BlobStore)
+    every that many seconds, keeping those written in the last
+    `blob_min_age` seconds.
+    """
+
+    def __init__(self, db, address_index, writer, fingerprints, checkpoints, executor, ingestor,
+                 nodes: List[LndNode], activity_cache: ActivityCache, activity: ActivityReader, aggregator=None, journal=None, ledger=None,
+                 notifications=None, chain=None, chain_poll_interval: float = 10.0,
+                 blob_collect_interval: Optional[float] = None, blob_min_age: float = 3600.0,
+                 address_index_ready_timeout: float = 30, lease=None,
+                 lease_renew_interval: float = 5.0, lease_retry_interval: float = 1.0):
+        self.db = db
+        self.address_index = address_index
+        self.writer = writer
+        self.fingerprints = fingerprints
+        self.checkpoints = checkpoints
+        self.executor = executor
+        self.ingestor = ingestor
+        self.nodes = nodes
+        self.activity_cache = activity_cache
+        self.activity = activity
+        self.aggregator = aggregator
+        self.journal = journal
+        self.ledger = ledger
+        self.notifications = notifications
+        self.chain = chain
+        self.chain_poll_interval = chain_poll_interval
+        self._chain_watcher: Optional[asyncio.Task] = None
+        self.blob_collect_interval = blob_collect_interval
+        self.blob_min_age = blob_min_age
+        self._blob_collector: Optional[asyncio.Task] = None
+        # Last tip of every healthy node, by node name
+        self.chain_tips: Dict[str, ChainTip] = {}
+        self._reconcile: Optional[asyncio.Task] = None
+        self.address_index_ready_timeout = address_index_ready_timeout
+        self.lease = lease
+        self.lease_renew_interval = lease_renew_interval
+        self.lease_retry_interval = lease_retry_interval
+        self.ingesting = False
+        self._elector: Optional[asyncio.Task] = None
+        self._starting: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self.lease is None:
+            await self.start_ingestion()
+        else:
+            self._elector = asyncio.create_task(self._hold_lease())
+
+    async def stop(self):
+        if self._elector is not None:
+            self._elector.cancel()
+            await asyncio.gather(self._elector, return_exceptions=True)
+            self._elector = None
+        await self.stop_ingestion()
+        if self.lease is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.lease.release)
+        await asyncio.gather(*(node.close() for node in self.nodes), return_exceptions=True)
+        if self.aggregator is not None:
+            self.aggregator.close()
+        if self.journal is not None:
+            self.journal.close()
+        if self.chain is not None:
+            self.chain.close()
+        if self.notifications is not None:
+            self.notifications.close()
+        self.checkpoints.close()
+        self.executor.shutdown(wait=False)
+
+    def leadership_status(self) -> dict:
+        return {
+            "mode": type(self.lease).__name__ if self.lease is not None else None,
+            "holder_id": getattr(self.lease, 'holder_id', None),
+            "ingesting": self.ingesting,
+        }
+
+    def reconcile_aggregates(self) -> bool:
+        """Start rebuilding and verifying every user's aggregates, return False if it cannot start now."""
+        if self.aggregator is None or not self.ingesting or (self._reconcile is not None and not self._reconcile.done()):
+            return False
+        loop = asyncio.get_running_loop()
+        self._reconcile = asyncio.create_task(self._run_reconcile(loop))
+        return True
+
+    async def _run_reconcile(self, loop):
+        try:
+            await loop.run_in_executor(self.executor, self.aggregator.reconcile)
+        except Exception:
+            logger.exception('aggregate reconciliation failed')
+
+    async def start_ingestion(self):
+        if self.ingesting:
+            return
+        self.ingesting = True
+        loop = asyncio.get_running_loop()
+        # From now on every record passes through this process, see ActivityCache
+        self.activity_cache.reset()
+        if self.notifications is not None:
+            self.notifications.start()
+
+        self.address_index.start()
+        self.writer.start()
+        if self.ledger is not None:
+            self.ledger.start()
+        if not await loop.run_in_executor(None, self.address_index.wait_ready, self.address_index_ready_timeout):
+            logger.warning('address index not ready yet, falling back to owner queries')
+
+        # Every node runs its streams and backfill as tasks on this event loop
+        for node in self.nodes:
+            await node.start()
+        logger.info('lnd nodes started', extra={'nodes': [node.name for node in self.nodes]})
+        if self.chain is not None and self.nodes:
+            self._chain_watcher = asyncio.create_task(self._watch_chain())
+        if self.ingestor.blobs is not None and self.blob_collect_interval is not None:
+            self._blob_collector = asyncio.create_task(self._collect_blobs())
+
+    async def stop_ingestion(self):
+        if not self.ingesting:
+            return
+        self.ingesting = False
+        # Another worker may be writing from now on, the cache would go stale
+        self.activity_cache.clear()
+        if self.notifications is not None:
+            # Clients reconnect and find the worker that publishes now
+            self.notifications.stop()
+        if self._reconcile is not None:
+            # The job stops after the user it is working on
+            self.aggregator.cancel_reconcile()
+            await asyncio.gather(self._reconcile, return_exceptions=True)
+            self._reconcile = None
+        if self._chain_watcher is not None:
+            self._chain_watcher.cancel()
+            await asyncio.gather(self._chain_watcher, return_exceptions=True)
+            self._chain_watcher = None
+        if self._blob_collector is not None:
+            # A collection under way finishes on the executor, its deletes are conditional
+            self._blob_collector.cancel()
+            await asyncio.gather(self._blob_collector, return_exceptions=True)
+            self._blob_collector = None
+        if self._starting is not None:
+            self._starting.cancel()
+            await asyncio.gather(self._starting, return_exceptions=True)
+            self._starting = None
+        await asyncio.gather(*(node.stop() for node in self.nodes), return_exceptions=True)
+        self.address_index.stop()
+        await asyncio.get_running_loop().run_in_executor(None, self.writer.close)
+        if self.ledger is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.ledger.close)
+
+    async def _watch_chain(self):
+        """Move the chain tip along with LND's, once per block, and refetch reorganized transactions."""
+        loop = asyncio.get_running_loop()
+        # Kept until the refetch succeeded
+        refetch_from: Optional[int] = None
+        while True:
+            try:
+                tip = await self._poll_chain_tips()
+                if tip is not None:
+                    reorg_from = await loop.run_in_executor(self.executor, self.chain.advance,
+                                                            tip.block_height, tip.block_hash)
+                    if reorg_from is not None:
+                        refetch_from = reorg_from if refetch_from is None else min(refetch_from, reorg_from)
+                if refetch_from is not None:
+                    logger.warning('refetching transactions after a chain reorganization',
+                                   extra={'start_height': refetch_from})
+                    await asyncio.gather(*(node.refetch_transactions(refetch_from) for node in self.nodes))
+                    refetch_from = None
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('chain tip update failed')
+            await asyncio.sleep(self.chain_poll_interval)
+
+    async def _collect_blobs(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.blob_collect_interval)
+            try:
+                await loop.run_in_executor(self.executor, self.ingestor.blobs.collect, self.blob_min_age)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('blob collection failed')
+
+    async def _poll_chain_tips(self) -> Optional[ChainTip]:
+        """
+        Update `chain_tips` from every node and return the highest tip, None
+        if no node is healthy. A node behind the others is not taken for a
+        reorganization, and on a tie the current tip is kept.
+        """
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*(loop.run_in_executor(self.executor, node.lnd.get_chain_tip)
+                                         for node in self.nodes), return_exceptions=True)
+        for node, result in zip(self.nodes, results):
+            if isinstance(result, Exception):
+                logger.warning('chain tip poll failed', extra={'node': node.name, 'error': repr(result)})
+                self.chain_tips.pop(node.name, None)
+                continue
+            block_height, block_hash, synced = result
+            if not synced:
+                logger.warning('node not synced to the chain, its tip is ignored',
+                               extra={'node': node.name, 'block_height': block_height})
+                self.chain_tips.pop(node.name, None)
+                continue
+            self.chain_tips[node.name] = ChainTip(block_height, block_hash)
+        if not self.chain_tips:
+            return None
+        current = self.chain.tip
+        return max(self.chain_tips.values(), key=lambda tip: (tip.block_height, tip == current))
+
+    async def _hold_lease(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self.ingesting:
+                if not await loop.run_in_executor(None, self.lease.try_acquire):
+                    await asyncio.sleep(self.lease_retry_interval)
+                    continue
+                logger.info('acquired the stream lease, starting ingestion', extra={'holder': self.lease.holder_id})
+                # Started in the background so waiting for the address index does not hold up renewals
+                self._starting = asyncio.create_task(self.start_ingestion())
+            elif not await loop.run_in_executor(None, self.lease.renew):
+                logger.warning('lost the stream lease, stopping ingestion', extra={'holder': self.lease.holder_id})
+                await self.stop_ingestion()
+                continue
+            await asyncio.sleep(self.lease_renew_interval)
@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import random
+import time
+from contextlib import AbstractAsyncContextManager
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional, Set
+
+import httpx
+
+from services.metrics import STREAM_CONNECTED, STREAM_GAP, STREAM_IDLE_TIMEOUTS, STREAM_RECONNECTS
+
+logger = logging.getLogger(__name__)
+
+# Stream states
+STOPPED = 'stopped'
+CONNECTING = 'connecting'
+STREAMING = 'streaming'
+BACKOFF = 'backoff'
+
+
+class StreamIdle(Exception):
+    """Nothing was read from the stream for the idle timeout."""
+
+
+def backoff_delay(attempt: int, initial: float, maximum: float) -> float:
+    """
+    Delay before reconnect `attempt` (0 is the first after a healthy session):
+    none, then full jitter over an exponentially growing, capped window.
+    """
+    if attempt == 0:
+        return 0.0
+    return random.uniform(0, min(maximum, initial * 2 ** (attempt - 1)))
+
+
+@dataclass
+class StreamHealth:
+    state: str = STOPPED
+    since: Optional[float] = None
+    # Failed attempts since the last healthy session
+    attempt: int = 0
+    reconnects: int = 0
+    idle_timeouts: int = 0
+    connected_at: Optional[float] = None
+    last_event_at: Optional[float] = None
+    last_error: Optional[str] = None
+    retry_at: Optional[float] = None
+    catch_up: str = 'idle'  # idle, running, done or failed
+    caught_up: int = 0
+
+    def to_json(self) -> dict:
+        return {
+            "state": self.state,
+            "since": self.since,
+            "attempt": self.attempt,
+            "reconnects": self.reconnects,
+            "idle_timeouts": self.idle_timeouts,
+            "connected_at": self.connected_at,
+            "last_event_at": self.last_event_at,
+            "last_error": self.last_error,
+            "retry_at": self.retry_at,
+            "catch_up": self.catch_up,
+            "caught_up": self.caught_up,
+        }
+
+
+class StreamSupervisor:
+    """
+    Keeps one LND subscription stream open for as long as it runs.
+
+    Every line read is handed to `on_line(line, received_at)`, which returns
+    the key of the record it carried. Whatever ends a session (an error, LND
+    closing the stream or nothing read for `idle_timeout` seconds, which is
+    how a half-open connection shows) leads to a reconnect, never to giving
+    up. The first reconnect after a healthy session, one that delivered an
+    event or stayed up for `stable_after` seconds, is immediate. Further
+    attempts back off with full jitter up to `max_retry_delay`.
+
+    The stream is reopened before anything missed in between is fetched:
+    `catch_up(seen_live)` runs concurrently with the new session and must
+    skip the records for which `seen_live(key)` is true, since the stream
+    already delivered a state at least as new. It is retried with the same
+    backoff until it succeeds or the next session replaces it.
+    """
+
+    def __init__(self, node: str, stream: str, open_stream: Callable[[], AbstractAsyncContextManager],
+                 on_line: Callable[[str, float], str],
+                 catch_up: Optional[Callable[[Callable[[str], bool]], Awaitable[int]]] = None,
+                 retry_delay: float = 1.0, max_retry_delay: float = 60.0, idle_timeout: Optional[float] = 300.0,
+                 stable_after: float = 30.0):
+        self.node = node
+        self.stream = stream
+        self.health = StreamHealth()
+        self._open_stream = open_stream
+        self._on_line = on_line
+        self._catch_up = catch_up
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.idle_timeout = idle_timeout
+        self.stable_after = stable_after
+        self._catch_up_task: Optional[asyncio.Task] = None
+        self._delivered = False
+        # Keys delivered by the stream while a catch-up runs
+        self._live_keys: Set[str] = set()
+
+    @property
+    def state(self) -> str:
+        return self.health.state
+
+    @property
+    def catching_up(self) -> bool:
+        return self._catch_up_task is not None
+
+    async def run(self):
+        health = self.health
+        extra = {'node': self.node, 'stream': self.stream}
+        logger.info('starting stream', extra=extra)
+        disconnected_at = None
+        try:
+            while True:
+                self._set_state(CONNECTING)
+                self._delivered = False
+                healthy = False
+                try:
+                    async with self._open_stream() as response:
+                        started = time.monotonic()
+                        health.connected_at = time.time()
+                        self._set_state(STREAMING)
+                        STREAM_CONNECTED.labels(self.node, self.stream).set(1)
+                        if disconnected_at is not None:
+                            STREAM_GAP.labels(self.stream).observe(time.monotonic() - disconnected_at)
+                            # Only a reconnect can have missed something, startup is covered by the backfill
+                            self._start_catch_up()
+                        logger.info('stream began', extra=extra)
+                        try:
+                            await self._read(response)
+                        finally:
+                            healthy = self._delivered or time.monotonic() - started >= self.stable_after
+                except asyncio.CancelledError:
+                    raise
+                except StreamIdle:
+                    health.idle_timeouts += 1
+                    STREAM_IDLE_TIMEOUTS.labels(self.node, self.stream).inc()
+                    health.last_error = f'nothing read for {self.idle_timeout} seconds'
+                    logger.warning('stream idle, reconnecting', extra={**extra, 'idle_timeout': self.idle_timeout})
+                except httpx.TimeoutException as e:
+                    health.last_error = repr(e)
+                    logger.warning('stream stopped: timeout, reconnecting', extra=extra)
+                except httpx.TransportError as e:
+                    health.last_error = repr(e)
+                    logger.warning('stream stopped, reconnecting', extra={**extra, 'error': repr(e)})
+                except Exception as e:
+                    health.last_error = repr(e)
+                    logger.exception('stream stopped: unexpected error, reconnecting', extra=extra)
+                else:
+                    health.last_error = 'closed by LND'
+                    logger.warning('stream closed by LND, reconnecting', extra=extra)
+                STREAM_CONNECTED.labels(self.node, self.stream).set(0)
+                disconnected_at = time.monotonic()
+                health.reconnects += 1
+                STREAM_RECONNECTS.labels(self.node, self.stream).inc()
+                health.attempt = 0 if healthy else health.attempt + 1
+                delay = backoff_delay(health.attempt, self.retry_delay, self.max_retry_delay)
+                if delay:
+                    self._set_state(BACKOFF)
+                    health.retry_at = time.time() + delay
+                    await asyncio.sleep(delay)
+                    health.retry_at = None
+        finally:
+            STREAM_CONNECTED.labels(self.node, self.stream).set(0)
+            await self._stop_catch_up()
+            health.retry_at = None
+            self._set_state(STOPPED)
+
+    async def _read(self, response):
+        """Hand on the lines of `response` until the stream ends."""
+        loop = asyncio.get_running_loop()
+        self._delivered = False
+        try:
+            # One deadline moved along with every line, cheaper than a timeout per read
+            async with asyncio.timeout(self.idle_timeout) as deadline:
+                async for line in response.aiter_lines():
+                    if self.idle_timeout is not None:
+                        deadline.reschedule(loop.time() + self.idle_timeout)
+                    if not line:
+                        continue
+                    received_at = time.time()
+                    key = self._on_line(line, received_at)
+                    self.health.last_event_at = received_at
+                    if not self._delivered:
+                        # A healthy session, the next reconnect is immediate again
+                        self._delivered = True
+                        self.health.attempt = 0
+                    if self._catch_up_task is not None:
+                        self._live_keys.add(key)
+        except TimeoutError:
+            raise StreamIdle() from None
+
+    def _start_catch_up(self):
+        if self._catch_up is None:
+            return
+        if self._catch_up_task is not None:
+            self._catch_up_task.cancel()
+        self._live_keys = set()
+        self._catch_up_task = asyncio.create_task(self._run_catch_up())
+
+    async def _run_catch_up(self):
+        health = self.health
+        extra = {'node': self.node, 'stream': self.stream}
+        attempt = 0
+        health.catch_up = 'running'
+        try:
+            while True:
+                try:
+                    health.caught_up = await self._catch_up(self._live_keys.__contains__)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    attempt += 1
+                    health.catch_up = 'failed'
+                    health.last_error = repr(e)
+                    logger.exception('stream catch-up failed, retrying', extra={**extra, 'attempt': attempt})
+                    await asyncio.sleep(backoff_delay(attempt, self.retry_delay, self.max_retry_delay))
+                    health.catch_up = 'running'
+                    continue
+                health.catch_up = 'done'
+                logger.info('stream caught up', extra={**extra, 'records': health.caught_up})
+                return
+        finally:
+            if self._catch_up_task is asyncio.current_task():
+                self._catch_up_task = None
+                self._live_keys = set()
+
+    async def _stop_catch_up(self):
+        task = self._catch_up_task
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+    def _set_state(self, state: str):
+        if self.health.state != state:
+            self.health.state = state
+            self.health.since = time.time()
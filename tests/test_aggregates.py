@@ -0,0 +1,110 @@
+"""
+Aggregator totals under replay: records are applied once their document is
+committed, and a journal replay or a restart hands the same records to
+`apply` again, which must not count them twice.
+"""
+from benchmarks.fake_firestore import FakeFirestore
+from services.aggregates import AGGREGATES_SUBCOLLECTION, SUMMARY_DOCUMENT, Aggregator
+from services.firestore_writer import BatchWriter
+from services.ingestion import BACKEND_COLLECTION, INVOICES_SUBCOLLECTION, TRANSACTIONS_SUBCOLLECTION
+
+USER = "user1"
+ADDRESS = "bc1qtest"
+
+
+class Owners:
+    def get_owner(self, address):
+        return USER if address == ADDRESS else None
+
+
+def transaction(amount: int, confirmations: int) -> dict:
+    return {
+        "output_details": [{"address": ADDRESS, "amount": str(amount), "is_our_address": True},
+                           {"address": "bc1qother", "amount": "999", "is_our_address": False}],
+        "num_confirmations": confirmations,
+        "time_stamp": "1700000000",
+    }
+
+
+def invoice(state: str, amount: int) -> dict:
+    return {"state": state, "amt_paid_sat": str(amount), "settle_date": "1700000100", "creation_date": "1700000050"}
+
+
+class Setup:
+    def __init__(self, path=None):
+        self.db = FakeFirestore()
+        self.writer = BatchWriter(self.db)
+        self.aggregator = Aggregator(self.db, self.writer, Owners(), path)
+
+    def write(self, collection: str, document_id: str, data: dict):
+        """Commit a record like the Ingestor does, then apply it."""
+        ref = self.db.collection(BACKEND_COLLECTION).document(USER).collection(collection).document(document_id)
+        ref.set(data, merge=True)
+        self.aggregator.apply(USER, collection, document_id, data)
+
+    def summary(self) -> dict:
+        self.writer.flush()
+        ref = (self.db.collection(BACKEND_COLLECTION).document(USER)
+               .collection(AGGREGATES_SUBCOLLECTION).document(SUMMARY_DOCUMENT))
+        summary = ref.get().to_dict()
+        summary.pop("updated_at")
+        return summary
+
+
+def test_replayed_records_are_counted_once():
+    setup = Setup()
+    setup.write(TRANSACTIONS_SUBCOLLECTION, "tx1", transaction(1000, 0))
+    setup.write(INVOICES_SUBCOLLECTION, "inv1", invoice("SETTLED", 500))
+    totals = setup.summary()
+    assert totals["onchain_unconfirmed_sat"] == 1000
+    assert totals["lightning_received_sat"] == 500
+    assert totals["transaction_count"] == 1
+    assert totals["invoice_count"] == 1
+
+    setup.aggregator.apply(USER, TRANSACTIONS_SUBCOLLECTION, "tx1", transaction(1000, 0))
+    setup.aggregator.apply(USER, INVOICES_SUBCOLLECTION, "inv1", invoice("SETTLED", 500))
+    assert setup.summary() == totals
+
+
+def test_updates_replace_the_previous_contribution():
+    setup = Setup()
+    setup.write(TRANSACTIONS_SUBCOLLECTION, "tx1", transaction(1000, 0))
+    setup.write(TRANSACTIONS_SUBCOLLECTION, "tx1", transaction(1000, 1))
+    setup.write(INVOICES_SUBCOLLECTION, "inv1", invoice("OPEN", 0))
+    setup.write(INVOICES_SUBCOLLECTION, "inv1", invoice("SETTLED", 500))
+    # Replaying the latest state of a record changes nothing
+    setup.aggregator.apply(USER, TRANSACTIONS_SUBCOLLECTION, "tx1", transaction(1000, 1))
+    totals = setup.summary()
+    assert totals["onchain_confirmed_sat"] == 1000
+    assert totals["onchain_unconfirmed_sat"] == 0
+    assert totals["transaction_count"] == 1
+    assert totals["lightning_received_sat"] == 500
+    assert totals["invoice_count"] == 1
+    assert totals["settled_invoice_count"] == 1
+    assert totals["last_activity_at"] == 1700000100
+
+
+def test_replay_after_a_restart_is_a_no_op(tmp_path):
+    path = str(tmp_path / "aggregates.db")
+    setup = Setup(path)
+    setup.write(TRANSACTIONS_SUBCOLLECTION, "tx1", transaction(1000, 1))
+    totals = setup.summary()
+    setup.aggregator.close()
+
+    setup.aggregator = Aggregator(setup.db, setup.writer, Owners(), path)
+    setup.aggregator.apply(USER, TRANSACTIONS_SUBCOLLECTION, "tx1", transaction(1000, 1))
+    assert setup.summary() == totals
+    assert not setup.aggregator.rebuild(USER)
+
+
+def test_replay_into_a_lost_store_counts_the_committed_record_once():
+    setup = Setup()
+    setup.write(TRANSACTIONS_SUBCOLLECTION, "tx1", transaction(1000, 1))
+    setup.write(INVOICES_SUBCOLLECTION, "inv1", invoice("SETTLED", 500))
+    totals = setup.summary()
+
+    # A new store rebuilds the user from Firestore, which already has the replayed record
+    setup.aggregator = Aggregator(setup.db, setup.writer, Owners())
+    setup.aggregator.apply(USER, TRANSACTIONS_SUBCOLLECTION, "tx1", transaction(1000, 1))
+    assert setup.summary() == totals
+    assert not setup.aggregator.rebuild(USER)
@@ -0,0 +1,145 @@
+"""
+Replays recorded LND stream fixtures through the Coalescer with the flush
+rules of LndNode. Each fixture line is a stream line as received, with
+`at` its arrival in seconds after the first one.
+"""
+import asyncio
+import json
+import os
+import time
+
+from data_classes.invoice import Invoice
+from data_classes.transaction import Transaction
+from services.coalescer import Coalescer
+from services.journal import JournalEntry
+from services.lnd_node import LndNode, flush_invoice_now, flush_transaction_now
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+WINDOW = 0.2
+
+TX_A = "a1" * 32
+TX_B = "b2" * 32
+INVOICE_1 = "21" * 32
+INVOICE_2 = "22" * 32
+INVOICE_3 = "23" * 32
+INVOICE_4 = "24" * 32
+
+
+def transaction_entry(seq: int, line: str) -> JournalEntry:
+    transaction = Transaction.from_json(json.loads(line))
+    return JournalEntry(seq, transaction.tx_hash, transaction, None)
+
+
+def invoice_entry(seq: int, line: str) -> JournalEntry:
+    invoice = Invoice.from_json(json.loads(line)["result"])
+    return JournalEntry(seq, LndNode.invoice_key(invoice), invoice, None)
+
+
+def load(name: str):
+    with open(os.path.join(FIXTURES, name)) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def replay(name: str, parse, flush_now):
+    """Forwarded (key, entry, received_at, seconds after the first line) in order."""
+    forwarded = []
+    started = time.monotonic()
+
+    async def forward(key, entry, received_at):
+        forwarded.append((key, entry, received_at, time.monotonic() - started))
+
+    coalescer = Coalescer("test", forward, WINDOW, flush_now=flush_now)
+    coalescer.start()
+    for seq, recorded in enumerate(load(name)):
+        delay = started + recorded["at"] - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        entry = parse(seq, recorded["line"])
+        await coalescer.submit(entry.key, entry, recorded["at"])
+    await asyncio.sleep(WINDOW * 2)
+    await coalescer.stop()
+    assert coalescer.pending_count() == 0
+    return forwarded
+
+
+def replay_transactions():
+    return asyncio.run(replay("transactions_stream.jsonl", transaction_entry, flush_transaction_now))
+
+
+def replay_invoices():
+    return asyncio.run(replay("invoices_stream.jsonl", invoice_entry, flush_invoice_now))
+
+
+def test_transaction_updates_in_a_window_are_merged():
+    forwarded = replay_transactions()
+    # 7 lines: the 3 updates of A after its first confirmation are one write, B and the late update one each
+    assert [(key, entry.record.num_confirmations) for key, entry, _, _ in forwarded] == [
+        (TX_A, 1), (TX_B, 0), (TX_A, 3), (TX_A, 4),
+    ]
+
+
+def test_first_confirmation_is_forwarded_immediately():
+    forwarded = replay_transactions()
+    key, entry, received_at, forwarded_at = forwarded[0]
+    assert (key, entry.record.num_confirmations) == (TX_A, 1)
+    # Replaces the unconfirmed updates held for A, without waiting for their window
+    assert forwarded_at < WINDOW
+    assert received_at == 0.0
+
+
+def test_transaction_last_writer_state():
+    forwarded = replay_transactions()
+    latest = {}
+    for key, entry, _, _ in forwarded:
+        latest[key] = entry.record
+    assert latest[TX_A].num_confirmations == 4
+    assert latest[TX_A].label == "deposit"
+    assert latest[TX_A].block_height == 800100
+    assert latest[TX_B].num_confirmations == 0
+    # The merged write keeps the earliest receive time of the updates it replaced
+    assert [received_at for key, _, received_at, _ in forwarded if key == TX_A] == [0.0, 0.04, 0.4]
+
+
+def test_settled_and_canceled_invoices_are_forwarded_immediately():
+    forwarded = replay_invoices()
+    immediate = [(key, entry.record.state) for key, entry, _, forwarded_at in forwarded if forwarded_at < WINDOW]
+    assert immediate == [(INVOICE_1, "SETTLED"), (INVOICE_2, "CANCELED")]
+
+
+def test_invoice_updates_in_a_window_are_merged():
+    forwarded = replay_invoices()
+    assert [(key, entry.record.state) for key, entry, _, _ in forwarded] == [
+        (INVOICE_1, "SETTLED"), (INVOICE_2, "CANCELED"), (INVOICE_3, "ACCEPTED"), (INVOICE_4, "OPEN"),
+    ]
+
+
+def test_invoice_last_writer_state():
+    forwarded = replay_invoices()
+    by_key = {key: (entry, received_at) for key, entry, received_at, _ in forwarded}
+    settled, received_at = by_key[INVOICE_1]
+    assert settled.record.settled
+    assert settled.record.settle_index == "1"
+    assert received_at == 0.0
+    accepted, received_at = by_key[INVOICE_3]
+    # The ACCEPTED update is written with the fields of the last line, not the memo of the one before
+    assert accepted.record.memo == "order 3"
+    assert len(accepted.record.htlcs) == 1
+    assert received_at == 0.02
+
+
+def test_zero_window_forwards_every_update():
+    async def run():
+        forwarded = []
+
+        async def forward(key, entry, received_at):
+            forwarded.append(entry.seq)
+
+        coalescer = Coalescer("test", forward, 0, flush_now=flush_transaction_now)
+        recorded = load("transactions_stream.jsonl")
+        for seq, line in enumerate(recorded):
+            entry = transaction_entry(seq, line["line"])
+            await coalescer.submit(entry.key, entry, line["at"])
+        return forwarded, len(recorded)
+
+    forwarded, count = asyncio.run(run())
+    assert forwarded == list(range(count))
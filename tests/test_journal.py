@@ -0,0 +1,162 @@
+"""
+The EventJournal and JournalStream as LndNode drives them: entries are
+appended, read and handed on, and only the positions staged by a drain
+without failures are persisted. Anything else is replayed.
+"""
+import asyncio
+import os
+import sqlite3
+
+from services.journal import EventJournal, JournalStream
+
+STREAM = "test.transactions"
+
+
+def open_stream(journal: EventJournal) -> JournalStream:
+    return JournalStream(journal, STREAM, lambda data: data)
+
+
+def append(stream: JournalStream, entries):
+    async def run():
+        for key, data in entries:
+            stream.append(key, data, 1.0)
+        await stream.flush()
+
+    asyncio.run(run())
+
+
+def keys(entries):
+    return [entry.key for entry in entries]
+
+
+def test_entries_are_read_in_order(tmp_path):
+    journal = EventJournal(str(tmp_path / "journal.db"))
+    stream = open_stream(journal)
+    append(stream, [("a", {"n": 1}), ("b", {"n": 2}), ("a", {"n": 3})])
+    entries = stream.read(10)
+    assert keys(entries) == ["a", "b", "a"]
+    assert [entry.record["n"] for entry in entries] == [1, 2, 3]
+    assert stream.read(10) == []
+    journal.close()
+
+
+def test_reopened_journal_replays_what_was_not_committed(tmp_path):
+    path = str(tmp_path / "journal.db")
+    journal = EventJournal(path)
+    stream = open_stream(journal)
+    append(stream, [("a", {}), ("b", {}), ("c", {})])
+    a, b, c = stream.read(10)
+    stream.done(a)
+    stream.done(c)
+    journal.commit_staged()
+    journal.close()
+
+    # b is still pending, so the persisted position stops before it
+    journal = EventJournal(path)
+    stream = open_stream(journal)
+    assert keys(stream.read(10)) == ["b", "c"]
+    journal.close()
+
+
+def test_rewind_replays_from_the_persisted_position(tmp_path):
+    journal = EventJournal(str(tmp_path / "journal.db"))
+    stream = open_stream(journal)
+    append(stream, [("a", {}), ("b", {})])
+    a, b = stream.read(10)
+    stream.done(a)
+    journal.commit_staged()
+    stream.done(b)
+    # The drain failed, b's staged position is dropped
+    journal.rewind()
+    assert stream.rewound()
+    stream.rewind()
+    assert not stream.rewound()
+    assert keys(stream.read(10)) == ["b"]
+    journal.close()
+
+
+def test_later_entry_of_a_key_covers_the_earlier_ones(tmp_path):
+    journal = EventJournal(str(tmp_path / "journal.db"))
+    stream = open_stream(journal)
+    append(stream, [("a", {"n": 1}), ("b", {}), ("a", {"n": 2})])
+    first, b, second = stream.read(10)
+    stream.done(second)
+    assert stream.handled_up_to() == b.seq - 1
+    stream.done(b)
+    assert stream.handled_up_to() == second.seq
+    journal.close()
+
+
+def test_failed_entries_are_retried_until_replaced(tmp_path):
+    journal = EventJournal(str(tmp_path / "journal.db"))
+    stream = open_stream(journal)
+    append(stream, [("a", {"n": 1}), ("b", {})])
+    a, b = stream.read(10)
+    stream.failed(a)
+    stream.failed(b)
+    # Done reports for a failed entry do not count
+    stream.done(a)
+    retried = stream.take_failed()
+    assert keys(retried) == ["a", "b"]
+    assert not any(entry.failed for entry in retried)
+    assert stream.take_failed() == []
+
+    stream.failed(retried[0])
+    append(stream, [("a", {"n": 2})])
+    newer, = stream.read(10)
+    stream.done(newer)
+    # The newer state of a is written, only b is left to retry
+    assert stream.take_failed() == []
+    assert stream.handled_up_to() == b.seq - 1
+    journal.close()
+
+
+def test_commit_deletes_the_handled_entries(tmp_path):
+    journal = EventJournal(str(tmp_path / "journal.db"))
+    stream = open_stream(journal)
+    append(stream, [(str(i), {}) for i in range(10)])
+    assert journal.backlog(STREAM) == 10
+    entries = stream.read(10)
+    for entry in entries[:6]:
+        stream.done(entry)
+    journal.commit_staged()
+    assert journal.backlog(STREAM) == 4
+    assert journal.position(STREAM) == entries[5].seq
+    # Committing again with nothing staged changes nothing
+    journal.commit_staged()
+    assert journal.backlog(STREAM) == 4
+    journal.close()
+
+
+def test_compaction_returns_the_deleted_pages(tmp_path):
+    path = str(tmp_path / "journal.db")
+    journal = EventJournal(path, compact_interval=3600)
+    stream = open_stream(journal)
+    append(stream, [(str(i), {"raw": "x" * 1000}) for i in range(500)])
+    for entry in stream.read(500):
+        stream.done(entry)
+    journal.commit_staged()
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA freelist_count").fetchone()[0] > 0
+    size = os.path.getsize(path) + os.path.getsize(path + "-wal")
+
+    journal.compact()
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA freelist_count").fetchone()[0] == 0
+    # The WAL is checkpointed into the file and truncated
+    assert os.path.getsize(path + "-wal") == 0
+    assert os.path.getsize(path) < size
+    journal.close()
+
+
+def test_commit_compacts_once_the_interval_elapsed(tmp_path):
+    path = str(tmp_path / "journal.db")
+    journal = EventJournal(path, compact_interval=0)
+    stream = open_stream(journal)
+    append(stream, [(str(i), {"raw": "x" * 1000}) for i in range(500)])
+    for entry in stream.read(500):
+        stream.done(entry)
+    journal.commit_staged()
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA freelist_count").fetchone()[0] == 0
+    journal.close()